@@ -0,0 +1,261 @@
+"""Times the public functions of rms_tools and noise, and the end-to-end runners, on synthetic images of several sizes.
+
+Each run is appended to a results file as one JSON line, with the commit it was run on, so the numbers can be compared from run to run. The results file is benchmarks/results/benchmarks.jsonl unless --results names one, which git ignores, so the history of runs is kept from one session to the next without being committed. Everything else they write goes in a temporary working directory, which they run in. SExtractor is replaced by the stand-in in this directory unless --real-sextractor is given.
+
+Usage: python benchmarks/run_benchmarks.py [--sizes 512,1024,2048] [--repeat N] [--results FILE] [--compare] [--skip-runners]
+
+"""
+
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import chdir, environ, getcwd, makedirs, pathsep, remove
+from os.path import abspath, dirname, exists, join
+
+BENCH_DIR = dirname(abspath(__file__))
+REPO_DIR = dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+from astropy.io import fits
+import rms_tools as rms
+import noise
+import synthetic
+
+FIELD = 'bench'
+BANDS = ['F125', 'F160']
+
+# Results file used unless --results is given. The directory is ignored by git
+RESULTS_FNAME = join(BENCH_DIR, 'results', 'benchmarks.jsonl')
+
+def git_commit():
+    """The commit the repo is at, or None if it isn't a git checkout.
+
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def clear(*fnames):
+    for fname in fnames:
+        if exists(fname):
+            remove(fname)
+
+def band_dict(work_dir, band):
+    """Makes the field_band_dict the rms_tools and noise functions expect for one synthetic band, with every output in work_dir.
+
+    """
+    data_name = work_dir + 'data/borg_' + FIELD + '/borg_' + FIELD + '_' + band + '_drz_'
+    out_name = work_dir + 'out/' + FIELD + '_' + band + '_'
+    return {'sci': data_name + 'sci.fits',
+            'wht': data_name + 'wht.fits',
+            'rms_crude': out_name + 'rms_crude.fits',
+            'rms_norm': out_name + 'rms_norm.fits',
+            'segmap': out_name + 'seg_crude.fits',
+            'cat_crude': out_name + 'crude.cat',
+            'false_img': out_name + 'false_sources.fits',
+            'false_pos': out_name + 'false_sources.pos',
+            'seg_false': out_name + 'seg_false.fits',
+            'cat_false': out_name + 'false.cat',
+            'test_cat': out_name + 'test.cat',
+            'sex_log': out_name + 'sextractor.log',
+            'scratch': work_dir + 'out/',
+            'gain': 1000.,
+            'magz': 26.2303,
+            'no_false_srcs': 100}
+
+def time_call(func, setup=None, repeat=3):
+    """Times a call, taking the best of repeat runs.
+
+    Parameters
+    ----------
+    func : callable
+        The call to time
+    setup : callable or None
+        Called untimed before each run, e.g. to remove the outputs of the last run
+    repeat : int
+        Number of runs
+
+    Returns
+    -------
+    seconds : float
+
+    """
+    best = None
+    for n in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+def function_benchmarks(work_dir, size, repeat=3, block_rows=256):
+    """Times the public functions of rms_tools and noise on one synthetic field.
+
+    The functions are run in pipeline order, so each one's inputs are the outputs of those before it.
+
+    Returns
+    -------
+    results : list
+        A {'name', 'size', 'seconds'} dict for each function
+
+    """
+    fbd = band_dict(work_dir, BANDS[0])
+    wht_fnames = [band_dict(work_dir, band)['wht'] for band in BANDS]
+    mask_fname = work_dir + 'out/' + FIELD + '_mask.fits'
+    bitmask_fname = work_dir + 'out/' + FIELD + '_bitmask.fits'
+    norm_const = 1.2
+
+    def mask_data():
+        return fits.getdata(mask_fname)
+
+    benchmarks = [
+        ('rms_tools.bad_pixel_mask', lambda: rms.bad_pixel_mask(wht_fnames, mask_fname), lambda: clear(mask_fname)),
+        ('rms_tools.bad_pixel_mask[block_rows]', lambda: rms.bad_pixel_mask(wht_fnames, mask_fname, block_rows=block_rows), lambda: clear(mask_fname)),
+        ('rms_tools.bad_pixel_bitmask', lambda: rms.bad_pixel_bitmask(wht_fnames, bitmask_fname, bands=BANDS), lambda: clear(bitmask_fname)),
+        ('rms_tools.wht_to_rms_mask', lambda: rms.wht_to_rms_mask(fbd['wht'], fbd['rms_crude'], mask_data()), lambda: clear(fbd['rms_crude'])),
+        ('rms_tools.wht_to_rms[block_rows]', lambda: rms.wht_to_rms(fbd['wht'], fbd['rms_crude'], zero_handle=100, block_rows=block_rows), lambda: clear(fbd['rms_crude'])),
+        ('rms_tools.wht_to_rms', lambda: rms.wht_to_rms(fbd['wht'], fbd['rms_crude'], zero_handle=100), lambda: clear(fbd['rms_crude'])),
+        ('rms_tools.crude_segment', lambda: rms.crude_segment(fbd), None),
+        ('rms_tools.crude_segment[block_rows]', lambda: rms.crude_segment(fbd, block_rows=block_rows), None),
+        ('rms_tools.crude_SExtract', lambda: rms.crude_SExtract(fbd), lambda: clear(fbd['segmap'], fbd['cat_crude'])),
+        ('noise.false_sources', lambda: noise.false_sources(fbd, no_sources=fbd['no_false_srcs']), lambda: clear(fbd['false_img'], fbd['false_pos'])),
+        ('noise.false_sources[block_rows]', lambda: noise.false_sources(fbd, no_sources=fbd['no_false_srcs'], block_rows=block_rows), lambda: clear(fbd['false_img'], fbd['false_pos'])),
+        ('noise.false_SExtract', lambda: noise.false_SExtract(fbd), lambda: clear(fbd['cat_false'], fbd['seg_false'])),
+        ('noise.false_photometry', lambda: noise.false_photometry(fbd), None),
+        ('noise.read_catalog', lambda: noise.read_catalog(fbd['cat_false']), None),
+        ('noise.rms_norm_constant', lambda: noise.rms_norm_constant(fbd['cat_false']), None),
+        ('noise.predicted_norm_constant', lambda: noise.predicted_norm_constant(fbd['cat_false'], norm_const, gain=fbd['gain']), None),
+        ('rms_tools.norm_rms_map', lambda: rms.norm_rms_map(fbd['rms_crude'], fbd['rms_norm'], norm_const), lambda: clear(fbd['rms_norm'])),
+        ('rms_tools.norm_rms_map[block_rows]', lambda: rms.norm_rms_map(fbd['rms_crude'], fbd['rms_norm'], norm_const, block_rows=block_rows), lambda: clear(fbd['rms_norm'])),
+        ('noise.test_SExtract', lambda: noise.test_SExtract(fbd), lambda: clear(fbd['test_cat'])),
+    ]
+
+    results = []
+    for name, func, setup in benchmarks:
+        seconds = time_call(func, setup, repeat)
+        print "%-40s %6d %10.3f s" % (name, size, seconds)
+        results.append({'name': name, 'size': size, 'seconds': seconds})
+    return results
+
+def runner_benchmarks(work_dir, size, env, jobs=1):
+    """Times run_rms.py and make_detection_rms.py from scratch on the synthetic field.
+
+    Returns
+    -------
+    results : list
+        A {'name', 'size', 'seconds'} dict for each runner
+
+    """
+    results = []
+    for script in ('run_rms.py', 'make_detection_rms.py'):
+        shutil.rmtree(work_dir + 'out/', ignore_errors=True)
+        makedirs(work_dir + 'out/')
+        log_file = open(work_dir + script + '.log', 'w')
+        start = time.time()
+        subprocess.check_call([sys.executable, join(REPO_DIR, script), '-c', work_dir + 'detection.config', '-j', str(jobs)], cwd=work_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        seconds = time.time() - start
+        log_file.close()
+        name = script + ('[-j %d]' % jobs if jobs > 1 else '')
+        print "%-40s %6d %10.3f s" % (name, size, seconds)
+        results.append({'name': name, 'size': size, 'seconds': seconds})
+    return results
+
+def setup_work_dir(work_dir, size, settings=None, **synthetic_kwargs):
+    """Writes a synthetic field, its config and the SExtractor config files into work_dir.
+
+    """
+    synthetic.write_field(work_dir + 'data/', FIELD, BANDS, size, **synthetic_kwargs)
+    synthetic.write_config(work_dir + 'detection.config', work_dir, [FIELD], BANDS, make_bands=BANDS[-1:], **(settings or {}))
+    for fname in ('crude.sex', 'crude.param'):
+        shutil.copy(join(REPO_DIR, fname), work_dir)
+    if not exists(work_dir + 'out/'):
+        makedirs(work_dir + 'out/')
+
+def compare(results, previous, threshold=1.2):
+    """Prints the change in each timing since a previous run, marking slowdowns of more than threshold times.
+
+    """
+    old_times = dict(((result['name'], result['size']), result['seconds']) for result in previous['results'])
+    print "\nCompared with %s (commit %s):" % (previous['time'], previous['commit'])
+    for result in results:
+        old = old_times.get((result['name'], result['size']))
+        if old is None or old == 0:
+            continue
+        ratio = result['seconds'] / old
+        print "%-40s %6d %10.3f s -> %10.3f s  x%.2f%s" % (result['name'], result['size'], old, result['seconds'], ratio, '  SLOWER' if ratio > threshold else '')
+
+def last_result(results_fname):
+    if not exists(results_fname):
+        return None
+    lines = [line for line in open(results_fname) if line.strip()]
+    if not lines:
+        return None
+    return json.loads(lines[-1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks rms_norming on synthetic images.')
+    parser.add_argument('--sizes', default='512,1024,2048', help='comma separated image sizes in pixels')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each function, taking the best')
+    parser.add_argument('--block-rows', type=int, default=256, help='block_rows for the streamed variants')
+    parser.add_argument('--masked-fraction', type=float, default=0.05)
+    parser.add_argument('--source-density', type=float, default=1e-3)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='worker processes for the runners')
+    parser.add_argument('--store', action='store_true', help='run the runners with a store_dir (see store.py)')
+    parser.add_argument('--skip-runners', action='store_true', help="don't time the end-to-end runners")
+    parser.add_argument('--real-sextractor', action='store_true', help='use the sextractor on PATH instead of the stand-in')
+    parser.add_argument('--results', default=RESULTS_FNAME, help='file to append the results to (default %(default)s)')
+    parser.add_argument('--compare', action='store_true', help='compare with the last run in the results file')
+    parser.add_argument('--keep', action='store_true', help="keep the synthetic data and outputs")
+    args = parser.parse_args()
+
+    env = dict(environ)
+    env['PYTHONPATH'] = REPO_DIR + pathsep + env.get('PYTHONPATH', '')
+    if not args.real_sextractor:
+        # The stand-in runs on the same python as the benchmarks
+        env['PATH'] = BENCH_DIR + pathsep + dirname(sys.executable) + pathsep + env.get('PATH', '')
+        environ['PATH'] = env['PATH']
+
+    previous = last_result(args.results)
+    results = []
+    start_dir = getcwd()
+    for size in [int(size) for size in args.sizes.split(',')]:
+        work_dir = tempfile.mkdtemp(prefix='rms_bench_%d_' % size) + '/'
+        try:
+            settings = {'store_dir': work_dir + 'store/'} if args.store else {}
+            setup_work_dir(work_dir, size, settings, masked_fraction=args.masked_fraction, source_density=args.source_density)
+            # The SExtractor calls read crude.sex from the working directory
+            chdir(work_dir)
+            results += function_benchmarks(work_dir, size, repeat=args.repeat, block_rows=args.block_rows)
+            if not args.skip_runners:
+                results += runner_benchmarks(work_dir, size, env, jobs=args.jobs)
+        finally:
+            chdir(start_dir)
+            if args.keep:
+                print "Synthetic data and outputs kept in %s" % work_dir
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'commit': git_commit(),
+           'python': sys.version.split()[0],
+           'numpy': np.__version__,
+           'settings': {'repeat': args.repeat, 'block_rows': args.block_rows, 'masked_fraction': args.masked_fraction, 'source_density': args.source_density, 'jobs': args.jobs, 'real_sextractor': args.real_sextractor, 'store': args.store},
+           'results': results}
+    if dirname(args.results) and not exists(dirname(args.results)):
+        makedirs(dirname(args.results))
+    results_file = open(args.results, 'a')
+    results_file.write(json.dumps(run, sort_keys=True) + '\n')
+    results_file.close()
+    print "\nResults appended to %s" % args.results
+
+    if args.compare and previous is not None:
+        compare(results, previous)
@@ -0,0 +1,135 @@
+"""Generates synthetic science images and weight maps laid out like the z9 data, for benchmarking without real survey data.
+
+"""
+
+import numpy as np
+from astropy.io import fits
+from os import makedirs
+from os.path import exists
+
+def synthetic_pair(size, masked_fraction=0.05, source_density=1e-3, noise=1., seed=0):
+    """Makes a science image and weight map pair.
+
+    The weight map is flat apart from a masked border strip and a few masked rectangles, together covering roughly masked_fraction of the image. The science image is Gaussian noise matching the weights, plus Gaussian sources.
+
+    Parameters
+    ----------
+    size : int
+        Width and height of the images in pixels
+    masked_fraction : float
+        Fraction of pixels with zero weight
+    source_density : float
+        Number of sources per pixel
+    noise : float
+        RMS of the noise in the unmasked pixels
+    seed : int
+        Random seed
+
+    Returns
+    -------
+    sci_data, wht_data : numpy array
+
+    """
+    rng = np.random.RandomState(seed)
+    wht_data = np.full((size, size), 1. / noise**2, dtype=np.float32)
+
+    # A border like the edge of a drizzled mosaic, then rectangles until the masked fraction is reached
+    border = int(size * masked_fraction / 4.)
+    wht_data[:, :border] = 0
+    while np.mean(wht_data == 0) < masked_fraction:
+        height, width = rng.randint(size // 64 + 1, size // 8 + 2, 2)
+        row, col = rng.randint(0, size - height), rng.randint(0, size - width)
+        wht_data[row:row+height, col:col+width] = 0
+
+    sci_data = (rng.randn(size, size) * noise).astype(np.float32)
+    n_sources = rng.poisson(source_density * size**2)
+    y, x = np.mgrid[-10:11, -10:11]
+    for n in range(n_sources):
+        row, col = rng.randint(10, size - 10, 2)
+        sigma = rng.uniform(1., 3.)
+        sci_data[row-10:row+11, col-10:col+11] += rng.uniform(5., 100.) * noise * np.exp(-(x**2 + y**2) / (2 * sigma**2))
+    sci_data[wht_data == 0] = 0
+
+    return sci_data, wht_data
+
+def write_field(data_dir, field, bands, size, exptime=1000., extensions=0, **kwargs):
+    """Writes a synthetic field in the z9 layout that rms_config.full_filename_list_z9 expects.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory to put the field's directory in
+    field : str
+        Name of the field
+    bands : list
+        Bands to write images for, which need to be in rms_config.magzeros
+    size : int
+        Width and height of the images in pixels
+    exptime : float
+        Exposure time written to the science image headers
+    extensions : int
+        Set to write multi-extension images with this many chips, each size x size, after an empty primary HDU. 0 writes single images
+    kwargs
+        Passed on to synthetic_pair
+
+    """
+    field_dir = data_dir + 'borg_' + field + '/'
+    if not exists(field_dir):
+        makedirs(field_dir)
+    seed = kwargs.pop('seed', 0)
+    for n, band in enumerate(bands):
+        sci_fname = field_dir + 'borg_' + field + '_' + band + '_drz_sci.fits'
+        wht_fname = field_dir + 'borg_' + field + '_' + band + '_drz_wht.fits'
+        if extensions:
+            sci_hdus = [fits.PrimaryHDU()]
+            wht_hdus = [fits.PrimaryHDU()]
+            sci_hdus[0].header['EXPTIME'] = exptime
+            for chip in range(extensions):
+                sci_data, wht_data = synthetic_pair(size, seed=seed + n + 100 * (chip + 1), **kwargs)
+                sci_hdus.append(fits.ImageHDU(sci_data, name='SCI'))
+                wht_hdus.append(fits.ImageHDU(wht_data, name='WHT'))
+            fits.HDUList(sci_hdus).writeto(sci_fname, overwrite=True)
+            fits.HDUList(wht_hdus).writeto(wht_fname, overwrite=True)
+            continue
+        sci_data, wht_data = synthetic_pair(size, seed=seed + n, **kwargs)
+        sci_hdu = fits.PrimaryHDU(sci_data)
+        sci_hdu.header['EXPTIME'] = exptime
+        sci_hdu.writeto(sci_fname, overwrite=True)
+        fits.writeto(wht_fname, wht_data, overwrite=True)
+
+def write_config(config_fname, work_dir, fields, bands, make_bands=None, **settings):
+    """Writes a config file for a synthetic run, with every output directory inside work_dir.
+
+    Parameters
+    ----------
+    config_fname : str
+        Filename of the config file
+    work_dir : str
+        Directory the synthetic data and outputs live in
+    fields, bands : list
+        The fields and bands of the run
+    make_bands : list or None
+        Bands to make detection maps for
+    settings
+        Any other config entries, e.g. photometry='native'
+
+    """
+    field_list = work_dir + 'fields.list'
+    list_file = open(field_list, 'w')
+    list_file.write('\n'.join(fields) + '\n')
+    list_file.close()
+
+    entries = [('fields', field_list),
+               ('master_bands', ','.join(bands)),
+               ('make_bands', ','.join(make_bands or bands)),
+               ('wht_zero', '100'),
+               ('data_dir', work_dir + 'data/')]
+    for out_dir in ('bad_mask_dir', 'rms_crude_dir', 'cat_crude_dir', 'seg_crude_dir', 'rms_final_dir', 'fake_dir'):
+        entries.append((out_dir, work_dir + out_dir[:-4] + '/'))
+    entries.append(('flag_log', work_dir + 'run.flags'))
+    entries += sorted(settings.items())
+
+    config_file = open(config_fname, 'w')
+    for key, val in entries:
+        config_file.write('%s=%s\n' % (key, val))
+    config_file.close()
@@ -0,0 +1,159 @@
+"""A module for deciding whether a stage of the normalisation needs re-running.
+
+Each stage's outputs are stamped with a key made from everything the stage depends on: the identity of its input files, the config values it uses and the contents of any SExtractor config files. A stage is only re-run when its key has changed or its outputs have been touched since they were stamped.
+
+"""
+
+import hashlib
+import json
+from os import remove, rename, stat
+from os.path import abspath, exists
+import photometry
+
+def stamp_fname(outputs):
+    """Filename of the stamp recording the key a stage's outputs were made with.
+
+    """
+    return outputs[0] + '.stamp'
+
+def file_identity(fname, mode='stat'):
+    """Identifies the current version of a file.
+
+    Parameters
+    ----------
+    fname : str
+        Filename
+    mode : str 'stat' or 'checksum'
+        'stat' uses the path, size and modification time, which is fast. 'checksum' hashes the file contents, which survives files being copied or touched
+
+    Returns
+    -------
+    identity : str
+
+    """
+    if not exists(fname):
+        raise IOError("%s doesn't exist" % fname)
+    if mode == 'checksum':
+        sha = hashlib.sha1()
+        in_file = open(fname, 'rb')
+        for chunk in iter(lambda: in_file.read(1 << 20), b''):
+            sha.update(chunk)
+        in_file.close()
+        return sha.hexdigest()
+    file_stat = stat(fname)
+    return '%s:%d:%r' % (abspath(fname), file_stat.st_size, file_stat.st_mtime)
+
+def content_identity(fname):
+    """Identifies a small text file, like a SExtractor config, by its contents.
+
+    """
+    return file_identity(fname, mode='checksum')
+
+def sex_config_files(sex_fname='crude.sex'):
+    """Lists a SExtractor config file and the parameter and filter files it names, where they exist.
+
+    """
+    sex_config = photometry.read_sex_config(sex_fname)
+    config_files = [sex_fname]
+    for key in ('PARAMETERS_NAME', 'FILTER_NAME'):
+        if sex_config.get(key) and exists(sex_config[key][0]):
+            config_files.append(sex_config[key][0])
+    return config_files
+
+def stage_key(inputs, params=None, config_files=(), mode='stat'):
+    """Makes the key of a stage from everything its outputs depend on.
+
+    Parameters
+    ----------
+    inputs : list
+        Filenames of the input images and catalogs
+    params : dict or None
+        Config values the stage uses
+    config_files : list
+        Filenames of config files whose contents matter, e.g. from sex_config_files
+    mode : str 'stat' or 'checksum'
+        How to identify the input files, see file_identity
+
+    Returns
+    -------
+    key : str
+
+    """
+    sha = hashlib.sha1()
+    for fname in inputs:
+        sha.update(file_identity(fname, mode).encode('utf-8'))
+    for fname in config_files:
+        sha.update(content_identity(fname).encode('utf-8'))
+    sha.update(json.dumps(params or {}, sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
+def _output_identities(outputs):
+    return dict((fname, file_identity(fname)) for fname in outputs)
+
+def clear_stage(outputs):
+    """Removes a stage's outputs and stamp so it can be run again from scratch.
+
+    """
+    for fname in list(outputs) + [stamp_fname(outputs)]:
+        if exists(fname):
+            remove(fname)
+
+def keep_unstamped(outputs):
+    """Moves a stage's outputs that have no stamp aside, to <output>.unstamped, so the stage can be run again without losing them.
+
+    Outputs without a stamp may have been made before the stages were cached, by hand or by an earlier version of the package, so they're kept rather than removed. A stage interrupted before stamping its outputs leaves them unstamped too, and they're moved aside the same way.
+
+    """
+    for fname in outputs:
+        if exists(fname):
+            print "%s has no stamp, so it's out of date. Keeping it as %s.unstamped" % (fname, fname)
+            rename(fname, fname + '.unstamped')
+
+def check_stage(outputs, inputs, params=None, config_files=(), mode='stat'):
+    """Checks whether a stage's outputs are up to date, clearing them out if they aren't.
+
+    Outputs with no stamp at all aren't removed, only moved aside (see keep_unstamped).
+
+    Parameters
+    ----------
+    outputs : list
+        Filenames of the stage's outputs
+    inputs, params, config_files, mode
+        As for stage_key
+
+    Returns
+    -------
+    up_to_date : bool
+        True if the outputs were made from the same inputs and haven't changed since
+    key : str
+        The stage's current key, to pass to mark_stage once the stage has been run
+
+    """
+    key = stage_key(inputs, params, config_files, mode)
+    if not exists(stamp_fname(outputs)):
+        keep_unstamped(outputs)
+        return False, key
+    try:
+        stamp_file = open(stamp_fname(outputs))
+        stamp = json.load(stamp_file)
+        stamp_file.close()
+        if stamp['key'] == key and stamp['outputs'] == _output_identities(outputs):
+            return True, key
+    except (IOError, ValueError, KeyError):
+        pass
+
+    clear_stage(outputs)
+    return False, key
+
+def mark_stage(outputs, key):
+    """Stamps a stage's freshly made outputs with its key.
+
+    The stamp is written last and moved into place in one step, so an interrupted stage is never mistaken for a finished one.
+
+    """
+    stamp = {'key': key, 'outputs': _output_identities(outputs)}
+    tmp_fname = stamp_fname(outputs) + '.tmp'
+    stamp_file = open(tmp_fname, 'w')
+    json.dump(stamp, stamp_file, sort_keys=True)
+    stamp_file.close()
+    rename(tmp_fname, stamp_fname(outputs))
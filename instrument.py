@@ -0,0 +1,140 @@
+"""A module for measuring how long each stage of the normalisation takes and what it costs, and writing that out as a run report.
+
+"""
+
+import csv
+import json
+import resource
+import time
+from contextlib import contextmanager
+
+REPORT_COLUMNS = ['field', 'band', 'ext', 'stage', 'wall_s', 'cpu_s', 'subprocess_s', 'peak_rss_kb', 'subprocess_peak_rss_kb', 'read_bytes', 'write_bytes',
+                  'subprocess_read_bytes', 'subprocess_write_bytes', 'norm_constant', 'norm_ci_low', 'norm_ci_high', 'flags']
+
+def _proc_io():
+    """Reads the bytes this process has read from and written to storage so far from /proc, or None where that isn't available.
+
+    These count the pages of memory mapped images read in as well as ordinary reads, along with the I/O of the subprocesses it has waited for, such as SExtractor. Reads served from the page cache aren't counted.
+
+    """
+    try:
+        io_file = open('/proc/self/io')
+        io_counts = dict(line.split(':') for line in io_file)
+        io_file.close()
+        return int(io_counts['read_bytes']), int(io_counts['write_bytes'])
+    except (IOError, KeyError, ValueError):
+        return None, None
+
+def _reset_peak_rss():
+    """Resets the peak resident memory of this process to what it's using now, so the peak of each stage can be read off on its own. Returns False where that isn't possible (Linux before 4.0, or no /proc).
+
+    """
+    try:
+        refs_file = open('/proc/self/clear_refs', 'w')
+        refs_file.write('5')
+        refs_file.close()
+        return True
+    except IOError:
+        return False
+
+def _peak_rss_kb():
+    """Reads the peak resident memory of this process in KB from /proc, or None where that isn't available.
+
+    """
+    try:
+        status_file = open('/proc/self/status')
+        for line in status_file:
+            if line.startswith('VmHWM:'):
+                status_file.close()
+                return int(line.split()[1])
+        status_file.close()
+    except (IOError, ValueError):
+        pass
+    return None
+
+def _usage():
+    """Takes a snapshot of the resources used by this process and its finished subprocesses.
+
+    """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = _proc_io()
+    return {'wall': time.time(),
+            'cpu': self_usage.ru_utime + self_usage.ru_stime,
+            'subprocess': child_usage.ru_utime + child_usage.ru_stime,
+            'subprocess_peak_rss_kb': child_usage.ru_maxrss,
+            'read_bytes': read_bytes,
+            'write_bytes': write_bytes,
+            # Counted in 512 byte blocks
+            'subprocess_read_bytes': 512 * child_usage.ru_inblock,
+            'subprocess_write_bytes': 512 * child_usage.ru_oublock}
+
+def new_report(field, band, ext=None):
+    """Starts the report of one field and band, or of one extension of it for multi-extension images.
+
+    """
+    return {'field': field, 'band': band, 'ext': ext, 'stages': [], 'norm_constant': None, 'norm_constant_ci': None, 'noise_curve': None, 'realisations': None, 'flags': ''}
+
+@contextmanager
+def stage(report, name):
+    """Records the wall time, CPU time, subprocess time, peak memory and I/O of the code run inside it as a stage of a report.
+
+    peak_rss_kb is the peak memory of the stage itself: the process's high water mark is reset as the stage starts, where Linux allows it, so stages mustn't be nested. Otherwise it's None, as the high water mark of the whole process says nothing about the stage. subprocess_peak_rss_kb is the high water mark of the largest subprocess so far by the end of the stage, as that's all the OS keeps track of. read_bytes and write_bytes are the storage I/O of the stage (see _proc_io), including that of its subprocesses, which is also given on its own as subprocess_read_bytes and subprocess_write_bytes.
+
+    Parameters
+    ----------
+    report : dict
+        Report from new_report to add the stage to
+    name : str
+        Name of the stage
+
+    """
+    peak_reset = _reset_peak_rss()
+    start = _usage()
+    try:
+        yield
+    finally:
+        end = _usage()
+        stage_usage = {'stage': name,
+                       'wall_s': end['wall'] - start['wall'],
+                       'cpu_s': end['cpu'] - start['cpu'],
+                       'subprocess_s': end['subprocess'] - start['subprocess'],
+                       'peak_rss_kb': _peak_rss_kb() if peak_reset else None,
+                       'subprocess_peak_rss_kb': end['subprocess_peak_rss_kb'],
+                       'read_bytes': None,
+                       'write_bytes': None,
+                       'subprocess_read_bytes': end['subprocess_read_bytes'] - start['subprocess_read_bytes'],
+                       'subprocess_write_bytes': end['subprocess_write_bytes'] - start['subprocess_write_bytes']}
+        if start['read_bytes'] is not None:
+            stage_usage['read_bytes'] = end['read_bytes'] - start['read_bytes']
+            stage_usage['write_bytes'] = end['write_bytes'] - start['write_bytes']
+        report['stages'].append(stage_usage)
+
+def write_report(reports, json_fname=None, csv_fname=None):
+    """Writes the reports of a run as JSON, with one entry per field/band, and/or CSV, with one row per stage.
+
+    Parameters
+    ----------
+    reports : list
+        Reports from new_report
+    json_fname, csv_fname : str or None
+        Output filenames. Either format is skipped if its filename is None
+
+    """
+    if json_fname is not None:
+        json_file = open(json_fname, 'w')
+        json.dump(reports, json_file, indent=1, sort_keys=True)
+        json_file.close()
+
+    if csv_fname is not None:
+        csv_file = open(csv_fname, 'wb')
+        writer = csv.DictWriter(csv_file, REPORT_COLUMNS)
+        writer.writeheader()
+        for report in reports:
+            for stage_usage in report['stages']:
+                row = dict(stage_usage)
+                row.update(field=report['field'], band=report['band'], ext=report.get('ext'), norm_constant=report['norm_constant'], flags=report['flags'].strip())
+                if report.get('norm_constant_ci') is not None:
+                    row.update(norm_ci_low=report['norm_constant_ci'][0], norm_ci_high=report['norm_constant_ci'][1])
+                writer.writerow(row)
+        csv_file.close()
@@ -0,0 +1,126 @@
+"""A module for multi-extension FITS (MEF) inputs, with one chip per image extension.
+
+Each image extension of a field and band is processed as a task of its own (see pipeline.band_tasks), reading its extension straight out of the input files. The per-extension outputs are single image files, and the normalised RMS maps are put back together into one MEF matching the input at the end of the run.
+
+"""
+
+from astropy.io import fits
+from os.path import splitext
+
+def image_extensions(fname):
+    """Lists the HDUs of a FITS file that hold 2D images.
+
+    Only the headers are read.
+
+    Parameters
+    ----------
+    fname : str
+        Filename of the FITS file
+
+    Returns
+    -------
+    extensions : list
+        Indices of the image HDUs, [0] for a single image file
+
+    """
+    hdu_list = fits.open(fname, memmap=True, ignore_missing_end=True)
+    extensions = [n for n, hdu in enumerate(hdu_list) if hdu.is_image and hdu.header.get('NAXIS') == 2]
+    hdu_list.close()
+    return extensions
+
+def is_mef(extensions):
+    """Whether a list of image extensions from image_extensions needs splitting into per-extension tasks.
+
+    """
+    return extensions != [0]
+
+def ext_fname(fname, ext):
+    """Filename of the output of one extension, e.g. rms.fits -> rms_ext2.fits.
+
+    """
+    root, suffix = splitext(fname)
+    return '%s_ext%d%s' % (root, ext, suffix)
+
+def primary_header(header):
+    """Copies the header of an image HDU for writing the image to a file of its own, turning an extension header into a primary one.
+
+    """
+    header = header.copy()
+    if 'XTENSION' in header:
+        del header['XTENSION']
+        header.insert(0, ('SIMPLE', True, 'conforms to FITS standard'))
+        header.remove('PCOUNT', ignore_missing=True)
+        header.remove('GCOUNT', ignore_missing=True)
+    return header
+
+def write_mef(ext_fnames, template_fname, out_fname, keywords=None):
+    """Puts single image files back together into a MEF laid out like the input it was made from.
+
+    The primary header and any HDUs that aren't in ext_fnames are copied from the template, so the output has the same extension numbers. Each image is read through a memory map.
+
+    Parameters
+    ----------
+    ext_fnames : dict
+        Filename of the single image file for each extension, by HDU index
+    template_fname : str
+        The input MEF, e.g. the weight map
+    out_fname : str
+        Filename of the output MEF
+    keywords : dict or None
+        Header keywords to add to each extension, by HDU index, as {ext: [(key, value, comment), ...]}
+
+    """
+    template = fits.open(template_fname, memmap=True, ignore_missing_end=True)
+    ext_lists = []
+    out_hdus = []
+    try:
+        for n, hdu in enumerate(template):
+            if n not in ext_fnames:
+                if n == 0:
+                    out_hdus.append(fits.PrimaryHDU(header=hdu.header.copy()))
+                else:
+                    out_hdus.append(hdu.copy())
+                continue
+            ext_list = fits.open(ext_fnames[n], memmap=True, ignore_missing_end=True)
+            ext_lists.append(ext_list)
+            header = hdu.header.copy()
+            header.remove('BSCALE', ignore_missing=True)
+            header.remove('BZERO', ignore_missing=True)
+            for key, value, comment in (keywords or {}).get(n, []):
+                header[key] = (value, comment)
+            data = ext_list[0].data
+            if n == 0:
+                out_hdus.append(fits.PrimaryHDU(data, header=header))
+            else:
+                out_hdus.append(fits.ImageHDU(data, header=header))
+        fits.HDUList(out_hdus).writeto(out_fname, overwrite=True)
+    finally:
+        for ext_list in ext_lists:
+            ext_list.close()
+        template.close()
+
+def write_mask_mef(ext_masks, template_fname, out_fname, header_cards=()):
+    """Writes the bad pixel mask of each extension of a field as a MEF with the same extension numbers as its weight maps.
+
+    Parameters
+    ----------
+    ext_masks : dict
+        Mask of each extension, by HDU index
+    template_fname : str
+        One of the field's weight maps, for the layout of the extensions
+    out_fname : str
+        Filename of the output MEF
+    header_cards : list
+        (key, value, comment) cards to add to every mask extension, e.g. the MASKBn band labels
+
+    """
+    template = fits.open(template_fname, memmap=True, ignore_missing_end=True)
+    n_hdus = len(template)
+    template.close()
+    out_hdus = [fits.PrimaryHDU(ext_masks.get(0))]
+    for n in range(1, n_hdus):
+        out_hdus.append(fits.ImageHDU(ext_masks.get(n)))
+    for n in ext_masks:
+        for key, value, comment in header_cards:
+            out_hdus[n].header[key] = (value, comment)
+    fits.HDUList(out_hdus).writeto(out_fname)
@@ -2,11 +2,23 @@
 
 """
 
+import warnings
 import numpy as np
 from astropy.io import fits
-from subprocess import check_call
-import pandas as pd
-import matplotlib.pyplot as plt
+from astropy.io.fits.hdu.base import DTYPE2BITPIX
+from os import remove, rename
+from os.path import exists
+from rms_tools import pipe_sextractor, row_blocks, run_sextractor
+import photometry
+import sex_profiles
+import store
+
+# Aperture (1-indexed, of PHOT_APERTURES in crude.sex) the norm constant is measured in by default, 8 pixels across
+NORM_APERTURE = 4
+
+# SExtractor parameters written as integers. Every other catalog column is read as float
+INT_PARAMETERS = ('NUMBER', 'EXT_NUMBER', 'ISOAREA_IMAGE', 'ISOAREAF_IMAGE', 'XMIN_IMAGE', 'XMAX_IMAGE', 'YMIN_IMAGE', 'YMAX_IMAGE', 'XPEAK_IMAGE', 'YPEAK_IMAGE',
+                  'ISO0', 'ISO1', 'ISO2', 'ISO3', 'ISO4', 'ISO5', 'ISO6', 'ISO7', 'NITER_WIN', 'NITER_MODEL', 'NITER_PSF', 'NLOWWEIGHT_ISO', 'NLOWDWEIGHT_ISO')
 
 def gest(r):
     """A simple Gaussian estimate to model the light profile of the false sources we'll create
@@ -26,7 +38,260 @@ def inrad(x0, y0, r):
                 points.append((y,x))
     return points
 
-def false_sources(field_band_dict, no_sources=100):
+def gaussian_stamp(r=12, peak=30):
+    """Makes a stamp of the false source light profile out to radius r.
+
+    Returns
+    -------
+    stamp : numpy array
+        (2r+1, 2r+1) array of the profile, peak * gest(distance from the centre)
+    disk : numpy array
+        Boolean array of the stamp pixels within radius r of the centre
+
+    """
+    dy, dx = np.mgrid[-r:r+1, -r:r+1]
+    dist = np.sqrt(dx**2 + dy**2)
+    return peak * gest(dist), dist <= r
+
+def paint_sources(image, x_seg, y_seg, stamp, disk, row_offset=0):
+    """Paints a stamp onto an image at each of a set of positions, clipping at the image edges.
+
+    Parameters
+    ----------
+    image : numpy array
+        Image, or strip of rows of an image, to paint onto in place
+    x_seg, y_seg : array
+        1-indexed pixel coordinates of the stamp centres in the full image
+    stamp, disk : numpy array
+        The stamp and the boolean map of its pixels to paint, as from gaussian_stamp
+    row_offset : int
+        Row of the full image that the first row of image corresponds to
+
+    """
+    r = stamp.shape[0] // 2
+    n_rows, n_cols = image.shape
+    for x0, y0 in zip(x_seg, y_seg):
+        row0 = y0 - 1 - r - row_offset
+        col0 = x0 - 1 - r
+        row_lo, row_hi = max(row0, 0), min(row0 + 2*r + 1, n_rows)
+        col_lo, col_hi = max(col0, 0), min(col0 + 2*r + 1, n_cols)
+        if row_lo >= row_hi or col_lo >= col_hi:
+            continue
+        sub_disk = disk[row_lo-row0:row_hi-row0, col_lo-col0:col_hi-col0]
+        sub_stamp = stamp[row_lo-row0:row_hi-row0, col_lo-col0:col_hi-col0]
+        image[row_lo:row_hi, col_lo:col_hi][sub_disk] = sub_stamp[sub_disk]
+    return image
+
+def false_strips(shape, x_seg, y_seg, dtype=np.float64, block_rows=1024):
+    """Generates a false source image a strip of rows at a time.
+
+    Each strip is the background noise with the sources overlapping it painted on, so the whole image never has to be held in memory.
+
+    Yields
+    ------
+    start, stop : int
+        Row bounds of the strip
+    strip : numpy array
+        The strip of the false image
+
+    """
+    stamp, disk = gaussian_stamp()
+    for start, stop in row_blocks(shape[0], block_rows):
+        strip = (np.random.randn(stop - start, shape[1]) / 1000).astype(dtype)
+        paint_sources(strip, x_seg, y_seg, stamp, disk, row_offset=start)
+        yield start, stop, strip
+
+def dilate_disk(bad, r):
+    """Marks every pixel lying within radius r of a True pixel in a boolean map.
+
+    The disk is built from horizontal runs, one per row offset, so the map is shifted a few times rather than once per pixel of the disk.
+
+    """
+    n_rows = bad.shape[0]
+    runs = {0: bad}
+    out = np.zeros(bad.shape, dtype=bool)
+    for dy in range(-r, r+1):
+        w = int(np.floor(np.sqrt(r**2 - dy**2)))
+        # Grow the horizontal run for this half-width from the narrower ones
+        for half in range(max(runs) + 1, w + 1):
+            run = runs[half-1].copy()
+            run[:, half:] |= bad[:, :-half]
+            run[:, :-half] |= bad[:, half:]
+            runs[half] = run
+        if dy >= 0:
+            out[:n_rows-dy] |= runs[w][dy:]
+        else:
+            out[-dy:] |= runs[w][:n_rows+dy]
+    return out
+
+def allowed_centres(wht_data, seg_data, r=4, block_rows=1024):
+    """Finds the pixels a false source can be centred on.
+
+    A pixel is allowed when the disk of radius r around it lies inside the image and contains no zero weight pixels and no pixels belonging to a segmented object. The maps are dilated a strip of rows at a time, with r rows either side for the disk to reach into, so only the boolean map of allowed centres is held in memory at full size.
+
+    Parameters
+    ----------
+    wht_data, seg_data : numpy array
+        The weight map and segmentation map of the image, ideally memory mapped
+    r : int
+        Exclusion radius in pixels
+    block_rows : int
+        Number of image rows per strip
+
+    Returns
+    -------
+    allowed : numpy array
+        Boolean map of the allowed centres
+
+    """
+    n_rows = wht_data.shape[0]
+    allowed = np.empty(wht_data.shape, dtype=bool)
+    for start, stop in row_blocks(n_rows, block_rows):
+        lo, hi = max(start - r, 0), min(stop + r, n_rows)
+        bad = (np.asarray(wht_data[lo:hi]) == 0) | (np.asarray(seg_data[lo:hi]) != 0)
+        allowed[start:stop] = ~dilate_disk(bad, r)[start-lo:stop-lo]
+    n_cols = allowed.shape[1]
+    allowed[:r] = False
+    allowed[n_rows-r:] = False
+    allowed[:, :r] = False
+    allowed[:, n_cols-r:] = False
+    return allowed
+
+def place_sources(allowed, no_sources, fname=''):
+    """Draws distinct random false source positions from a map of allowed centres.
+
+    Parameters
+    ----------
+    allowed : numpy array
+        Boolean map of allowed centres, as from allowed_centres
+    no_sources : int
+        Number of positions to draw
+    fname : str
+        Name of the image, used in the error message
+
+    Returns
+    -------
+    x_seg, y_seg : numpy array
+        1-indexed pixel coordinates of the sources
+
+    Raises
+    ------
+    ValueError
+        If there are fewer allowed centres than sources
+
+    """
+    row_counts = np.count_nonzero(allowed, axis=1)
+    row_ends = np.cumsum(row_counts)
+    n_allowed = row_ends[-1]
+    if n_allowed < no_sources:
+        raise ValueError("Only %d allowed false source centres in %s, %d needed" % (n_allowed, fname, no_sources))
+
+    # Draw ranks among the allowed pixels, topping up until they're all distinct
+    if 2 * no_sources > n_allowed:
+        ranks = np.random.permutation(n_allowed)[:no_sources]
+    else:
+        ranks = np.unique(np.random.randint(0, n_allowed, no_sources))
+    while len(ranks) < no_sources:
+        extra = np.random.randint(0, n_allowed, no_sources - len(ranks))
+        ranks = np.unique(np.concatenate((ranks, extra)))
+    np.random.shuffle(ranks)
+
+    rows = np.searchsorted(row_ends, ranks, side='right')
+    cols = np.empty_like(rows)
+    for n in range(len(ranks)):
+        row_rank = ranks[n] - (row_ends[rows[n]] - row_counts[rows[n]])
+        cols[n] = np.flatnonzero(allowed[rows[n]])[row_rank]
+
+    return cols + 1, rows + 1
+
+def place_separated_sources(allowed, no_sources, min_sep, fname='', max_rounds=50):
+    """Draws random false source positions from a map of allowed centres, keeping every pair of sources at least min_sep pixels apart.
+
+    Candidates are drawn with place_sources and accepted in turn if they're far enough from those already accepted, with more drawn until there are enough.
+
+    Parameters
+    ----------
+    allowed : numpy array
+        Boolean map of allowed centres, as from allowed_centres
+    no_sources : int
+        Number of positions to draw
+    min_sep : float
+        Smallest distance between two sources in pixels
+    fname : str
+        Name of the image, used in the error message
+    max_rounds : int
+        Number of rounds of candidates to draw before giving up
+
+    Returns
+    -------
+    x_seg, y_seg : numpy array
+        1-indexed pixel coordinates of the sources
+
+    Raises
+    ------
+    ValueError
+        If no_sources separated positions can't be found
+
+    """
+    n_allowed = np.count_nonzero(allowed)
+    x_seg = np.zeros(no_sources, dtype=int)
+    y_seg = np.zeros(no_sources, dtype=int)
+    n_placed = 0
+    for n in range(max_rounds):
+        x_cand, y_cand = place_sources(allowed, min(2 * (no_sources - n_placed), n_allowed), fname=fname)
+        for x0, y0 in zip(x_cand, y_cand):
+            if n_placed == 0 or np.min((x_seg[:n_placed] - x0)**2 + (y_seg[:n_placed] - y0)**2) >= min_sep**2:
+                x_seg[n_placed] = x0
+                y_seg[n_placed] = y0
+                n_placed += 1
+                if n_placed == no_sources:
+                    return x_seg, y_seg
+    raise ValueError("Only found room for %d false sources %g pixels apart in %s, %d needed" % (n_placed, min_sep, fname, no_sources))
+
+def write_false_image(fname, shape, x_seg, y_seg, dtype=np.float64, block_rows=None):
+    """Writes out the false source image of a set of positions.
+
+    Parameters
+    ----------
+    fname : str
+        Filename of the false source image, which mustn't exist yet
+    shape : tuple
+        Shape of the image (rows, columns)
+    x_seg, y_seg : numpy array
+        1-indexed pixel coordinates of the sources
+    dtype : numpy dtype or str
+        Data type of the image
+    block_rows : int or None
+        If given, make the image in strips of this many rows and write each strip out as it's made instead of building the whole image in memory
+
+    """
+    dtype = np.dtype(dtype)
+    if block_rows:
+        if exists(fname):
+            raise IOError("%s already exists." % fname)
+        header = fits.Header()
+        header['SIMPLE'] = True
+        header['BITPIX'] = DTYPE2BITPIX[dtype.name]
+        header['NAXIS'] = 2
+        header['NAXIS1'] = shape[1]
+        header['NAXIS2'] = shape[0]
+        false_hdu = fits.StreamingHDU(fname, header)
+        try:
+            for start, stop, strip in false_strips(shape, x_seg, y_seg, dtype=dtype, block_rows=block_rows):
+                false_hdu.write(strip)
+        except Exception:
+            # Don't leave a truncated image behind to be mistaken for a finished one
+            false_hdu.close()
+            remove(fname)
+            raise
+        false_hdu.close()
+    else:
+        falsedata = np.empty(shape, dtype=dtype)
+        for start, stop, strip in false_strips(shape, x_seg, y_seg, dtype=dtype):
+            falsedata[start:stop] = strip
+        fits.writeto(fname, falsedata)
+
+def false_sources(field_band_dict, no_sources=100, dtype=np.float64, block_rows=None, realisations=1, separate=None, exclude=None):
     """Generates .fits file containing false sources in empty regions of the image.
 
     This enables analysis of the background noise level of an image if SExtractor is used to detect in this false image, but then do photometry in the original science image.
@@ -34,74 +299,87 @@ def false_sources(field_band_dict, no_sources=100):
     Parameters
     ----------
     field_band_dict : dict
-        Dict containing the necessary filenames.
+        Dict containing the necessary filenames, and the field's store directory under 'store' if it has one
+    no_sources : int
+        Number of false sources to place
+    dtype : numpy dtype or str
+        Data type of the false image. float32 halves its size on disk
+    block_rows : int or None
+        If given, generate the image in strips of this many rows and write each strip out as it's made instead of building the whole image in memory
+    realisations : int
+        Number of independent placements of no_sources false sources to render into the one image
+    separate : bool or None
+        Set True to keep the sources far enough apart for SExtractor to detect each one separately, which matters once there are many of them. Defaults to True for more than one realisation
+    exclude : tuple or None
+        1-indexed (x, y) coordinates of false sources already placed, e.g. from read_false_positions, to keep the new ones off them, or with separate apart from them
 
     Returns
     -------
     FITS file conataining false sources
+    x_seg, y_seg : numpy array
+        1-indexed pixel coordinates of the sources, also saved to field_band_dict['false_pos'] if it's given, along with the realisation each source belongs to
+
+    Raises
+    ------
+    ValueError
+        If the image doesn't have room for no_sources false sources
     """
     ############################
     ##### Load in the data #####
     ############################
-    hdu_list_wht = fits.open(field_band_dict['wht'], ignore_missing_end=True)
-    wht_data = hdu_list_wht[0].data
-    hdu_list_wht.close()
+    # The weight and segmentation maps are memory mapped (through the field's store if it has one) so only the pixels we test are read
+    wht_data = store.image_data(field_band_dict['wht'], field_band_dict.get('store'), field_band_dict.get('ext', 0))
 
-    hdu_list = fits.open(field_band_dict['sci'], ignore_missing_end=True)
-    sci_data = hdu_list[0].data
-    hdu_list.close()
+    # Only the shape of the science image is needed
+    sci_header = fits.getheader(field_band_dict['sci'], ext=field_band_dict.get('ext', 0), ignore_missing_end=True)
 
-    hdu_list_seg = fits.open(field_band_dict['segmap'], ignore_missing_end=True)
-    seg_data = hdu_list_seg[0].data
-    hdu_list_seg.close()
+    seg_data = store.image_data(field_band_dict['segmap'], field_band_dict.get('store'))
     ############################
 
     # x and y bounds
-    xmax = sci_data.shape[1]
-    ymax = sci_data.shape[0]
-
-    x_seg = []
-    y_seg = []
-
-    # Pick our random points
-    Npoints = no_sources
-    break_point = 0
-    while len(x_seg) < Npoints:
-        new_x = np.random.randint(0,xmax)
-        new_y = np.random.randint(0,ymax)
-        region = inrad(new_x-1, new_y-1,4)
-        q_append = True
-        for point in region:
-            try:
-                if wht_data[point] == 0:
-                    q_append = False
-            except IndexError:
-                q_append = False
-        if q_append:
-            objcount = 0
-            for point in region:
-                objcount += seg_data[point]
-            if objcount == 0:
-                x_seg.append(new_x)
-                y_seg.append(new_y)
-        p_count = len(x_seg)
-        break_point += 1
-        if break_point >= 1000000:
-            print "ERROR: Random placements unable to generate enough false sources for %s" % field_band_dict['sci']
-            p_count = N_points
-
-    falsedata = np.random.randn(sci_data.shape[0],sci_data.shape[1]) / 1000
-
-    for n in range(len(x_seg)):
-        f_pixs = inrad(x_seg[n]-1,y_seg[n]-1, 12)
-        for pixel in f_pixs:
-            try:
-                falsedata[pixel] = 30 * gest(np.sqrt((x_seg[n]-1-pixel[1])**2+(y_seg[n]-1-pixel[0])**2))
-            except IndexError:
-                pass
+    xmax = sci_header['NAXIS1']
+    ymax = sci_header['NAXIS2']
+
+    # Pick our random points from the pixels with nothing nearby
+    allowed = allowed_centres(wht_data, seg_data)
+    if separate is None:
+        separate = realisations > 1
+    # Two stamps' radius apart, so neighbouring false sources don't blend
+    min_sep = 2 * (gaussian_stamp()[0].shape[0] // 2) + 1
+    if exclude is not None:
+        half = min_sep - 1 if separate else 0
+        for x0, y0 in zip(*exclude):
+            allowed[max(y0 - 1 - half, 0):y0 + half, max(x0 - 1 - half, 0):x0 + half] = False
+    if separate:
+        x_seg, y_seg = place_separated_sources(allowed, realisations * no_sources, min_sep, fname=field_band_dict['sci'])
+    else:
+        # Each realisation drawn on its own, so they may overlap one another
+        placements = [place_sources(allowed, no_sources, fname=field_band_dict['sci']) for k in range(realisations)]
+        x_seg = np.concatenate([x_k for x_k, y_k in placements])
+        y_seg = np.concatenate([y_k for x_k, y_k in placements])
 
     print "%d false sources generated" % len(x_seg)
-    fits.writeto(field_band_dict['false_img'], falsedata)
+    if 'false_pos' in field_band_dict:
+        np.savetxt(field_band_dict['false_pos'], np.column_stack((x_seg, y_seg, np.arange(len(x_seg)) // no_sources)), fmt='%d')
+    write_false_image(field_band_dict['false_img'], (ymax, xmax), x_seg, y_seg, dtype=dtype, block_rows=block_rows)
+
+    return x_seg, y_seg
+
+def read_false_positions(field_band_dict):
+    """Reads back the false source positions saved by false_sources.
+
+    Returns
+    -------
+    x_seg, y_seg : numpy array
+        1-indexed pixel coordinates of the sources
+    realisation : numpy array
+        The placement each source belongs to
+
+    """
+    positions = np.loadtxt(field_band_dict['false_pos'], dtype=int, ndmin=2)
+    if positions.shape[1] < 3:
+        return positions[:, 0], positions[:, 1], np.zeros(len(positions), dtype=int)
+    return positions[:, 0], positions[:, 1], positions[:, 2]
 
 def rm_empty(q_list):
     """Removes empty entries from a list.
@@ -176,25 +454,262 @@ def get_catalog(fname):
             # Add the new data line to the output
             object_data[int(data_line[0])] = data_line[1:]
 
+    # pandas is only needed here, so it isn't imported with the module
+    import pandas as pd
     final_data = pd.DataFrame(object_data, index=header)
 
     return final_data
 
-def false_SExtract(field_band_dict):
+def is_int_parameter(name):
+    """Checks whether a SExtractor parameter is written as an integer, from its name. The flags all are, e.g. FLAGS, IMAFLAGS_ISO and FLAGS_WIN.
+
+    """
+    return name in INT_PARAMETERS or 'FLAGS' in name
+
+def param_widths(param_fname):
+    """Reads the number of values of each vector parameter out of a SExtractor parameter file, e.g. 5 for FLUX_APER(5).
+
+    """
+    widths = {}
+    param_file = open(param_fname)
+    for param_line in param_file:
+        param = param_line.split('#')[0].strip()
+        if param.endswith(')'):
+            name, width = param[:-1].split('(')
+            widths[name.strip()] = int(width)
+    param_file.close()
+    return widths
+
+def catalog_dtype(names, widths):
+    """Builds the structured dtype of a catalog, expanding vector parameters into numbered sub-columns.
+
+    Parameters
+    ----------
+    names : list
+        Names of the catalog parameters
+    widths : list
+        Number of values of each parameter, e.g. 5 for FLUX_APER(5)
+
+    Returns
+    -------
+    dtype : numpy dtype
+        int64 for the parameters SExtractor writes as integers (see is_int_parameter), float64 for the rest
+
+    """
+    fields = []
+    for name, width in zip(names, widths):
+        col_type = np.int64 if is_int_parameter(name) else np.float64
+        if width == 1:
+            fields.append((name, col_type))
+        else:
+            fields.extend(('%s_%d' % (name, n+1), col_type) for n in range(width))
+    return np.dtype(fields)
+
+def parse_ascii_catalog(cat_lines, chunk_lines=10000, param_fname=None):
+    """Parses the lines of an ASCII_HEAD SExtractor catalog in one pass, as they come.
+
+    The rows are converted to numbers chunk_lines at a time, so the catalog can be read straight from SExtractor's output (see rms_tools.pipe_sextractor) without ever holding all of its text.
+
+    The header gives the first column of each parameter, so the width of each vector parameter is the gap to the next one. The last parameter has no next one, so its width comes from the length of a row, or for a catalog with no rows from the parameter file of the run, if it is given and still there.
+
+    Parameters
+    ----------
+    cat_lines : iterable
+        Lines of the catalog, e.g. an open file
+    chunk_lines : int
+        Number of rows to convert at once
+    param_fname : str or None
+        SExtractor parameter file the catalog was made with
+
+    Returns
+    -------
+    cat : numpy array
+        The catalog, as from read_catalog
+
+    """
+    names = []
+    starts = []
+    n_cols = None
+    chunks = []
+    data_lines = []
+    for cat_line in cat_lines:
+        if cat_line[0] == '#':
+            head_line = cat_line.split()
+            starts.append(int(head_line[1]))
+            names.append(head_line[2])
+        elif cat_line.strip():
+            if n_cols is None:
+                n_cols = len(cat_line.split())
+            data_lines.append(cat_line)
+            if len(data_lines) >= chunk_lines:
+                chunks.append(np.array(''.join(data_lines).split(), dtype=np.float64))
+                data_lines = []
+    chunks.append(np.array(''.join(data_lines).split(), dtype=np.float64))
+
+    if not names:
+        raise ValueError("Catalog has no ASCII_HEAD header")
+    if n_cols is None:
+        last_width = param_widths(param_fname).get(names[-1], 1) if param_fname is not None and exists(param_fname) else 1
+        n_cols = starts[-1] + last_width - 1
+    widths = [stop - start for start, stop in zip(starts, starts[1:] + [n_cols + 1])]
+
+    dtype = catalog_dtype(names, widths)
+    values = np.concatenate(chunks).reshape(-1, n_cols)
+    cat = np.empty(len(values), dtype=dtype)
+    for col, name in enumerate(dtype.names):
+        cat[name] = values[:, col]
+    return cat
+
+def write_ascii_catalog(cat, fname):
+    """Writes a catalog as from read_catalog out as an ASCII_HEAD SExtractor catalog, with the numbered sub-columns of vector parameters put back together.
+
+    """
+    header = []
+    col = 1
+    last_base = None
+    for name in cat.dtype.names:
+        base, _, number = name.rpartition('_')
+        if number.isdigit() and base == last_base:
+            col += 1
+            continue
+        last_base = base if number == '1' else None
+        header.append('#%4d %s\n' % (col, base if number == '1' and base + '_2' in cat.dtype.names else name))
+        col += 1
+
+    fmts = ['%d' if cat.dtype[name].kind in 'iu' else '%#.10g' for name in cat.dtype.names]
+    tmp_fname = fname + '.tmp'
+    out_file = open(tmp_fname, 'w')
+    out_file.write(''.join(header))
+    if len(cat):
+        np.savetxt(out_file, np.column_stack([cat[name] for name in cat.dtype.names]).astype(object), fmt=fmts)
+    out_file.close()
+    rename(tmp_fname, fname)
+
+def _read_ascii_catalog(fname, param_fname=None):
+    """Reads an ASCII_HEAD SExtractor catalog in one pass.
+
+    """
+    cat_file = open(fname)
+    try:
+        return parse_ascii_catalog(cat_file, param_fname=param_fname)
+    finally:
+        cat_file.close()
+
+def _tee_lines(cat_lines, fname):
+    """Passes lines on while writing them to a file, which is only moved into place once they're all written.
+
+    """
+    tmp_fname = fname + '.tmp'
+    out_file = open(tmp_fname, 'w')
+    try:
+        for cat_line in cat_lines:
+            out_file.write(cat_line)
+            yield cat_line
+    finally:
+        out_file.close()
+    rename(tmp_fname, fname)
+
+def piped_catalog(sex_args, log_fname=None, keep_fname=None, param_fname=None):
+    """Runs SExtractor with its catalog written to stdout and parses the catalog as it comes out, so it never touches the disk.
+
+    Parameters
+    ----------
+    sex_args : list
+        Command line arguments for SExtractor, without CATALOG_NAME
+    log_fname : str or None
+        File to append SExtractor's messages to, as for run_sextractor
+    keep_fname : str or None
+        Also write the catalog to this file, if it's wanted afterwards
+    param_fname : str or None
+        SExtractor parameter file of the run, for the widths of an empty catalog (see parse_ascii_catalog)
+
+    Returns
+    -------
+    cat : numpy array
+        The catalog, as from read_catalog
+
+    """
+    cat_lines = pipe_sextractor(sex_args, log_fname=log_fname)
+    if keep_fname is not None:
+        cat_lines = _tee_lines(cat_lines, keep_fname)
+    return parse_ascii_catalog(cat_lines, param_fname=param_fname)
+
+def _read_fits_catalog(fname):
+    """Reads a FITS_1.0 or FITS_LDAC SExtractor catalog.
+
+    """
+    hdu_list = fits.open(fname)
+    table_hdus = [hdu for hdu in hdu_list if isinstance(hdu, fits.BinTableHDU)]
+    obj_hdus = [hdu for hdu in table_hdus if hdu.name == 'LDAC_OBJECTS']
+    if obj_hdus:
+        table = obj_hdus[0].data
+    else:
+        table = table_hdus[-1].data
+
+    fields = []
+    for name in table.names:
+        column = np.asarray(table[name])
+        col_type = np.int64 if column.dtype.kind in 'iub' else np.float64
+        if column.ndim == 1:
+            fields.append((name, col_type, column))
+        else:
+            for n in range(column.shape[1]):
+                fields.append(('%s_%d' % (name, n+1), col_type, column[:, n]))
+
+    cat = np.empty(len(table), dtype=[(name, col_type) for name, col_type, column in fields])
+    for name, col_type, column in fields:
+        cat[name] = column
+    hdu_list.close()
+    return cat
+
+def read_catalog(fname, param_fname=None):
+    """Reads a SExtractor catalog into a structured array with one typed column per catalog entry.
+
+    Vector parameters are split into numbered sub-columns, so FLUX_APER(5) becomes FLUX_APER_1 to FLUX_APER_5. ASCII_HEAD, FITS_1.0 and FITS_LDAC catalogs are all understood, and the type is worked out from the file itself.
+
+    Parameters
+    ----------
+    fname : str
+        The filename of the SExtractor catalog.
+    param_fname : str or None
+        SExtractor parameter file the catalog was made with, for the widths of an empty ASCII_HEAD catalog (see parse_ascii_catalog)
+
+    Returns
+    -------
+    cat : numpy array
+        Structured array with one row per object
+
+    """
+    cat_file = open(fname, 'rb')
+    is_fits = cat_file.read(9) == b'SIMPLE  ='
+    cat_file.close()
+
+    if is_fits:
+        return _read_fits_catalog(fname)
+    return _read_ascii_catalog(fname, param_fname)
+
+def false_SExtract(field_band_dict, profile='lean', pipe=False, keep=True):
     """Runs SExtractor in dual mode, detecting on a false sources image and performing photometry with the science image.
 
     Parameters
     ----------
     field_band_dict : dict
         Dict of the various filenames etc relevant to the field and band being SExtracted
+    profile : str 'lean' or 'full'
+        SExtractor profile of the run, see sex_profiles.py. The lean profile makes no check image
+    pipe : bool
+        Set True to read the catalog straight from SExtractor's output instead of from cat_false
+    keep : bool
+        With pipe, whether to write the catalog to cat_false as well
 
     Returns
     -------
-    SExtractor outputs
+    cat : numpy array or None
+        The catalog if pipe is set, as from read_catalog. Otherwise SExtractor's outputs are in the files
 
     """
     false_image = field_band_dict['false_img']
-    sci_image = field_band_dict['sci']
+    sci_image = field_band_dict.get('sci_ext', field_band_dict['sci'])
     rms_map = field_band_dict['rms_crude']
     cat_fname = field_band_dict['cat_false']
     segmap_false = field_band_dict['seg_false']
@@ -206,25 +721,35 @@ def false_SExtract(field_band_dict):
     dual_rms = rms_map + ',' + rms_map
 
     # Run SExtractor
-    check_call(['sextractor', dual_sci, '-c', 'crude.sex', '-WEIGHT_IMAGE', dual_rms, '-CHECKIMAGE_NAME', segmap_false, '-CATALOG_NAME', cat_fname, '-GAIN', gain, '-MAG_ZEROPOINT', magzeropoint])
+    sex_args = [dual_sci, '-c', 'crude.sex', '-WEIGHT_IMAGE', dual_rms, '-CHECKIMAGE_NAME', segmap_false, '-GAIN', gain, '-MAG_ZEROPOINT', magzeropoint] + sex_profiles.profile_args('false', profile, field_band_dict.get('scratch', ''))
+    if pipe:
+        return piped_catalog(sex_args, log_fname=field_band_dict.get('sex_log'), keep_fname=cat_fname if keep else None, param_fname=sex_profiles.param_fname('false', profile, field_band_dict.get('scratch', '')))
+    run_sextractor(sex_args + ['-CATALOG_NAME', cat_fname], log_fname=field_band_dict.get('sex_log'))
 
-def test_SExtract(field_band_dict):
+def test_SExtract(field_band_dict, profile='lean', pipe=False, keep=False):
     """Runs SExtractor in dual mode, detecting on a false sources image and performing photometry with the science image.
 
     Parameters
     ----------
     field_band_dict : dict
         Dict of the various filenames etc relevant to the field and band being SExtracted
+    profile : str 'lean' or 'full'
+        SExtractor profile of the run, see sex_profiles.py. The lean profile makes no check image
+    pipe : bool
+        Set True to read the catalog straight from SExtractor's output instead of from test_cat
+    keep : bool
+        With pipe, whether to write the catalog to test_cat as well
 
     Returns
     -------
-    SExtractor outputs
+    cat : numpy array or None
+        The catalog if pipe is set, as from read_catalog. Otherwise SExtractor's outputs are in the files
 
     """
     false_image = field_band_dict['false_img']
-    sci_image = field_band_dict['sci']
+    sci_image = field_band_dict.get('sci_ext', field_band_dict['sci'])
     rms_map = field_band_dict['rms_norm']
-    cat_fname = 'test.cat'
+    cat_fname = field_band_dict.get('test_cat', 'test.cat')
     gain = str(field_band_dict['gain'])
     magzeropoint = str(field_band_dict['magz'])
 
@@ -233,15 +758,108 @@ def test_SExtract(field_band_dict):
     dual_rms = rms_map + ',' + rms_map
 
     # Run SExtractor
-    check_call(['sextractor', dual_sci, '-c', 'crude.sex', '-WEIGHT_IMAGE', dual_rms, '-CHECKIMAGE_TYPE', 'NONE', '-CATALOG_NAME', cat_fname, '-GAIN', gain, '-MAG_ZEROPOINT', magzeropoint])
+    sex_args = [dual_sci, '-c', 'crude.sex', '-WEIGHT_IMAGE', dual_rms, '-CHECKIMAGE_TYPE', 'NONE', '-GAIN', gain, '-MAG_ZEROPOINT', magzeropoint] + sex_profiles.profile_args('test', profile, field_band_dict.get('scratch', ''))
+    if pipe:
+        return piped_catalog(sex_args, log_fname=field_band_dict.get('sex_log'), keep_fname=cat_fname if keep else None, param_fname=sex_profiles.param_fname('test', profile, field_band_dict.get('scratch', '')))
+    run_sextractor(sex_args + ['-CATALOG_NAME', cat_fname], log_fname=field_band_dict.get('sex_log'))
+
+def false_photometry(field_band_dict, rms_key='rms_crude', back_grid=None, sex_fname='crude.sex', mask_fname=None):
+    """Measures aperture photometry on the science image at the false source positions, in place of running SExtractor.
+
+    The apertures are taken from PHOT_APERTURES and the background mesh from BACK_SIZE and BACK_FILTERSIZE in the SExtractor config file. As in SExtractor, pixels with zero weight, an infinite RMS or set in the bad pixel mask are left out of the background. False sources with an aperture over pixels of infinite RMS are left out of the catalog, as their flux errors would be infinite.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    rms_key : str
+        Key of the RMS map in field_band_dict to propagate the errors from
+    back_grid : numpy array or None
+        Background grid of the science image from an earlier call, to save estimating it again
+    sex_fname : str
+        Filename of the SExtractor config file
+    mask_fname : str or None
+        Filename of the field's bad pixel mask, if it has one
+
+    Returns
+    -------
+    cat : numpy array
+        Catalog of the measurements with NUMBER, X_IMAGE, Y_IMAGE, FLUX_APER and FLUXERR_APER columns as from read_catalog, and the REALISATION each false source belongs to
+    back_grid : numpy array
+        Background grid of the science image
+
+    """
+    sex_config = photometry.read_sex_config(sex_fname)
+    diameters = photometry.phot_apertures(sex_fname)
+    back_size = int(sex_config['BACK_SIZE'][0])
+    x_seg, y_seg, realisation = read_false_positions(field_band_dict)
+
+    sci_data = store.image_data(field_band_dict['sci'], field_band_dict.get('store'), field_band_dict.get('ext', 0))
+    rms_data = store.image_data(field_band_dict[rms_key], field_band_dict.get('store'))
+
+    if back_grid is None:
+        ext = field_band_dict.get('ext', 0)
+        wht_data = store.image_data(field_band_dict['wht'], field_band_dict.get('store'), ext)
+        mask_data = store.image_data(mask_fname, field_band_dict.get('store'), ext) if mask_fname is not None else None
+        back_grid = photometry.mesh_background(sci_data, back_size=back_size, filter_size=int(sex_config['BACK_FILTERSIZE'][0]), rms_data=rms_data, wht_data=wht_data, mask_data=mask_data)
+    flux, fluxerr = photometry.aperture_photometry(sci_data, rms_data, x_seg, y_seg, diameters, gain=float(field_band_dict['gain']), back_grid=back_grid, back_size=back_size)
+    measured = np.isfinite(fluxerr).all(axis=1)
+    if not measured.all():
+        print "%d false sources left out for apertures over pixels of infinite RMS" % np.sum(~measured)
+        x_seg, y_seg, realisation = x_seg[measured], y_seg[measured], realisation[measured]
+        flux, fluxerr = flux[measured], fluxerr[measured]
 
-def rms_norm_constant(cat_fname):
+    names = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'REALISATION', 'FLUX_APER', 'FLUXERR_APER']
+    widths = [1, 1, 1, 1, len(diameters), len(diameters)]
+    cat = np.empty(len(x_seg), dtype=catalog_dtype(names, widths))
+    cat['NUMBER'] = np.arange(1, len(x_seg) + 1)
+    cat['X_IMAGE'] = x_seg
+    cat['Y_IMAGE'] = y_seg
+    cat['REALISATION'] = realisation
+    for a in range(len(diameters)):
+        cat['FLUX_APER_%d' % (a+1)] = flux[:, a]
+        cat['FLUXERR_APER_%d' % (a+1)] = fluxerr[:, a]
+
+    return cat, back_grid
+
+def tag_realisations(cat_data, field_band_dict):
+    """Adds the REALISATION column to a SExtractor catalog of the false sources, taking each detection to belong to the realisation of the nearest false source placed. Needs scipy.
+
+    Returns
+    -------
+    cat : numpy array
+        The catalog with the REALISATION column, as false_photometry makes it
+
+    """
+    from scipy.spatial import cKDTree
+    from numpy.lib import recfunctions
+
+    if 'REALISATION' in cat_data.dtype.names:
+        return cat_data
+    x_seg, y_seg, realisation = read_false_positions(field_band_dict)
+    if len(cat_data) == 0:
+        nearest = np.zeros(0, dtype=int)
+    else:
+        nearest = cKDTree(np.column_stack((x_seg, y_seg))).query(np.column_stack((cat_data['X_IMAGE'], cat_data['Y_IMAGE'])))[1]
+    return recfunctions.append_fields(cat_data, 'REALISATION', realisation[nearest].astype(np.float64), usemask=False, asrecarray=False)
+
+def _as_catalog(cat_fname):
+    """Reads a catalog from file unless it's already been read in.
+
+    """
+    if isinstance(cat_fname, basestring):
+        return read_catalog(cat_fname)
+    return cat_fname
+
+def rms_norm_constant(cat_fname, aperture=NORM_APERTURE):
     """Calculates the RMS normalisation constant of an image based off the .cat of background photometry.
 
     Parameters
     ----------
-    cat_fname : str
-        Filename of the .cat SExtracted from the false source photometry
+    cat_fname : str or numpy array
+        Filename of the .cat SExtracted from the false source photometry, or a catalog already read in, e.g. from false_photometry
+    aperture : int
+        Which of the apertures to measure it in, counting from 1
 
     Returns
     -------
@@ -249,17 +867,11 @@ def rms_norm_constant(cat_fname):
         The normalisation constant to be applied to the RMS map
 
     """
-    cat_data = get_catalog(cat_fname)
-    src_count = len(cat_data.columns)
-
-    for ind in range(len(cat_data.index)):
-        if cat_data.index[ind] == 'FLUX_APER':
-            aper8_ind = ind + 3
-        if cat_data.index[ind] == 'FLUXERR_APER':
-            erraper8_ind = ind + 3
+    cat_data = _as_catalog(cat_fname)
+    src_count = len(cat_data)
 
-    flux_aper = cat_data.iloc[aper8_ind]
-    fluxerr_aper = cat_data.iloc[erraper8_ind]
+    flux_aper = cat_data['FLUX_APER_%d' % aperture]
+    fluxerr_aper = cat_data['FLUXERR_APER_%d' % aperture]
 
     # Calculations
     f_stdev = np.std(flux_aper)
@@ -267,3 +879,358 @@ def rms_norm_constant(cat_fname):
     norm_constant = f_stdev / ferr_median
 
     return norm_constant, src_count
+
+def aperture_columns(cat_fname):
+    """Gathers the fluxes and errors of every aperture in a catalog into (sources, apertures) arrays.
+
+    """
+    cat_data = _as_catalog(cat_fname)
+    n_apertures = 0
+    while 'FLUX_APER_%d' % (n_apertures + 1) in cat_data.dtype.names:
+        n_apertures += 1
+    flux = np.column_stack([np.asarray(cat_data['FLUX_APER_%d' % (a+1)], dtype=np.float64) for a in range(n_apertures)])
+    fluxerr = np.column_stack([np.asarray(cat_data['FLUXERR_APER_%d' % (a+1)], dtype=np.float64) for a in range(n_apertures)])
+    return flux, fluxerr
+
+def aperture_norm_constants(cat_fname):
+    """Calculates rms_norm_constant in every aperture of the false source photometry at once.
+
+    Returns
+    -------
+    norm_consts : numpy array
+        The normalisation constant measured in each aperture
+    src_count : int
+
+    """
+    flux, fluxerr = aperture_columns(cat_fname)
+    return np.std(flux, axis=0) / np.median(fluxerr, axis=0), len(flux)
+
+def _fit_log_curve(log_pixels, log_consts):
+    """Fits straight lines of log norm constant against log aperture area, over the last axis so that many sets of constants (e.g. bootstrap resamples) are fitted at once.
+
+    """
+    x = log_pixels - log_pixels.mean()
+    slope = np.sum(x * (log_consts - log_consts.mean(axis=-1)[..., None]), axis=-1) / np.sum(x**2)
+    intercept = log_consts.mean(axis=-1) - slope * log_pixels.mean()
+    return intercept, slope
+
+def fit_noise_curve(diameters, norm_consts):
+    """Fits the scaling of the noise with aperture size, sigma(N) = sigma_1 * alpha * N**beta for apertures of N pixels, to the norm constants measured in each aperture.
+
+    The errors the photometry gives assume uncorrelated pixels, sigma_1 * sqrt(N), so the norm constant of an aperture is alpha * N**(beta - 0.5). beta is 0.5 for uncorrelated noise and rises towards 1 the more neighbouring pixels are correlated, e.g. by drizzling.
+
+    Parameters
+    ----------
+    diameters : numpy array
+        Diameters of the apertures in pixels
+    norm_consts : numpy array
+        The norm constant measured in each aperture, as from aperture_norm_constants
+
+    Returns
+    -------
+    alpha, beta : float
+
+    """
+    if len(diameters) < 2:
+        raise ValueError("Need at least two apertures to fit the noise curve, have %d" % len(diameters))
+    log_alpha, slope = _fit_log_curve(np.log(np.pi * (np.asarray(diameters) / 2.)**2), np.log(norm_consts))
+    return float(np.exp(log_alpha)), float(slope + 0.5)
+
+def noise_curve_constant(alpha, beta, diameter):
+    """Evaluates a fit_noise_curve relation as the norm constant of an aperture of a given diameter.
+
+    """
+    return alpha * (np.pi * (diameter / 2.)**2)**(beta - 0.5)
+
+def noise_curve_keywords(noise_curve):
+    """Makes the FITS header keywords recording the noise curve of a run report.
+
+    NAPDn and NCRATn are the diameter and measured norm constant of each aperture, NCALPHA and NCBETA the fitted relation (see fit_noise_curve), and NORMAPER the aperture the normalisation was measured in, or evaluated at with NORMFIT.
+
+    Parameters
+    ----------
+    noise_curve : dict
+        The 'noise_curve' entry of a run report from pipeline.process_band
+
+    Returns
+    -------
+    cards : list
+        (key, value, comment) header cards
+
+    """
+    cards = []
+    for a, (diameter, norm_const) in enumerate(zip(noise_curve['diameters'], noise_curve['norm_constants'])):
+        cards.append(('NAPD%d' % (a+1), diameter, 'diameter of aperture %d in pixels' % (a+1)))
+        cards.append(('NCRAT%d' % (a+1), norm_const, 'norm constant measured in aperture %d' % (a+1)))
+    if noise_curve['alpha'] is not None:
+        cards.append(('NCALPHA', noise_curve['alpha'], 'noise curve sigma(N) = sigma_1 alpha N^beta'))
+        cards.append(('NCBETA', noise_curve['beta'], 'noise curve exponent, 0.5 if uncorrelated'))
+    cards.append(('NORMAPER', noise_curve['aperture'], 'aperture the normalisation is for'))
+    cards.append(('NORMFIT', noise_curve['fit'], 'normalisation from the fitted noise curve'))
+    return cards
+
+def realisation_norm_constants(cat_fname, realisations, aperture=NORM_APERTURE):
+    """Calculates rms_norm_constant separately for the false sources of each realisation, all at once.
+
+    Parameters
+    ----------
+    cat_fname : str or numpy array
+        Filename of the .cat from the false source photometry, or the catalog itself
+    realisations : numpy array
+        The realisation each false source in the catalog belongs to, e.g. its REALISATION column
+    aperture : int
+        Which of the apertures to measure them in, counting from 1
+
+    Returns
+    -------
+    norm_consts : numpy array
+        The normalisation constant of each realisation, in order
+    src_counts : numpy array
+        Number of false sources in each realisation
+
+    """
+    cat_data = _as_catalog(cat_fname)
+    flux_aper = np.asarray(cat_data['FLUX_APER_%d' % aperture], dtype=np.float64)
+    fluxerr_aper = np.asarray(cat_data['FLUXERR_APER_%d' % aperture], dtype=np.float64)
+    groups = np.unique(realisations, return_inverse=True)[1]
+    n_groups = groups.max() + 1 if len(groups) else 0
+
+    src_counts = np.bincount(groups, minlength=n_groups)
+    flux_mean = np.bincount(groups, flux_aper, minlength=n_groups) / src_counts
+    f_stdev = np.sqrt(np.bincount(groups, (flux_aper - flux_mean[groups])**2, minlength=n_groups) / src_counts)
+    ferr_median = _grouped_median(fluxerr_aper, groups, n_groups)[0]
+    return f_stdev / ferr_median, src_counts
+
+def _weighted_norm_constants(flux, fluxerr, weights):
+    """Calculates rms_norm_constant of many resamples at once, each given as a (resamples, sources) array of how many times every source was drawn.
+
+    """
+    total = weights.sum(axis=1)
+    flux_mean = weights.dot(flux) / total
+    f_stdev = np.sqrt(np.sum(weights * (flux - flux_mean[:, None])**2, axis=1) / total)
+    # The weighted median, averaging the middle two values for an even total as np.median does
+    order = np.argsort(fluxerr)
+    cum_weights = np.cumsum(weights[:, order], axis=1)
+    low = np.argmax(cum_weights >= ((total + 1) // 2)[:, None], axis=1)
+    high = np.argmax(cum_weights >= (total // 2 + 1)[:, None], axis=1)
+    ferr_median = 0.5 * (fluxerr[order][low] + fluxerr[order][high])
+    return f_stdev / ferr_median
+
+def bootstrap_norm_constant(cat_fname, n_boot=1000, confidence=0.95, batch=200, seed=None, aperture=NORM_APERTURE, fit_diameters=None, realisations=None):
+    """Works out a confidence interval on rms_norm_constant by bootstrap resampling the false sources.
+
+    The resamples are drawn and reduced batch at a time as (batch, sources) index arrays, so there's no loop over them. With fit_diameters, each resample is measured in every aperture and fitted with the noise curve, for an interval on the constant from the fit instead. Given the realisation of each false source, whole realisations are resampled instead of single sources, so the interval takes in how much the constant changes from one placement of the false sources to another.
+
+    Parameters
+    ----------
+    cat_fname : str or numpy array
+        Filename of the .cat from the false source photometry, or the catalog itself
+    n_boot : int
+        Number of bootstrap resamples
+    confidence : float
+        Confidence level of the interval
+    batch : int
+        Number of resamples drawn at once
+    seed : int or None
+        Seed of the resampling
+    aperture : int
+        Which of the apertures the constant is for, counting from 1
+    fit_diameters : numpy array or None
+        Diameters of all the apertures, to take the constant from the fitted noise curve (see fit_noise_curve). None takes it from the one aperture
+    realisations : numpy array or None
+        The realisation each false source belongs to, to resample whole realisations. None, or a single realisation, resamples the sources
+
+    Returns
+    -------
+    low, high : float
+        Bounds of the interval
+
+    """
+    if fit_diameters is None:
+        cat_data = _as_catalog(cat_fname)
+        flux_aper = np.asarray(cat_data['FLUX_APER_%d' % aperture], dtype=np.float64)
+        fluxerr_aper = np.asarray(cat_data['FLUXERR_APER_%d' % aperture], dtype=np.float64)
+    else:
+        flux_aper, fluxerr_aper = aperture_columns(cat_fname)
+        log_pixels = np.log(np.pi * (np.asarray(fit_diameters[:flux_aper.shape[1]]) / 2.)**2)
+    n_src = len(flux_aper)
+    groups = None
+    if realisations is not None:
+        groups = np.unique(realisations, return_inverse=True)[1]
+        n_groups = groups.max() + 1 if n_src else 0
+        if n_groups < 2:
+            groups = None
+
+    rng = np.random.RandomState(seed)
+    boot_consts = np.empty(n_boot)
+    for start in range(0, n_boot, batch):
+        stop = min(start + batch, n_boot)
+        if groups is None:
+            resamples = rng.randint(0, n_src, (stop - start, n_src))
+            boot_ratios = np.std(flux_aper[resamples], axis=1) / np.median(fluxerr_aper[resamples], axis=1)
+        else:
+            # How many times each realisation is drawn in each resample, handed down to its sources
+            draws = rng.randint(0, n_groups, (stop - start, n_groups)) + n_groups * np.arange(stop - start)[:, None]
+            weights = np.bincount(draws.ravel(), minlength=(stop - start) * n_groups).reshape(stop - start, n_groups)[:, groups].astype(np.float64)
+            if flux_aper.ndim == 1:
+                boot_ratios = _weighted_norm_constants(flux_aper, fluxerr_aper, weights)
+            else:
+                boot_ratios = np.column_stack([_weighted_norm_constants(flux_aper[:, a], fluxerr_aper[:, a], weights) for a in range(flux_aper.shape[1])])
+        if fit_diameters is not None:
+            # (batch, apertures) constants, each row fitted with its own curve
+            log_alpha, slope = _fit_log_curve(log_pixels, np.log(boot_ratios))
+            boot_ratios = np.exp(log_alpha + slope * log_pixels[aperture-1])
+        boot_consts[start:stop] = boot_ratios
+
+    low, high = np.percentile(boot_consts, [50. * (1 - confidence), 50. * (1 + confidence)])
+    return low, high
+
+def sources_needed(no_sources, rel_width, target):
+    """Estimates how many false sources would bring the relative width of the interval on the norm constant down to target, given the width from no_sources of them.
+
+    The width of the interval shrinks as one over the square root of the number of sources.
+
+    """
+    return int(np.ceil(no_sources * (rel_width / target)**2))
+
+def _grouped_median(values, groups, n_groups):
+    """Takes the median of the values in each group at once, by sorting on group then value.
+
+    Returns
+    -------
+    medians : numpy array
+        Median of each group, NaN for groups with no values
+    counts : numpy array
+        Number of values in each group
+
+    """
+    counts = np.bincount(groups, minlength=n_groups)
+    sorted_values = values[np.lexsort((values, groups))]
+    starts = np.cumsum(counts) - counts
+    filled = counts > 0
+    low = (starts + (counts - 1) // 2)[filled]
+    high = (starts + counts // 2)[filled]
+    medians = np.full(n_groups, np.nan)
+    medians[filled] = 0.5 * (sorted_values[low] + sorted_values[high])
+    return medians, counts
+
+def tiled_norm_constants(cat_fname, shape, tile_size=1024, min_sources=10, filter_size=3, aperture=NORM_APERTURE):
+    """Calculates a normalisation constant for each tile of a grid over the image from the false source photometry.
+
+    The false sources are binned into tile_size x tile_size tiles, and each tile's constant is the robust standard deviation of its fluxes (1.4826 times their median absolute deviation) over the median of their errors, all tiles being worked out together. Tiles with fewer than min_sources false sources take the value of their neighbours, or the constant of the whole image if they have none, and the grid is then median filtered like a SExtractor background mesh. Finally the grid is scaled so that the fluxes over their errors times the interpolated surface have a standard deviation of one, matching the scale of rms_norm_constant. rms_tools.norm_rms_map interpolates the grid into a smooth surface between the tile centres.
+
+    Parameters
+    ----------
+    cat_fname : str or numpy array
+        Filename of the .cat from the false source photometry, or the catalog itself
+    shape : tuple
+        Shape of the image (rows, columns)
+    tile_size : int
+        Size of each tile in pixels
+    min_sources : int
+        Fewest false sources a tile needs to get its own constant
+    filter_size : int
+        Size of the median filter applied to the grid
+    aperture : int
+        Which of the apertures to measure the constants in, counting from 1
+
+    Returns
+    -------
+    norm_grid : numpy array
+        The normalisation constant of each tile
+    src_counts : numpy array
+        Number of false sources in each tile
+
+    """
+    cat_data = _as_catalog(cat_fname)
+    flux_aper = np.asarray(cat_data['FLUX_APER_%d' % aperture], dtype=np.float64)
+    fluxerr_aper = np.asarray(cat_data['FLUXERR_APER_%d' % aperture], dtype=np.float64)
+
+    n_tiles_y = -(-shape[0] // tile_size)
+    n_tiles_x = -(-shape[1] // tile_size)
+    tile_x = np.clip((np.asarray(cat_data['X_IMAGE']) - 1).astype(int) // tile_size, 0, n_tiles_x - 1)
+    tile_y = np.clip((np.asarray(cat_data['Y_IMAGE']) - 1).astype(int) // tile_size, 0, n_tiles_y - 1)
+    tiles = tile_y * n_tiles_x + tile_x
+    n_tiles = n_tiles_y * n_tiles_x
+
+    flux_median, src_counts = _grouped_median(flux_aper, tiles, n_tiles)
+    abs_dev, src_counts = _grouped_median(np.abs(flux_aper - flux_median[tiles]), tiles, n_tiles)
+    ferr_median, src_counts = _grouped_median(fluxerr_aper, tiles, n_tiles)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_grid = 1.4826 * abs_dev / ferr_median
+    norm_grid[src_counts < min_sources] = np.nan
+    norm_grid = norm_grid.reshape(n_tiles_y, n_tiles_x)
+
+    # Tiles short of false sources take the value of their neighbours through the filter, or of the whole image
+    global_const = 1.4826 * np.median(np.abs(flux_aper - np.median(flux_aper))) / np.median(fluxerr_aper)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if np.isnan(norm_grid).any():
+            norm_grid = np.where(np.isnan(norm_grid), photometry.median_filter_grid(norm_grid, 3), norm_grid)
+        norm_grid[~np.isfinite(norm_grid)] = global_const
+        if filter_size > 1:
+            norm_grid = photometry.median_filter_grid(norm_grid, filter_size)
+    norm_grid *= np.std(flux_aper / (norm_constants_at(norm_grid, tile_size, cat_data['X_IMAGE'], cat_data['Y_IMAGE']) * fluxerr_aper))
+
+    return norm_grid, src_counts.reshape(n_tiles_y, n_tiles_x)
+
+def normalised_scatter(cat_fname, aperture=NORM_APERTURE):
+    """Measures the standard deviation of the false source fluxes over their own errors, the check of a normalisation that varies across the map.
+
+    Returns
+    -------
+    scatter : float
+    src_count : int
+
+    """
+    cat_data = _as_catalog(cat_fname)
+    return np.std(cat_data['FLUX_APER_%d' % aperture] / cat_data['FLUXERR_APER_%d' % aperture]), len(cat_data)
+
+def norm_constants_at(norm_grid, tile_size, x, y):
+    """Looks up the normalisation surface of a tiled_norm_constants grid at 1-indexed pixel positions, e.g. of the false sources.
+
+    """
+    return photometry.background_at(norm_grid, np.asarray(x) - 1, np.asarray(y) - 1, tile_size)
+
+def predicted_norm_constant(cat_fname, norm_const, gain=0., aperture=NORM_APERTURE):
+    """Works out what rms_norm_constant would measure once the RMS map has been normalised, without measuring it again.
+
+    Normalising only scales the RMS map, so the fluxes are unchanged and the part of each flux error that comes from the RMS map scales by norm_const. The Poisson part, flux/gain for positive fluxes, is left as it was. Where norm_const varies from source to source the check is normalised_scatter rather than rms_norm_constant.
+
+    This checks the normalisation's arithmetic, not the noise: norm_const was measured from these same fluxes and errors, so for a single constant the result is close to 1 by construction, and it only strays when the Poisson part of the errors is large or the constant varies across the map. Measuring again with strict_verify doesn't make it independent either, as it's the same science image at the same positions. The uncertainty on the constant itself is the bootstrap interval (see bootstrap_norm_constant).
+
+    Parameters
+    ----------
+    cat_fname : str or numpy array
+        Filename of the .cat from the false source photometry with the crude RMS map, or the catalog itself
+    norm_const : float or numpy array
+        The normalisation constant applied to the RMS map, or the constant at each false source where it varies across the map (see norm_constants_at)
+    gain : float
+        The gain the photometry was done with
+    aperture : int
+        Which of the apertures to predict it in, counting from 1
+
+    Returns
+    -------
+    test_norm : float
+        The expected noise_measured / noise_estimated of the normalised map
+    src_count : int
+        Number of false sources in the catalog
+
+    """
+    cat_data = _as_catalog(cat_fname)
+    flux_aper = cat_data['FLUX_APER_%d' % aperture]
+    fluxerr_aper = cat_data['FLUXERR_APER_%d' % aperture]
+
+    poisson_var = np.zeros(len(cat_data))
+    if gain > 0:
+        poisson_var = np.where(flux_aper > 0, flux_aper / gain, 0.)
+    rms_var = np.clip(fluxerr_aper**2 - poisson_var, 0, None)
+    norm_fluxerr = np.sqrt(norm_const**2 * rms_var + poisson_var)
+
+    if np.ndim(norm_const) > 0:
+        test_norm = np.std(flux_aper / norm_fluxerr)
+    else:
+        test_norm = np.std(flux_aper) / np.median(norm_fluxerr)
+
+    return test_norm, len(cat_data)
@@ -0,0 +1,236 @@
+"""A module for measuring aperture photometry in-process at known positions, following the conventions of the SExtractor config in crude.sex.
+
+"""
+
+import warnings
+import numpy as np
+
+def read_sex_config(sex_fname='crude.sex'):
+    """Reads the parameters out of a SExtractor config file.
+
+    Parameters
+    ----------
+    sex_fname : str
+        Filename of the SExtractor config file
+
+    Returns
+    -------
+    sex_config : dict
+        The value of each parameter as a list of strings, split on commas
+
+    """
+    sex_config = {}
+    sex_file = open(sex_fname)
+    for sex_line in sex_file:
+        sex_line = sex_line.split('#')[0].strip()
+        if len(sex_line) == 0:
+            continue
+        split_line = sex_line.split(None, 1)
+        if len(split_line) == 1:
+            sex_config[split_line[0]] = []
+        else:
+            sex_config[split_line[0]] = [val.strip() for val in split_line[1].split(',')]
+    sex_file.close()
+    return sex_config
+
+def phot_apertures(sex_fname='crude.sex'):
+    """Gets the aperture diameters in pixels from a SExtractor config file.
+
+    """
+    return np.array(read_sex_config(sex_fname)['PHOT_APERTURES'], dtype=float)
+
+def _clipped_mode(values, n_iter=5, clip=3.):
+    """Estimates the background of each row of a 2D array of mesh pixels the way SExtractor does.
+
+    The pixels are sigma clipped about the median, then the mode is estimated as 2.5*median - 1.5*mean unless the mesh is too crowded for that to be reliable, in which case the median is used.
+
+    """
+    values = np.array(values, dtype=np.float64)
+    for n in range(n_iter):
+        med = np.nanmedian(values, axis=1)
+        std = np.nanstd(values, axis=1)
+        values[np.absolute(values - med[:, None]) > clip * std[:, None]] = np.nan
+    mean = np.nanmean(values, axis=1)
+    med = np.nanmedian(values, axis=1)
+    std = np.nanstd(values, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crowded = np.absolute(mean - med) >= 0.3 * std
+    mode = np.where(crowded, med, 2.5*med - 1.5*mean)
+    return mode, std
+
+def median_filter_grid(grid, filter_size):
+    """Median filters a mesh grid with a filter_size x filter_size box, repeating the edge meshes.
+
+    """
+    half = filter_size // 2
+    padded = np.pad(grid, half, mode='edge')
+    stack = [padded[dy:dy+grid.shape[0], dx:dx+grid.shape[1]] for dy in range(filter_size) for dx in range(filter_size)]
+    return np.nanmedian(np.array(stack), axis=0)
+
+def mesh_background(sci_data, back_size=64, filter_size=3, rms_data=None, with_rms=False, wht_data=None, mask_data=None):
+    """Estimates the background of an image on a grid of meshes, like SExtractor's BACK_SIZE and BACK_FILTERSIZE.
+
+    The image is read one row of meshes at a time, so it can be a memory map of an image larger than memory.
+
+    Parameters
+    ----------
+    sci_data : numpy array
+        The image
+    back_size : int
+        Size of each mesh in pixels
+    filter_size : int
+        Size of the median filter applied to the grid of meshes
+    rms_data : numpy array or None
+        RMS map of the image. Pixels with a non-finite RMS are left out of the estimate
+    with_rms : bool
+        Set True to also return the grid of the clipped standard deviation in each mesh
+    wht_data : numpy array or None
+        Weight map of the image. Pixels with zero weight are left out of the estimate
+    mask_data : numpy array or None
+        Bad pixel mask of the image, such as the bitmask from rms_tools.bad_pixel_bitmask. Pixels with non-zero values are left out of the estimate
+
+    Returns
+    -------
+    back_grid : numpy array
+        Background level of each mesh
+    rms_grid : numpy array
+        Only if with_rms is True. Background noise of each mesh
+
+    """
+    n_rows, n_cols = sci_data.shape
+    n_mesh_x = -(-n_cols // back_size)
+    back_rows = []
+    rms_rows = []
+    for start in range(0, n_rows, back_size):
+        stop = min(start + back_size, n_rows)
+        strip = np.full((back_size, n_mesh_x * back_size), np.nan)
+        strip[:stop-start, :n_cols] = sci_data[start:stop]
+        if rms_data is not None:
+            strip[:stop-start, :n_cols][~np.isfinite(rms_data[start:stop])] = np.nan
+        if wht_data is not None:
+            strip[:stop-start, :n_cols][np.asarray(wht_data[start:stop]) == 0] = np.nan
+        if mask_data is not None:
+            strip[:stop-start, :n_cols][np.asarray(mask_data[start:stop]) != 0] = np.nan
+        strip[~np.isfinite(strip)] = np.nan
+        meshes = strip.reshape(back_size, n_mesh_x, back_size).transpose(1, 0, 2).reshape(n_mesh_x, -1)
+        with warnings.catch_warnings():
+            # Meshes that are entirely blank give all-NaN warnings
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mode, std = _clipped_mode(meshes)
+        back_rows.append(mode)
+        rms_rows.append(std)
+
+    # Empty meshes take the value of their neighbours through the filter
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        back_grid = median_filter_grid(np.array(back_rows), filter_size)
+        rms_grid = median_filter_grid(np.array(rms_rows), filter_size)
+    back_grid[~np.isfinite(back_grid)] = 0.
+    rms_grid[~np.isfinite(rms_grid)] = 0.
+
+    if with_rms:
+        return back_grid, rms_grid
+    return back_grid
+
+def background_at(back_grid, x, y, back_size=64):
+    """Interpolates a mesh background grid bilinearly between the mesh centres.
+
+    Parameters
+    ----------
+    back_grid : numpy array
+        Grid from mesh_background
+    x, y : numpy array
+        0-indexed pixel coordinates to evaluate the background at
+    back_size : int
+        Size of each mesh in pixels
+
+    """
+    n_mesh_y, n_mesh_x = back_grid.shape
+    gx = np.clip((np.asarray(x, dtype=float) + 0.5) / back_size - 0.5, 0, n_mesh_x - 1)
+    gy = np.clip((np.asarray(y, dtype=float) + 0.5) / back_size - 0.5, 0, n_mesh_y - 1)
+    x0 = np.minimum(np.floor(gx).astype(int), max(n_mesh_x - 2, 0))
+    y0 = np.minimum(np.floor(gy).astype(int), max(n_mesh_y - 2, 0))
+    x1 = np.minimum(x0 + 1, n_mesh_x - 1)
+    y1 = np.minimum(y0 + 1, n_mesh_y - 1)
+    fx = gx - x0
+    fy = gy - y0
+    return ((1-fy) * ((1-fx) * back_grid[y0, x0] + fx * back_grid[y0, x1]) +
+            fy * ((1-fx) * back_grid[y1, x0] + fx * back_grid[y1, x1]))
+
+def aperture_weights(dx, dy, radius, oversamp=5):
+    """Fraction of each pixel lying inside a circular aperture.
+
+    Pixels cut by the edge of the aperture are subsampled oversamp x oversamp times, as SExtractor does with APER_OVERSAMP.
+
+    Parameters
+    ----------
+    dx, dy : numpy array
+        Offsets of the pixel centres from the aperture centre
+    radius : float
+        Radius of the aperture in pixels
+
+    """
+    sub = (np.arange(oversamp) + 0.5) / oversamp - 0.5
+    sub_dx = dx[..., None, None] + sub[None, :]
+    sub_dy = dy[..., None, None] + sub[:, None]
+    inside = (sub_dx**2 + sub_dy**2) <= radius**2
+    return inside.reshape(dx.shape + (-1,)).mean(axis=-1)
+
+def aperture_photometry(sci_data, rms_data, x, y, diameters, gain=0., back_grid=None, back_size=64):
+    """Measures the flux and flux error in circular apertures centred on known positions.
+
+    The background is taken from a mesh grid and subtracted, and the errors are propagated from the RMS map (WEIGHT_TYPE MAP_RMS) with a Poisson term for positive fluxes when the gain is non-zero, matching FLUX_APER and FLUXERR_APER in crude.sex. An aperture taking in any pixel of infinite RMS (zero weight, with wht_zero=inf) has no finite error, so it's flagged with a NaN flux and error rather than passing on an infinite one.
+
+    Parameters
+    ----------
+    sci_data, rms_data : numpy array
+        The science image and its RMS map. Either can be a memory map as only the pixels around each aperture are read
+    x, y : array
+        1-indexed pixel coordinates of the aperture centres, as in X_IMAGE and Y_IMAGE
+    diameters : array
+        Aperture diameters in pixels, as in PHOT_APERTURES
+    gain : float
+        Detector gain in e-/ADU. 0 leaves out the Poisson term
+    back_grid : numpy array or None
+        Background grid from mesh_background. No background is subtracted if None
+    back_size : int
+        Mesh size back_grid was made with
+
+    Returns
+    -------
+    flux, fluxerr : numpy array
+        Arrays of shape (number of positions, number of apertures), NaN for flagged apertures
+
+    """
+    x = np.asarray(x, dtype=float) - 1
+    y = np.asarray(y, dtype=float) - 1
+    diameters = np.asarray(diameters, dtype=float)
+    half = int(np.ceil(diameters.max() / 2. + 1))
+    n_rows, n_cols = sci_data.shape
+
+    flux = np.zeros((len(x), len(diameters)))
+    fluxerr = np.zeros((len(x), len(diameters)))
+    for n in range(len(x)):
+        xc = int(np.floor(x[n] + 0.5))
+        yc = int(np.floor(y[n] + 0.5))
+        row_lo, row_hi = max(yc - half, 0), min(yc + half + 1, n_rows)
+        col_lo, col_hi = max(xc - half, 0), min(xc + half + 1, n_cols)
+        sci_box = np.array(sci_data[row_lo:row_hi, col_lo:col_hi], dtype=np.float64)
+        var_box = np.array(rms_data[row_lo:row_hi, col_lo:col_hi], dtype=np.float64)**2
+        rows, cols = np.mgrid[row_lo:row_hi, col_lo:col_hi]
+        if back_grid is not None:
+            sci_box = sci_box - background_at(back_grid, cols, rows, back_size)
+
+        for a in range(len(diameters)):
+            weights = aperture_weights(cols - x[n], rows - y[n], diameters[a] / 2.)
+            inside = weights > 0
+            var = np.sum(weights[inside] * var_box[inside])
+            if not np.isfinite(var):
+                flux[n, a], fluxerr[n, a] = np.nan, np.nan
+                continue
+            flux[n, a] = np.sum(weights * sci_box)
+            if gain > 0 and flux[n, a] > 0:
+                var += flux[n, a] / gain
+            fluxerr[n, a] = np.sqrt(var)
+
+    return flux, fluxerr
@@ -0,0 +1,946 @@
+"""Runs the RMS normalisation of each field and band as an independent task, so that several can be run at once.
+
+"""
+
+import multiprocessing
+import numpy as np
+from astropy.io import fits
+from os import makedirs, remove
+from os.path import exists, splitext
+from subprocess import CalledProcessError
+import rms_tools as rms
+import noise
+import photometry
+import cache
+import instrument
+import mef
+import scheduler
+import sex_profiles
+import store
+import tiling
+
+# Most rounds of false sources an adaptive count will run
+MAX_ADAPTIVE_ROUNDS = 4
+
+# Outputs of a field and band that each extension of a multi-extension input gets its own copy of
+EXT_KEYS = ('cat_crude', 'cat_false', 'rms_crude', 'rms_norm', 'segmap', 'seg_false', 'false_img', 'false_pos')
+
+def scratch_names(field_band_dict, scratch_dir):
+    """Gives a field and band its own scratch directory and names for the files SExtractor writes there, so concurrent tasks never share an output file.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    scratch_dir : str
+        The task's scratch directory
+
+    Returns
+    -------
+    field_band_dict : dict
+        With new entries.
+
+    """
+    field_band_dict['scratch'] = scratch_dir
+    field_band_dict['test_cat'] = scratch_dir + 'test.cat'
+    field_band_dict['sex_log'] = scratch_dir + 'sextractor.log'
+    return field_band_dict
+
+def read_gain(field_band_dict):
+    """Fills in the gain of a field and band, the exposure time of its science image, if it isn't there already.
+
+    Only the primary header is read (or the extension's, for a multi-extension image without EXPTIME in its primary header), and only when the field and band is processed, so setting up a run doesn't open every image.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+
+    Returns
+    -------
+    gain : float
+
+    """
+    if 'gain' not in field_band_dict:
+        sci_header = fits.getheader(field_band_dict['sci'], ignore_missing_end=True)
+        if 'exptime' not in sci_header and field_band_dict.get('ext'):
+            sci_header = fits.getheader(field_band_dict['sci'], ext=field_band_dict['ext'], ignore_missing_end=True)
+        field_band_dict['gain'] = sci_header['exptime']
+    return field_band_dict['gain']
+
+def task_options(config_dict, strict_verify=False):
+    """Gets the run settings of process_band shared by run_rms.py and make_detection_rms.py out of a config, with their defaults.
+
+    Parameters
+    ----------
+    config_dict : dict
+        The config, as from rms_config.auto_config
+    strict_verify : bool
+        From the command line, see process_band
+
+    Returns
+    -------
+    options : dict
+        Keyword arguments for band_tasks. The runners add wht_zero or mask themselves
+
+    """
+    return {'block_rows': config_dict.get('block_rows'),
+            'false_dtype': config_dict.get('false_dtype', 'float64'),
+            'photometry': config_dict.get('photometry', 'sextractor'),
+            'masking': config_dict.get('masking', 'sextractor'),
+            'sex_profile': config_dict.get('sex_profile', 'lean'),
+            'sex_catalogs': config_dict.get('sex_catalogs', 'file'),
+            'keep_catalogs': config_dict.get('keep_catalogs', 0),
+            'strict_verify': strict_verify,
+            'cache': config_dict.get('cache', 'stat'),
+            'norm_tile_size': config_dict.get('norm_tile_size'),
+            'false_realisations': config_dict.get('false_realisations', 1),
+            'bootstrap': config_dict.get('bootstrap', 1000),
+            'norm_precision': config_dict.get('norm_precision'),
+            'max_false_srcs': config_dict.get('max_false_srcs', 1000),
+            'norm_aperture': config_dict.get('norm_aperture', noise.NORM_APERTURE),
+            'norm_fit': config_dict.get('norm_fit', 0),
+            'sex_tile_size': config_dict.get('sex_tile_size'),
+            'sex_tile_overlap': config_dict.get('sex_tile_overlap', 128),
+            'sex_tile_jobs': config_dict.get('sex_tile_jobs')}
+
+def band_tasks(field_data, bands=None, scratch_root=None, store_root=None, **options):
+    """Makes the list of tasks for process_band, one for each field and band, or for each image extension of a field and band with multi-extension images.
+
+    An extension's task reads its extension of the science and weight images (field_band_dict['ext']) and writes its own copy of each output, named by mef.ext_fname. Its normalised RMS map is put together with the others' by merge_extensions into the band's rms_norm.
+
+    Parameters
+    ----------
+    field_data : dict
+        Field data as from rms_config.full_filename_list_z9
+    bands : list or None
+        Bands to make tasks for. Defaults to all the bands of each field
+    scratch_root : str or None
+        Directory to make the scratch directory of each task in. Defaults to fake_dir of the config
+    store_root : str or None
+        Directory to make each field's store directory in (see store.py). None reads every image from its FITS file
+    options
+        Settings passed on to process_band, e.g. from task_options
+
+    Returns
+    -------
+    tasks : list
+        List of (field, band, field_band_dict, options) tuples
+
+    """
+    tasks = []
+    for field in sorted(field_data):
+        for band in (bands or field_data[field]['bands']):
+            band_dict = dict(field_data[field][band])
+            if store_root is not None:
+                band_dict['store'] = store_root + field + '/'
+            extensions = mef.image_extensions(band_dict['wht'])
+            if not mef.is_mef(extensions):
+                if scratch_root is not None:
+                    scratch_names(band_dict, scratch_root + field + '_' + band + '/')
+                tasks.append((field, band, band_dict, options))
+                continue
+
+            for ext in extensions:
+                ext_dict = dict(band_dict)
+                ext_dict['ext'] = ext
+                ext_dict['rms_mef'] = band_dict['rms_norm']
+                for key in EXT_KEYS:
+                    ext_dict[key] = mef.ext_fname(band_dict[key], ext)
+                # SExtractor gets a copy of the extension's science image
+                ext_dict['sci_ext'] = mef.ext_fname(band_dict['false_img'].replace('_false_sources', '_sci'), ext)
+                if scratch_root is not None:
+                    scratch_names(ext_dict, scratch_root + field + '_' + band + '_ext%d/' % ext)
+                tasks.append((field, band, ext_dict, options))
+    return tasks
+
+def field_mask(field, wht_list, bands, mask_fname, block_rows=None, store_dir=None, cache_mode='stat'):
+    """Runs the bad pixel mask stage of a field, for make_detection_rms.py.
+
+    Parameters
+    ----------
+    field : str
+        Name of the field
+    wht_list : list
+        Filenames of the weight image of each band
+    bands : list
+        Names of the bands, in the same order
+    mask_fname : str
+        Filename of the field's bitmask, see rms_tools.bad_pixel_bitmask
+    block_rows : int or None
+        Number of rows of each weight image to read at once
+    store_dir : str or None
+        The field's store directory (see store.py). The mask is put in the store too, so the band tasks share one copy of it
+    cache_mode : str 'stat' or 'checksum'
+        How to tell whether the weight images have changed, see cache.file_identity
+
+    Returns
+    -------
+    report : dict
+        Run report of the stage, from instrument.new_report
+
+    """
+    if store_dir is not None:
+        store.make_store(store_dir)
+    extensions = mef.image_extensions(wht_list[0])
+
+    report = instrument.new_report(field, '')
+    with instrument.stage(report, 'bad_pixel_mask'):
+        up_to_date, key = cache.check_stage([mask_fname], wht_list, {'bands': bands}, mode=cache_mode)
+        if not up_to_date:
+            print "\n\nMaking bad pixel mask for field %s..." % field
+            rms.bad_pixel_bitmask(wht_list, mask_fname, bands=bands, block_rows=block_rows, store_dir=store_dir, extensions=extensions)
+            cache.mark_stage([mask_fname], key)
+        else:
+            print "Bad pixel mask for field %s is up to date!" % field
+    if store_dir is not None:
+        for ext in extensions:
+            store.image_data(mask_fname, store_dir, ext)
+    return report
+
+def tile_options(options):
+    """Gets the tiling settings of a task's options as keyword arguments for the tiled SExtractor runs of tiling.py.
+
+    """
+    return {'tile_size': options['sex_tile_size'], 'overlap': options.get('sex_tile_overlap', 128), 'jobs': options.get('sex_tile_jobs')}
+
+def crude_rms(field_band_dict, options, report):
+    """Runs the wht_to_rms stage of a field and band, and for a multi-extension image the unpack_sci stage, which copies its extension of the science image out for SExtractor.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    options : dict
+        Run settings, as for process_band. Uses mask, wht_zero, block_rows, masking, photometry and cache
+    report : dict
+        Run report to record the stages in
+
+    """
+    field, band = report['field'], report['band']
+    ext = field_band_dict.get('ext', 0)
+    store_dir = field_band_dict.get('store')
+    block_rows = options.get('block_rows')
+    cache_mode = options.get('cache', 'stat')
+    with instrument.stage(report, 'wht_to_rms'):
+        if options.get('mask') is not None:
+            crude_inputs = [field_band_dict['wht'], options['mask']]
+            crude_params = {'mask': True, 'ext': ext}
+        else:
+            crude_inputs = [field_band_dict['wht']]
+            crude_params = {'wht_zero': str(options.get('wht_zero', 'inf')), 'ext': ext}
+        up_to_date, key = cache.check_stage([field_band_dict['rms_crude']], crude_inputs, crude_params, mode=cache_mode)
+        if not up_to_date:
+            print "Making initial RMS map..."
+            if options.get('mask') is not None:
+                rms.wht_to_rms_mask(field_band_dict['wht'], field_band_dict['rms_crude'], options['mask'], block_rows=block_rows, store_dir=store_dir, ext=ext)
+            else:
+                rms.wht_to_rms(field_band_dict['wht'], field_band_dict['rms_crude'], zero_handle=options.get('wht_zero', 'inf'), block_rows=block_rows, store_dir=store_dir, ext=ext)
+            cache.mark_stage([field_band_dict['rms_crude']], key)
+        else:
+            print "First pass RMS map for field %s band %s is up to date!" % (field, band)
+
+    if 'sci_ext' in field_band_dict and (options.get('masking', 'sextractor') != 'native' or options.get('photometry', 'sextractor') != 'native'):
+        with instrument.stage(report, 'unpack_sci'):
+            up_to_date, key = cache.check_stage([field_band_dict['sci_ext']], [field_band_dict['sci']], {'ext': ext}, mode=cache_mode)
+            if not up_to_date:
+                print "Copying extension %d of the science image for SExtractor..." % ext
+                rms.stream_rows(field_band_dict['sci'], field_band_dict['sci_ext'], lambda block, start, stop: block, block_rows or 1024, store_dir=store_dir, ext=ext)
+                cache.mark_stage([field_band_dict['sci_ext']], key)
+
+def mask_sources(field_band_dict, options, report, sex_params, sex_files):
+    """Runs the stage that masks the sources of a field and band in its segmentation map, crude_segment natively or crude_sextract with SExtractor.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    options : dict
+        Run settings, as for process_band. Uses masking, mask, block_rows, sex_tile_size, sex_tile_overlap, sex_tile_jobs and cache
+    report : dict
+        Run report to record the stage in
+    sex_params, sex_files
+        Config values and files the SExtractor runs depend on, for their cache keys
+
+    """
+    field, band = report['field'], report['band']
+    ext = field_band_dict.get('ext', 0)
+    store_dir = field_band_dict.get('store')
+    cache_mode = options.get('cache', 'stat')
+    if options.get('masking', 'sextractor') == 'native':
+        with instrument.stage(report, 'crude_segment'):
+            # The weight image and mask are left out of the background, so they're inputs too
+            segment_inputs = [field_band_dict['sci'], field_band_dict['rms_crude'], field_band_dict['wht']]
+            if options.get('mask') is not None:
+                segment_inputs.append(options['mask'])
+            up_to_date, key = cache.check_stage([field_band_dict['segmap']], segment_inputs, {'masking': 'native', 'ext': ext}, sex_files, mode=cache_mode)
+            if not up_to_date:
+                print "Masking sources...\n"
+                n_objects = rms.crude_segment(field_band_dict, block_rows=options.get('block_rows'), store_dir=store_dir, mask_fname=options.get('mask'))
+                print "%d sources masked" % n_objects
+                cache.mark_stage([field_band_dict['segmap']], key)
+            else:
+                print "Source mask for field %s band %s is up to date!" % (field, band)
+    else:
+        with instrument.stage(report, 'crude_sextract'):
+            crude_outputs = [field_band_dict['segmap']]
+            if sex_params['profile'] == 'full':
+                crude_outputs.append(field_band_dict['cat_crude'])
+            up_to_date, key = cache.check_stage(crude_outputs, [field_band_dict['sci'], field_band_dict['rms_crude']], sex_params, sex_files, mode=cache_mode)
+            if not up_to_date:
+                print "SExtracting...\n"
+                if options.get('sex_tile_size'):
+                    tiling.crude_SExtract_tiled(field_band_dict, profile=sex_params['profile'], store_dir=store_dir, **tile_options(options))
+                else:
+                    rms.crude_SExtract(field_band_dict, profile=sex_params['profile'])
+                cache.mark_stage(crude_outputs, key)
+            else:
+                print "Crude SExtractor run for field %s band %s is up to date!" % (field, band)
+
+def false_source_files(field_band_dict):
+    """Lists the outputs and inputs of the false_sources stage of a field and band, for its cache key.
+
+    """
+    return [field_band_dict['false_img'], field_band_dict['false_pos']], [field_band_dict['wht'], field_band_dict['segmap']]
+
+def false_catalog_files(field_band_dict, sex_params):
+    """Lists the outputs and inputs of the SExtractor false_photometry stage of a field and band, for its cache key.
+
+    """
+    false_sex_outputs = [field_band_dict['cat_false']]
+    if sex_params['profile'] == 'full':
+        false_sex_outputs.append(field_band_dict['seg_false'])
+    return false_sex_outputs, [field_band_dict['false_img'], field_band_dict['sci'], field_band_dict['rms_crude']]
+
+def make_false_sources(field_band_dict, options, report, false_params, no_sources):
+    """Runs the false_sources stage of a field and band, placing the false sources and making the false source image.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    options : dict
+        Run settings, as for process_band. Uses false_dtype, false_realisations, block_rows, photometry and cache
+    report : dict
+        Run report to record the stage in
+    false_params : dict
+        Config values the false source image depends on, for its cache key
+    no_sources : int
+        Number of false sources per placement
+
+    Returns
+    -------
+    n_placed : int
+        Number of false sources placed
+
+    """
+    field, band = report['field'], report['band']
+    with instrument.stage(report, 'false_sources'):
+        false_outputs, false_inputs = false_source_files(field_band_dict)
+        up_to_date, key = cache.check_stage(false_outputs, false_inputs, false_params, mode=options.get('cache', 'stat'))
+        if not up_to_date:
+            print "Generating false sources..."
+            # Native photometry measures at the positions placed, so its sources needn't be kept apart
+            noise.false_sources(field_band_dict, no_sources=no_sources, dtype=options.get('false_dtype', 'float64'), block_rows=options.get('block_rows'), realisations=options.get('false_realisations', 1),
+                               separate=False if options.get('photometry', 'sextractor') == 'native' else None)
+            cache.mark_stage(false_outputs, key)
+        else:
+            print "False sources image for field %s band %s is up to date!" % (field, band)
+        return len(noise.read_false_positions(field_band_dict)[0])
+
+def false_catalog(field_band_dict, options, report, sex_params, sex_files, back_grid=None):
+    """Runs the false_photometry stage of a field and band, measuring the false sources natively or with SExtractor.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    options : dict
+        Run settings, as for process_band. Uses photometry, mask, sex_catalogs, keep_catalogs, sex_tile_size, sex_tile_overlap, sex_tile_jobs and cache
+    report : dict
+        Run report to record the stage in
+    sex_params, sex_files
+        Config values and files the SExtractor runs depend on, for their cache keys
+    back_grid : numpy array or None
+        Background grid of the science image from earlier native photometry, to save estimating it again
+
+    Returns
+    -------
+    false_cat : numpy array
+        Catalog of the false source photometry, with the REALISATION of each false source if there's more than one
+    back_grid : numpy array or None
+        Background grid of the science image from native photometry
+
+    """
+    field, band = report['field'], report['band']
+    with instrument.stage(report, 'false_photometry'):
+        if options.get('photometry', 'sextractor') == 'native':
+            print "Measuring false source photometry...\n"
+            return noise.false_photometry(field_band_dict, back_grid=back_grid, mask_fname=options.get('mask'))
+
+        # A piped catalog that isn't kept has no file to cache, so it's SExtracted every time
+        pipe = options.get('sex_catalogs', 'file') == 'pipe'
+        keep = not pipe or bool(options.get('keep_catalogs'))
+        false_sex_outputs, false_sex_inputs = false_catalog_files(field_band_dict, sex_params)
+        if keep:
+            up_to_date, key = cache.check_stage(false_sex_outputs, false_sex_inputs, sex_params, sex_files, mode=options.get('cache', 'stat'))
+        else:
+            cache.clear_stage(false_sex_outputs)
+            up_to_date = False
+        false_cat = None
+        if not up_to_date:
+            print "SExtracting false sources...\n"
+            if options.get('sex_tile_size'):
+                false_cat = tiling.catalog_SExtract_tiled(field_band_dict, 'false', profile=sex_params['profile'], store_dir=field_band_dict.get('store'), pipe=pipe,
+                                                          cat_fname=field_band_dict['cat_false'] if keep else None, **tile_options(options))
+            else:
+                false_cat = noise.false_SExtract(field_band_dict, profile=sex_params['profile'], pipe=pipe, keep=keep)
+            if keep:
+                cache.mark_stage(false_sex_outputs, key)
+        else:
+            print "False source catalog for field %s band %s is up to date!" % (field, band)
+        if false_cat is None:
+            false_cat = noise.read_catalog(field_band_dict['cat_false'], sex_profiles.param_fname('false', sex_params['profile'], field_band_dict.get('scratch', '')))
+        if options.get('false_realisations', 1) > 1:
+            false_cat = noise.tag_realisations(false_cat, field_band_dict)
+        return false_cat, None
+
+def false_source_round(field_band_dict, options, report, false_params, sex_params, sex_files, no_sources):
+    """Runs the false_sources and false_photometry stages of a field and band for one count of false sources.
+
+    Parameters
+    ----------
+    field_band_dict, options, report, false_params, no_sources
+        As for make_false_sources
+    sex_params, sex_files
+        As for false_catalog
+
+    Returns
+    -------
+    false_cat : numpy array
+        Catalog of the false source photometry
+    back_grid : numpy array or None
+        Background grid of the science image from native photometry
+    n_placed : int
+        Number of false sources placed
+
+    """
+    n_placed = make_false_sources(field_band_dict, options, report, false_params, no_sources)
+    false_cat, back_grid = false_catalog(field_band_dict, options, report, sex_params, sex_files)
+    return false_cat, back_grid, n_placed
+
+def false_source_batch(field_band_dict, options, report, sex_params, sex_files, no_sources, batch_no, back_grid=None):
+    """Places a further batch of false sources, kept off those already placed, and measures them on their own.
+
+    The batch is rendered into a false source image of its own, so only its sources are measured, and its positions are added to false_pos. The batch's files are removed once it's measured.
+
+    Parameters
+    ----------
+    field_band_dict, options, report, no_sources
+        As for make_false_sources
+    sex_params, sex_files, back_grid
+        As for false_catalog
+    batch_no : int
+        Number of the batch, to name its files
+
+    Returns
+    -------
+    batch_cat : numpy array
+        Catalog of the photometry of the batch's false sources
+
+    Raises
+    ------
+    ValueError
+        If the image doesn't have room for the batch
+
+    """
+    batch_dict = dict(field_band_dict)
+    for key in ('false_img', 'false_pos', 'cat_false', 'seg_false'):
+        base, ext = splitext(field_band_dict[key])
+        batch_dict[key] = '%s_batch%d%s' % (base, batch_no, ext)
+    x_seg, y_seg, realisation = noise.read_false_positions(field_band_dict)
+    try:
+        with instrument.stage(report, 'false_sources'):
+            noise.false_sources(batch_dict, no_sources=no_sources, dtype=options.get('false_dtype', 'float64'), block_rows=options.get('block_rows'), realisations=options.get('false_realisations', 1),
+                                separate=options.get('photometry', 'sextractor') != 'native', exclude=(x_seg, y_seg))
+        # Piped and not kept, so the batch's catalog isn't cached
+        batch_cat = false_catalog(batch_dict, dict(options, sex_catalogs='pipe', keep_catalogs=0), report, sex_params, sex_files, back_grid=back_grid)[0]
+        positions = np.loadtxt(batch_dict['false_pos'], dtype=int, ndmin=2)
+    finally:
+        for key in ('false_img', 'false_pos', 'cat_false', 'seg_false'):
+            if exists(batch_dict[key]):
+                remove(batch_dict[key])
+    pos_file = open(field_band_dict['false_pos'], 'a')
+    np.savetxt(pos_file, positions, fmt='%d')
+    pos_file.close()
+    return batch_cat
+
+def keep_false_rounds(field_band_dict, options, report, false_params, sex_params, sex_files, false_cat):
+    """Saves the false sources of all the rounds of false_source_rounds as the outputs of the false_sources and false_photometry stages, so a rerun finds them up to date.
+
+    The false source image is rendered again with every round's sources, and with SExtractor photometry the joined catalog is written to cat_false if catalogs are kept. With the full SExtractor profile, seg_false is left as the first round's.
+
+    """
+    with instrument.stage(report, 'false_sources'):
+        x_seg, y_seg, realisation = noise.read_false_positions(field_band_dict)
+        sci_header = fits.getheader(field_band_dict['sci'], ext=field_band_dict.get('ext', 0), ignore_missing_end=True)
+        remove(field_band_dict['false_img'])
+        noise.write_false_image(field_band_dict['false_img'], (sci_header['NAXIS2'], sci_header['NAXIS1']), x_seg, y_seg, dtype=options.get('false_dtype', 'float64'), block_rows=options.get('block_rows'))
+        false_outputs, false_inputs = false_source_files(field_band_dict)
+        cache.mark_stage(false_outputs, cache.stage_key(false_inputs, false_params, mode=options.get('cache', 'stat')))
+    if options.get('photometry', 'sextractor') != 'native' and (options.get('sex_catalogs', 'file') != 'pipe' or options.get('keep_catalogs')):
+        with instrument.stage(report, 'false_photometry'):
+            noise.write_ascii_catalog(false_cat, field_band_dict['cat_false'])
+            false_sex_outputs, false_sex_inputs = false_catalog_files(field_band_dict, sex_params)
+            cache.mark_stage(false_sex_outputs, cache.stage_key(false_sex_inputs, sex_params, sex_files, mode=options.get('cache', 'stat')))
+
+def measure_norm_constant(false_cat, options, report):
+    """Runs the norm_constant stage, measuring the norm constant in every aperture of the false source catalog, fitting the noise curve and bootstrapping an interval on the constant.
+
+    The noise curve is recorded in report['noise_curve'] and the interval in report['norm_constant_ci']. With more than one realisation of the false sources, the bootstrap resamples whole realisations and the constant of each is recorded in report['realisations'], along with their spread.
+
+    Parameters
+    ----------
+    false_cat : numpy array
+        Catalog of the false source photometry
+    options : dict
+        Run settings, as for process_band. Uses norm_aperture, norm_fit and bootstrap
+    report : dict
+        Run report to record the stage in
+
+    Returns
+    -------
+    norm_constant : float
+        The constant to normalise by, from the chosen aperture or from the noise curve
+    fal_src_count : int
+        Number of false sources in the catalog
+
+    """
+    aperture = options.get('norm_aperture', noise.NORM_APERTURE)
+    with instrument.stage(report, 'norm_constant'):
+        # Measured in every aperture at once, for the noise curve, with the normalisation from one of them or from the curve
+        aper_consts, fal_src_count = noise.aperture_norm_constants(false_cat)
+        if not 0 < aperture <= len(aper_consts):
+            raise ValueError("No aperture %d to normalise in, the false source catalog has %d" % (aperture, len(aper_consts)))
+        diameters = photometry.phot_apertures()[:len(aper_consts)]
+        alpha, beta = None, None
+        if len(aper_consts) > 1 or options.get('norm_fit'):
+            alpha, beta = noise.fit_noise_curve(diameters, aper_consts)
+        if options.get('norm_fit'):
+            norm_constant = noise.noise_curve_constant(alpha, beta, diameters[aperture-1])
+        else:
+            norm_constant = aper_consts[aperture-1]
+        report['noise_curve'] = {'diameters': diameters.tolist(), 'norm_constants': aper_consts.tolist(), 'alpha': alpha, 'beta': beta,
+                                 'aperture': aperture, 'fit': bool(options.get('norm_fit'))}
+        realisations = None
+        if 'REALISATION' in false_cat.dtype.names and len(np.unique(false_cat['REALISATION'])) > 1:
+            realisations = false_cat['REALISATION']
+            real_consts, real_counts = noise.realisation_norm_constants(false_cat, realisations, aperture=aperture)
+            report['realisations'] = {'norm_constants': real_consts.tolist(), 'sources': real_counts.tolist(), 'spread': float(np.std(real_consts, ddof=1))}
+            print "Normalisation constants of %d realisations: %.4f to %.4f, spread %.4f" % (len(real_consts), real_consts.min(), real_consts.max(), report['realisations']['spread'])
+        if options.get('bootstrap', 1000) and fal_src_count > 1:
+            # Seeded, so a rerun with the same false sources gets the same interval and makes the same decision
+            report['norm_constant_ci'] = list(noise.bootstrap_norm_constant(false_cat, n_boot=options.get('bootstrap', 1000), seed=0, aperture=aperture,
+                                                                            fit_diameters=diameters if options.get('norm_fit') else None, realisations=realisations))
+            print "Normalisation constant %.4f, 95%% interval %.4f to %.4f" % ((norm_constant,) + tuple(report['norm_constant_ci']))
+    return norm_constant, fal_src_count
+
+def false_source_rounds(field_band_dict, options, report, sex_params, sex_files):
+    """Runs rounds of false sources and the norm constant until the constant is known well enough.
+
+    With norm_precision set, a further batch of false sources is placed each round until the 95% interval on the norm constant is narrow enough, max_false_srcs is reached or the image has no room for more. Each batch is kept off the false sources already placed and only it is measured, its catalog being joined on to the earlier rounds', so no round's photometry is wasted. Otherwise there's the one round, of no_false_srcs.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    options : dict
+        Run settings, as for process_band. Uses norm_precision, max_false_srcs, false_realisations and false_dtype, along with those of the stages run
+    report : dict
+        Run report to record the stages in, and the number of false sources placed
+    sex_params, sex_files
+        Config values and files the SExtractor runs depend on, for their cache keys
+
+    Returns
+    -------
+    false_cat : numpy array
+        Catalog of the photometry of every round's false sources
+    back_grid : numpy array or None
+        Background grid of the science image from native photometry
+    norm_constant : float
+        The norm constant, as from measure_norm_constant
+    fal_src_count : int
+        Number of false sources in the catalog
+
+    """
+    precision = options.get('norm_precision')
+    max_srcs = options.get('max_false_srcs', 1000)
+    realisations = options.get('false_realisations', 1)
+    no_sources = field_band_dict['no_false_srcs']
+    false_params = {'dtype': str(options.get('false_dtype', 'float64')), 'realisations': realisations}
+    if precision:
+        false_params.update(adaptive_start=no_sources, precision=precision, max_srcs=max_srcs)
+    else:
+        false_params.update(no_sources=no_sources)
+    false_cat, back_grid, n_placed = false_source_round(field_band_dict, options, report, false_params, sex_params, sex_files, no_sources)
+    norm_constant, fal_src_count = measure_norm_constant(false_cat, options, report)
+    n_batches = 0
+    for batch_no in range(1, MAX_ADAPTIVE_ROUNDS):
+        if not precision or report['norm_constant_ci'] is None:
+            break
+        rel_width = (report['norm_constant_ci'][1] - report['norm_constant_ci'][0]) / (2 * norm_constant)
+        if rel_width <= precision or n_placed >= max_srcs:
+            break
+        batch_sources = max((min(noise.sources_needed(n_placed, rel_width, precision), max_srcs) - n_placed) // realisations, 1)
+        print "Interval is +/-%.1f%%, placing %d more false sources to reach +/-%.1f%%" % (100 * rel_width, batch_sources * realisations, 100 * precision)
+        try:
+            batch_cat = false_source_batch(field_band_dict, options, report, sex_params, sex_files, batch_sources, batch_no, back_grid=back_grid)
+        except ValueError as err:
+            # No room for the extra false sources, so make do with those already measured
+            print 'ValueError: %s' % err
+            break
+        false_cat = np.concatenate((false_cat, batch_cat))
+        if 'NUMBER' in false_cat.dtype.names:
+            false_cat['NUMBER'] = np.arange(1, len(false_cat) + 1)
+        n_placed += batch_sources * realisations
+        n_batches += 1
+        norm_constant, fal_src_count = measure_norm_constant(false_cat, options, report)
+    if n_batches:
+        keep_false_rounds(field_band_dict, options, report, false_params, sex_params, sex_files, false_cat)
+    report['false_sources'] = n_placed
+    return false_cat, back_grid, norm_constant, fal_src_count
+
+def measure_norm_grid(field_band_dict, false_cat, options, report):
+    """Runs the norm_grid stage, measuring a norm constant in each tile of the image for a spatially varying normalisation.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    false_cat : numpy array
+        Catalog of the false source photometry
+    options : dict
+        Run settings, as for process_band. Uses norm_tile_size and norm_aperture
+    report : dict
+        Run report to record the stage in
+
+    Returns
+    -------
+    norm_grid : numpy array or None
+        Norm constant of each tile, or None without norm_tile_size
+
+    """
+    tile_size = options.get('norm_tile_size')
+    if not tile_size:
+        return None
+    with instrument.stage(report, 'norm_grid'):
+        rms_header = fits.getheader(field_band_dict['rms_crude'], ignore_missing_end=True)
+        norm_grid, tile_counts = noise.tiled_norm_constants(false_cat, (rms_header['NAXIS2'], rms_header['NAXIS1']), tile_size=tile_size, aperture=options.get('norm_aperture', noise.NORM_APERTURE))
+        print "Normalisation constants of %d x %d tiles: %.4f to %.4f" % (norm_grid.shape[0], norm_grid.shape[1], norm_grid.min(), norm_grid.max())
+    return norm_grid
+
+def normalise(field_band_dict, options, report, norm_constant, norm_grid=None):
+    """Runs the normalise stage of a field and band, multiplying the crude RMS map by the norm constant, or by the grid of constants, into rms_norm.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    options : dict
+        Run settings, as for process_band. Uses norm_tile_size, block_rows and cache
+    report : dict
+        Run report to record the stage in, with the noise curve to write to the map's header
+    norm_constant : float
+        The norm constant
+    norm_grid : numpy array or None
+        Norm constant of each tile, as from measure_norm_grid, used in place of norm_constant if given
+
+    """
+    field, band = report['field'], report['band']
+    tile_size = options.get('norm_tile_size')
+    with instrument.stage(report, 'normalise'):
+        if norm_grid is None:
+            norm_params = {'norm_constant': repr(norm_constant)}
+        else:
+            norm_params = {'norm_grid': [repr(const) for const in norm_grid.ravel()], 'tile_size': tile_size}
+        norm_keywords = noise.noise_curve_keywords(report['noise_curve'])
+        norm_params['keywords'] = repr(norm_keywords)
+        up_to_date, key = cache.check_stage([field_band_dict['rms_norm']], [field_band_dict['rms_crude']], norm_params, mode=options.get('cache', 'stat'))
+        if not up_to_date:
+            print "Creating normalised RMS map..."
+            rms.norm_rms_map(field_band_dict['rms_crude'], field_band_dict['rms_norm'], norm_constant if norm_grid is None else norm_grid, block_rows=options.get('block_rows'), store_dir=field_band_dict.get('store'), tile_size=tile_size, keywords=norm_keywords)
+            cache.mark_stage([field_band_dict['rms_norm']], key)
+        else:
+            print "Normalised RMS map for field %s band %s is up to date!" % (field, band)
+
+def verify(field_band_dict, options, report, sex_params, false_cat, back_grid, norm_constant, norm_grid=None):
+    """Runs the verify stage of a field and band, checking the normalised RMS map against the noise of the false sources.
+
+    By default the check is predicted from the false source catalog, without measuring the sources again. With strict_verify they're measured again against the normalised map, natively or by SExtractor as the false sources were. Either way it's measured from the same false sources as the norm constant, so it checks that the map was scaled as intended rather than giving an independent measure of the noise (see noise.predicted_norm_constant).
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    options : dict
+        Run settings, as for process_band. Uses strict_verify, photometry, mask, sex_catalogs, keep_catalogs, sex_tile_size, sex_tile_overlap, sex_tile_jobs, norm_tile_size and norm_aperture
+    report : dict
+        Run report to record the stage in
+    sex_params : dict
+        Config values of the SExtractor runs
+    false_cat : numpy array
+        Catalog of the false source photometry
+    back_grid : numpy array or None
+        Background grid of the science image from native photometry, to reuse
+    norm_constant : float
+        The norm constant
+    norm_grid : numpy array or None
+        Norm constant of each tile, as from measure_norm_grid
+
+    Returns
+    -------
+    test_norm : float
+        noise_measured / noise_estimated of the false sources with the normalised map, 1 for a perfect normalisation
+
+    """
+    aperture = options.get('norm_aperture', noise.NORM_APERTURE)
+    with instrument.stage(report, 'verify'):
+        if not options.get('strict_verify'):
+            source_norms = norm_constant
+            if norm_grid is not None:
+                source_norms = noise.norm_constants_at(norm_grid, options['norm_tile_size'], false_cat['X_IMAGE'], false_cat['Y_IMAGE'])
+            test_norm, test_count = noise.predicted_norm_constant(false_cat, source_norms, gain=float(field_band_dict['gain']), aperture=aperture)
+        elif options.get('photometry', 'sextractor') == 'native':
+            test_cat, back_grid = noise.false_photometry(field_band_dict, rms_key='rms_norm', back_grid=back_grid, mask_fname=options.get('mask'))
+            test_norm, test_count = noise.rms_norm_constant(test_cat, aperture) if norm_grid is None else noise.normalised_scatter(test_cat, aperture)
+        elif options.get('sex_tile_size'):
+            test_cat = tiling.catalog_SExtract_tiled(field_band_dict, 'test', profile=sex_params['profile'], store_dir=field_band_dict.get('store'), pipe=options.get('sex_catalogs', 'file') == 'pipe', **tile_options(options))
+            test_norm, test_count = noise.rms_norm_constant(test_cat, aperture) if norm_grid is None else noise.normalised_scatter(test_cat, aperture)
+        elif options.get('sex_catalogs', 'file') == 'pipe':
+            test_cat = noise.test_SExtract(field_band_dict, profile=sex_params['profile'], pipe=True, keep=bool(options.get('keep_catalogs')))
+            test_norm, test_count = noise.rms_norm_constant(test_cat, aperture) if norm_grid is None else noise.normalised_scatter(test_cat, aperture)
+        else:
+            noise.test_SExtract(field_band_dict, profile=sex_params['profile'])
+            test_cat = field_band_dict.get('test_cat', 'test.cat')
+            test_norm, test_count = noise.rms_norm_constant(test_cat, aperture) if norm_grid is None else noise.normalised_scatter(test_cat, aperture)
+            remove(test_cat)
+    return test_norm
+
+def process_band(task):
+    """Runs every stage of the RMS normalisation for one field and band.
+
+    Parameters
+    ----------
+    task : tuple
+        (field, band, field_band_dict, options), as from band_tasks. options is a dict of the run settings listed below, all of which may be left out
+
+    Other Parameters
+    ----------------
+    wht_zero : str 'inf' or '100'
+        RMS given to zero weight pixels when there's no mask, see rms_tools.wht_to_rms
+    mask : str or None
+        Filename of the field's bad pixel mask, see field_mask
+    block_rows : int or None
+        Number of image rows to stream through memory at once. None loads whole images
+    false_dtype : str
+        Data type of the false source image
+    photometry : str 'sextractor' or 'native'
+        How the false sources are measured
+    masking : str 'sextractor' or 'native'
+        Whether the segmentation map comes from the crude SExtractor run or is made in-process with segmentation.py
+    sex_profile : str 'lean' or 'full'
+        SExtractor profile of the runs, see sex_profiles.py
+    sex_catalogs : str 'file' or 'pipe'
+        Whether SExtractor's catalogs are read from file or straight from its output
+    keep_catalogs : bool
+        Whether piped catalogs are written to file as well
+    strict_verify : bool
+        Measure the false sources again against the normalised map, rather than predicting the check from their catalog
+    cache : str 'stat' or 'checksum'
+        How to tell whether a stage's inputs have changed, see cache.file_identity
+    norm_tile_size : int or None
+        Tile size in pixels for a spatially varying normalisation. None for a single constant
+    false_realisations : int
+        Placements of the false sources to render into the one false image
+    bootstrap : int
+        Number of bootstrap resamples for the interval on the norm constant, 0 for none
+    norm_precision : float or None
+        Relative half width of the interval to adapt the false source count to. None for a fixed count
+    max_false_srcs : int
+        Most false sources an adaptive count may place
+    norm_aperture : int
+        Aperture to normalise in, counting from 1
+    norm_fit : bool
+        Take the constant from the noise curve fitted over all the apertures, see noise.fit_noise_curve
+    sex_tile_size, sex_tile_overlap, sex_tile_jobs : int or None
+        Run SExtractor on overlapping tiles of this size, that many at once, see tiling.py. None for the whole frame
+
+    Returns
+    -------
+    report : dict
+        Run report of the field and band from instrument.new_report, with the cost of each stage, the norm constant and its bootstrap interval, the noise curve, and the flags raised (empty if there were none)
+
+    """
+    field, band, field_band_dict, options = task
+    ext = field_band_dict.get('ext', 0)
+    report = instrument.new_report(field, band, field_band_dict.get('ext'))
+    flags = ''
+    if 'scratch' in field_band_dict and not exists(field_band_dict['scratch']):
+        makedirs(field_band_dict['scratch'])
+    if field_band_dict.get('store') is not None:
+        store.make_store(field_band_dict['store'])
+    try:
+        print "\n\n****************\n****************\nField %s, band %s%s : \n" % (field, band, ', extension %d' % ext if ext else '')
+        sex_files = cache.sex_config_files()
+        read_gain(field_band_dict)
+        crude_rms(field_band_dict, options, report)
+
+        sex_params = {'gain': str(field_band_dict['gain']), 'magz': str(field_band_dict['magz']), 'profile': options.get('sex_profile', 'lean')}
+        if options.get('sex_tile_size'):
+            sex_params['tiles'] = [options['sex_tile_size'], options.get('sex_tile_overlap', 128)]
+        mask_sources(field_band_dict, options, report, sex_params, sex_files)
+
+        false_cat, back_grid, norm_constant, fal_src_count = false_source_rounds(field_band_dict, options, report, sex_params, sex_files)
+        if options.get('norm_precision') and report['norm_constant_ci'] is not None:
+            rel_width = (report['norm_constant_ci'][1] - report['norm_constant_ci'][0]) / (2 * norm_constant)
+            if rel_width > options['norm_precision']:
+                flags = flags + ' normprec:%.4f ' % rel_width
+
+        norm_grid = measure_norm_grid(field_band_dict, false_cat, options, report)
+        report['norm_constant'] = norm_constant
+        if norm_grid is not None:
+            report['norm_grid'] = norm_grid.tolist()
+        print "%d false sources SExtracted.\n" % fal_src_count
+        print "Calculating normalisation constant..."
+
+        if not fal_src_count == report['false_sources']:
+            flags = flags + ' falsecount '
+
+        normalise(field_band_dict, options, report, norm_constant, norm_grid)
+        test_norm = verify(field_band_dict, options, report, sex_params, false_cat, back_grid, norm_constant, norm_grid)
+
+        print "noise_measured / noise_estimated = ", test_norm
+
+        # A constant from the noise curve isn't meant to match the aperture's own measurement, only to be off from it by the fit's residual
+        expected_norm = 1.
+        if options.get('norm_fit') and norm_grid is None:
+            expected_norm = report['noise_curve']['norm_constants'][report['noise_curve']['aperture']-1] / norm_constant
+        if not 0.99 < test_norm / expected_norm < 1.001:
+            flags = flags + ' normacc:' + str(test_norm) + ' '
+    except IOError:
+        print 'IOError!!'
+        flags = flags + ' ERROR:IOError '
+    except ValueError as err:
+        print 'ValueError: %s' % err
+        flags = flags + ' ERROR:ValueError '
+    except CalledProcessError as err:
+        print 'SExtractor failed for field %s band %s with exit status %d' % (field, band, err.returncode)
+        if err.output:
+            print err.output
+        flags = flags + ' ERROR:SExtractor:%d ' % err.returncode
+
+    report['flags'] = flags
+    return report
+
+def run_tasks(tasks, jobs=1, memory_budget=None):
+    """Runs a list of tasks through process_band, keeping up to jobs of them running at once.
+
+    Parameters
+    ----------
+    tasks : list
+        Tasks as from band_tasks
+    jobs : int or None
+        Number of worker processes. None is one per CPU with a memory budget, or 1 without
+    memory_budget : int or None
+        If given, memory in MB the running tasks must fit in, by their estimates from scheduler.task_memory. Tasks are then started largest first, as many at a time as the budget allows, up to jobs
+
+    Returns
+    -------
+    flagged_imgs : list
+        A 'field_band flags' entry for each task that raised flags, ready for rms_config.write_flags
+    reports : list
+        The run report of each task, sorted by field and band. With a memory budget, each has the task's estimate in memory_estimate_kb
+
+    """
+    if not memory_budget:
+        jobs = jobs or 1
+    if memory_budget:
+        reports, estimates = scheduler.run_within_budget(process_band, tasks, memory_budget * 1024**2, jobs=jobs)
+        for report, estimate in zip(reports, estimates):
+            report['memory_estimate_kb'] = estimate // 1024
+    elif jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            reports = list(pool.imap_unordered(process_band, tasks, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        reports = [process_band(task) for task in tasks]
+
+    reports.sort(key=lambda report: (report['field'], report['band'], report.get('ext')))
+    return flag_entries(reports), reports
+
+def flag_entries(reports):
+    """Makes a 'field_band flags' entry for each report that raised flags, ready for rms_config.write_flags.
+
+    """
+    flagged_imgs = []
+    for report in reports:
+        if not report['flags'] == '':
+            flagged_imgs.append(report['field']+'_'+report['band']+('_ext%d' % report['ext'] if report.get('ext') is not None else '')+report['flags'])
+    return flagged_imgs
+
+def merge_extensions(tasks, reports, cache_mode='stat'):
+    """Puts the normalised RMS maps of the extensions of each multi-extension field and band back together into the band's rms_norm, laid out like its weight image.
+
+    Each extension's norm constant is written to its NORMCONS header keyword, and its 95% interval to NORMCILO and NORMCIHI.
+
+    Parameters
+    ----------
+    tasks : list
+        Tasks as from band_tasks
+    reports : list
+        Their run reports, as from run_tasks. An extension without a report, e.g. from a queue unit that hasn't finished, counts as failed
+    cache_mode : str 'stat' or 'checksum'
+        How to tell whether the extensions' maps have changed, see cache.file_identity
+
+    Returns
+    -------
+    flagged_imgs : list
+        A 'field_band flags' entry for each field and band that couldn't be put together because an extension failed
+
+    """
+    ext_tasks = {}
+    for field, band, field_band_dict, options in tasks:
+        if 'ext' in field_band_dict:
+            ext_tasks.setdefault((field, band), []).append(field_band_dict)
+    ext_reports = dict(((report['field'], report['band'], report.get('ext')), report) for report in reports)
+
+    flagged_imgs = []
+    for (field, band), ext_dicts in sorted(ext_tasks.items()):
+        ext_fnames = dict((ext_dict['ext'], ext_dict['rms_norm']) for ext_dict in ext_dicts)
+        failed = [ext for ext in sorted(ext_fnames) if (field, band, ext) not in ext_reports or ext_reports[(field, band, ext)]['norm_constant'] is None or not exists(ext_fnames[ext])]
+        if failed:
+            print "Not putting together the RMS map of field %s band %s, extensions %s failed" % (field, band, ','.join(str(ext) for ext in failed))
+            flagged_imgs.append('%s_%s ERROR:MEF:%s ' % (field, band, ','.join(str(ext) for ext in failed)))
+            continue
+
+        keywords = {}
+        for ext in ext_fnames:
+            report = ext_reports[(field, band, ext)]
+            keywords[ext] = [('NORMCONS', report['norm_constant'], 'RMS normalisation constant')]
+            if report['norm_constant_ci'] is not None:
+                keywords[ext] += [('NORMCILO', report['norm_constant_ci'][0], 'lower end of 95% interval on NORMCONS'),
+                                  ('NORMCIHI', report['norm_constant_ci'][1], 'upper end of 95% interval on NORMCONS')]
+            if report.get('noise_curve') is not None:
+                keywords[ext] += noise.noise_curve_keywords(report['noise_curve'])
+        out_fname = ext_dicts[0]['rms_mef']
+        up_to_date, key = cache.check_stage([out_fname], [ext_fnames[ext] for ext in sorted(ext_fnames)], {'keywords': repr(sorted(keywords.items()))}, mode=cache_mode)
+        if not up_to_date:
+            print "Putting together the RMS map of field %s band %s from %d extensions..." % (field, band, len(ext_fnames))
+            mef.write_mef(ext_fnames, ext_dicts[0]['wht'], out_fname, keywords)
+            cache.mark_stage([out_fname], key)
+        else:
+            print "RMS map of field %s band %s is up to date!" % (field, band)
+    return flagged_imgs
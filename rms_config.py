@@ -1,6 +1,5 @@
 from os import listdir, makedirs
-from astropy.io import fits
-from os.path import exists
+from os.path import exists, splitext
 
 # #### BORG z8 #### #
 # print "Config: Using BoRG z8 zeropoints"
@@ -13,7 +12,6 @@ from os.path import exists
 # }
 
 # #### BORG z9 #### #
-print "Config: Using BoRG z9 zeropoints"
 magzeros = {
 'F105':26.2687,
 'F125':26.2303,
@@ -51,6 +49,8 @@ def read_list(list_fname):
 def auto_config(config_file='detection.config'):
     """Reads in config file and determines various setup variable from that.
 
+    Nothing is created on disk here, use make_dirs once the output directories are needed.
+
     Parameters
     ----------
     config_file : str
@@ -71,8 +71,6 @@ def auto_config(config_file='detection.config'):
     for item in config_list:
         [key, val] = item.split('=')
         config_dict[key] = val
-        if key[-3:] == 'dir' and not exists(val):
-            makedirs(val)
 
     bands = config_dict['master_bands'].split(',')
     config_dict['master_bands'] = bands
@@ -81,9 +79,41 @@ def auto_config(config_file='detection.config'):
         bands = config_dict['make_bands'].split(',')
         config_dict['make_bands'] = bands
 
+    for key in ('block_rows', 'norm_tile_size', 'no_false_srcs', 'false_realisations', 'bootstrap', 'max_false_srcs', 'keep_catalogs', 'memory_budget', 'norm_aperture', 'norm_fit', 'sex_tile_size', 'sex_tile_overlap', 'sex_tile_jobs'):
+        if key in config_dict:
+            config_dict[key] = int(config_dict[key])
+
+    if 'norm_precision' in config_dict:
+        config_dict['norm_precision'] = float(config_dict['norm_precision'])
+
     return config_dict
 
-config_dict = auto_config()
+_loaded_configs = {}
+
+def load_config(config_file='detection.config'):
+    """Reads a config file with auto_config the first time it's asked for, and returns the same config_dict after that.
+
+    Parameters
+    ----------
+    config_file : str
+        Filename of the config file
+
+    Returns
+    -------
+    config_dict : dict
+
+    """
+    if config_file not in _loaded_configs:
+        _loaded_configs[config_file] = auto_config(config_file)
+    return _loaded_configs[config_file]
+
+def make_dirs(config_dict):
+    """Creates every directory in the config ('*dir' keys) that doesn't exist yet.
+
+    """
+    for key in sorted(config_dict):
+        if key[-3:] == 'dir' and not exists(config_dict[key]):
+            makedirs(config_dict[key])
 
 def field_band_list(fields, data_dir, master_bands=['f606w', 'f600lp', 'f098m', 'f125w', 'f160w']):
     """Takes a list of fields and science files and identifies which fields are present with which bands.
@@ -118,13 +148,17 @@ def field_band_list(fields, data_dir, master_bands=['f606w', 'f600lp', 'f098m',
 
     return field_data
 
-def full_filename_list_z8(field_data):
+def full_filename_list_z8(field_data, config_dict=None):
     """Finds and generates various filenames that will come in handy later
 
+    The gain (the exposure time of the science image) isn't read here, pipeline.read_gain fills it in when the field and band is processed.
+
     Parameters
     ----------
     field_data : dict
         The dict that we're collecting values relevant to our field in
+    config_dict : dict or None
+        Config from load_config. Defaults to detection.config
 
     Returns
     -------
@@ -132,6 +166,8 @@ def full_filename_list_z8(field_data):
         With new entries.
 
     """
+    if config_dict is None:
+        config_dict = load_config()
     sci_dir = config_dict['sci_dir']
     wht_dir = config_dict['wht_dir']
     rms_crude_dir = config_dict['rms_crude_dir']
@@ -161,26 +197,26 @@ def full_filename_list_z8(field_data):
             band_dict['segmap'] = seg_crude_dir + field + '_' + band + '_seg_crude.fits'
             band_dict['seg_false'] = fake_dir + field + '_' + band + '_seg_false.fits'
             band_dict['false_img'] = fake_dir + field + '_' + band + '_false_sources.fits'
+            band_dict['false_pos'] = fake_dir + field + '_' + band + '_false_sources.pos'
 
-            band_dict['no_false_srcs'] = 100
+            band_dict['no_false_srcs'] = config_dict.get('no_false_srcs', 100)
             band_dict['magz'] = magzeros[band]
 
-            hdu_list = fits.open(band_dict['sci'])
-            exptime = hdu_list[0].header['exptime']
-            hdu_list.close()
-            band_dict['gain'] = exptime
-
             field_data[field][band] = band_dict
 
     return field_data
 
-def full_filename_list_z9(field_data):
+def full_filename_list_z9(field_data, config_dict=None):
     """Finds and generates various filenames that will come in handy later
 
+    The gain (the exposure time of the science image) isn't read here, pipeline.read_gain fills it in when the field and band is processed.
+
     Parameters
     ----------
     field_data : dict
         The dict that we're collecting values relevant to our field in
+    config_dict : dict or None
+        Config from load_config. Defaults to detection.config
 
     Returns
     -------
@@ -188,6 +224,8 @@ def full_filename_list_z9(field_data):
         With new entries.
 
     """
+    if config_dict is None:
+        config_dict = load_config()
     data_dir = config_dict['data_dir']
     rms_crude_dir = config_dict['rms_crude_dir']
     rms_final_dir = config_dict['rms_final_dir']
@@ -208,32 +246,30 @@ def full_filename_list_z9(field_data):
             band_dict['segmap'] = seg_crude_dir + field + '_' + band + '_seg_crude.fits'
             band_dict['seg_false'] = fake_dir + field + '_' + band + '_seg_false.fits'
             band_dict['false_img'] = fake_dir + field + '_' + band + '_false_sources.fits'
+            band_dict['false_pos'] = fake_dir + field + '_' + band + '_false_sources.pos'
 
-            band_dict['no_false_srcs'] = 100
+            band_dict['no_false_srcs'] = config_dict.get('no_false_srcs', 100)
             band_dict['magz'] = magzeros[band]
 
-            hdu_list = fits.open(band_dict['sci'])
-            exptime = hdu_list[0].header['exptime']
-            hdu_list.close()
-            band_dict['gain'] = exptime
-
             field_data[field][band] = band_dict
 
     return field_data
 
-def write_flags(flagged_imgs, flag_log_fname=config_dict['flag_log'], verbose=True):
+def write_flags(flagged_imgs, flag_log_fname=None, verbose=True):
     """Writes a log of the flagged imaages from the RMS normalisation.
 
     Parameters
     ----------
     flagged_imgs : list
         A list of the flagged images to be written to file
-    flag_log_fname : str
-        Filename of the output file
+    flag_log_fname : str or None
+        Filename of the output file. Defaults to flag_log of detection.config
     verbose : bool
         Set True to print to console output as well
 
     """
+    if flag_log_fname is None:
+        flag_log_fname = load_config()['flag_log']
     log_file = open(flag_log_fname, 'w')
     log_file.truncate()
 
@@ -246,3 +282,23 @@ def write_flags(flagged_imgs, flag_log_fname=config_dict['flag_log'], verbose=Tr
         log_file.write(flag_img + '\n')
 
     log_file.close()
+
+def report_fnames(config_dict=None):
+    """Gets the filenames of the JSON and CSV run reports.
+
+    They're named by 'report' in the config file, or put next to the flag log if that isn't given.
+
+    Parameters
+    ----------
+    config_dict : dict or None
+        Config from load_config. Defaults to detection.config
+
+    Returns
+    -------
+    json_fname, csv_fname : str
+
+    """
+    if config_dict is None:
+        config_dict = load_config()
+    report_base = config_dict.get('report', splitext(config_dict['flag_log'])[0] + '_report')
+    return report_base + '.json', report_base + '.csv'
@@ -1,8 +1,179 @@
 import numpy as np
 from astropy.io import fits
-from subprocess import check_call
+from astropy.io.fits.hdu.base import DTYPE2BITPIX
+from os import remove
+from os.path import basename, exists
+from subprocess import CalledProcessError, PIPE, Popen, STDOUT, check_call
+import mef
+import photometry
+import segmentation
+import sex_profiles
+import store
+
+def _zero_value(zero_handle):
+    """Interprets the zero_handle argument, returning the RMS value to use for zero weight pixels or None for 1/0 = inf.
 
-def wht_to_rms(wht_fname, rms_fname, zero_handle='inf'):
+    """
+    if zero_handle == 'inf':
+        return None
+    try:
+        return float(zero_handle)
+    except ValueError:
+        return None
+
+def rms_from_wht(weight_data, zero_handle='inf'):
+    """Converts an array of weights into RMS values (1/sqrt(|x|)) in place.
+
+    Parameters
+    ----------
+    weight_data : numpy array
+        Weight values, overwritten with the RMS values
+    zero_handle : str 'inf' or '100'
+        What to put in the RMS map for a value of 0 in the wht map
+
+    Returns
+    -------
+    weight_data : numpy array
+        The same array, now holding RMS values
+
+    """
+    big_num = _zero_value(zero_handle)
+    with np.errstate(divide='ignore'):
+        rms_data = 1/np.sqrt(np.absolute(weight_data))
+    if big_num is not None:
+        rms_data[weight_data == 0] = big_num
+    weight_data[...] = rms_data
+    return weight_data
+
+def mask_rms(rms_data, mask, bad_rms=100):
+    """Overwrites the RMS of pixels flagged in a bad pixel mask, in place.
+
+    Parameters
+    ----------
+    rms_data : numpy array
+        RMS values
+    mask : numpy array
+        Array the shape of rms_data with non-zero values corresponding to bad pixels, e.g. from bad_pixel_bitmask
+    bad_rms : float
+        RMS value given to the bad pixels
+
+    """
+    rms_data[mask != 0] = bad_rms
+    return rms_data
+
+def scale_rms(rms_data, norm_const):
+    """Multiplies an RMS array by a normalisation constant in place.
+
+    The product is taken in double precision before being stored back in the array's own type.
+
+    """
+    rms_data[...] = np.multiply(rms_data, norm_const, dtype=np.float64)
+    return rms_data
+
+def norm_surface(norm_grid, tile_size, start, stop, n_cols):
+    """Evaluates a grid of normalisation constants on the image rows start to stop, interpolating bilinearly between the tile centres as photometry.background_at does.
+
+    The grid rows are interpolated along the image columns first, so each image row is then only a blend of two of them.
+
+    Parameters
+    ----------
+    norm_grid : numpy array
+        Normalisation constant of each tile, e.g. from noise.tiled_norm_constants
+    tile_size : int
+        Size of each tile in pixels
+    start, stop : int
+        Row bounds of the strip of the image
+    n_cols : int
+        Number of columns in the image
+
+    Returns
+    -------
+    surface : numpy array
+        The normalisation constant of each pixel of the strip
+
+    """
+    n_tiles_y = norm_grid.shape[0]
+    centres = (np.arange(n_tiles_y) + 0.5) * tile_size - 0.5
+    grid_rows = photometry.background_at(norm_grid, np.arange(n_cols)[np.newaxis, :], centres[:, np.newaxis], tile_size)
+    gy = np.clip((np.arange(start, stop) + 0.5) / float(tile_size) - 0.5, 0, n_tiles_y - 1)
+    y0 = np.minimum(np.floor(gy).astype(int), max(n_tiles_y - 2, 0))
+    y1 = np.minimum(y0 + 1, n_tiles_y - 1)
+    fy = (gy - y0)[:, np.newaxis]
+    return (1 - fy) * grid_rows[y0] + fy * grid_rows[y1]
+
+def scale_rms_tiled(rms_data, norm_grid, tile_size, start=0):
+    """Multiplies a strip of an RMS map, starting at row start of the image, by the interpolated surface of a grid of normalisation constants in place.
+
+    """
+    surface = norm_surface(norm_grid, tile_size, start, start + rms_data.shape[0], rms_data.shape[1])
+    rms_data[...] = np.multiply(rms_data, surface, dtype=np.float64)
+    return rms_data
+
+def row_blocks(n_rows, block_rows):
+    """Splits the rows of an image into strips of at most block_rows rows.
+
+    Yields
+    ------
+    start, stop : int
+        Row bounds of each strip
+
+    """
+    for start in range(0, n_rows, block_rows):
+        yield start, min(start + block_rows, n_rows)
+
+def stream_rows(in_fname, out_fname, block_func, block_rows, store_dir=None, ext=0, keywords=None):
+    """Applies a function to row strips of a .fits image, writing each strip to the output as soon as it's made.
+
+    The input is read through a memory map one strip at a time and the output is written with a StreamingHDU, so only a single strip of data is ever held in memory.
+
+    Parameters
+    ----------
+    in_fname, out_fname : str
+        Filenames of the input image and the output image. The output must NOT already be a file
+    block_func : function
+        Called as block_func(block, start, stop) on each strip of rows, returning the output strip
+    block_rows : int
+        Number of image rows per strip
+    store_dir : str or None
+        If given, read the input through the field's store (see store.py) instead of from the FITS file
+    ext : int
+        Index of the image HDU of the input to read, for multi-extension files. The output is always a single image file
+    keywords : list or None
+        (key, value, comment) cards to add to the output header
+
+    """
+    if exists(out_fname):
+        raise IOError("%s already exists." % out_fname)
+
+    hdu_list = fits.open(in_fname, memmap=True, ignore_missing_end=True)
+    in_hdu = hdu_list[ext]
+    in_rows = in_hdu.section if store_dir is None else store.image_data(in_fname, store_dir, ext)
+    out_hdu = None
+    try:
+        for start, stop in row_blocks(in_hdu.header['NAXIS2'], block_rows):
+            block = block_func(np.array(in_rows[start:stop]), start, stop)
+            if out_hdu is None:
+                header = mef.primary_header(in_hdu.header)
+                header['filename'] = out_fname
+                header['BITPIX'] = DTYPE2BITPIX[block.dtype.name]
+                header.remove('BSCALE', ignore_missing=True)
+                header.remove('BZERO', ignore_missing=True)
+                for key, value, comment in (keywords or []):
+                    header[key] = (value, comment)
+                out_hdu = fits.StreamingHDU(out_fname, header)
+            out_hdu.write(block)
+    except Exception:
+        # Don't leave a truncated file behind to be mistaken for a finished one
+        if out_hdu is not None:
+            out_hdu.close()
+            remove(out_fname)
+        raise
+    finally:
+        hdu_list.close()
+    if out_hdu is not None:
+        out_hdu.close()
+
+def wht_to_rms(wht_fname, rms_fname, zero_handle='inf', block_rows=None, store_dir=None, ext=0):
     """Reads in data from a .fits weight map and makes an RMS map where each pixel is 1/sqrt(x) of the value x in the weight map.
 
     Parameters
@@ -11,32 +182,41 @@ def wht_to_rms(wht_fname, rms_fname, zero_handle='inf'):
         Filenames of the input weight map file and the output RMS file. The RMS file must NOT already be a file
     zero_handle : str 'inf' or '100'
         What to put in the RMS map for a value of 0 in the wht map
+    block_rows : int or None
+        If given, stream the map through memory in strips of this many rows rather than loading it whole
+    store_dir : str or None
+        If given, read the input through the field's store (see store.py) instead of from the FITS file
+    ext : int
+        Index of the image HDU of the input to read, for multi-extension files. The output is always a single image file
 
     Returns
     -------
     RMS map .fits file
 
     """
+    if block_rows:
+        if exists(rms_fname):
+            print "Error: Unable to write to file. %s already exists." % rms_fname
+            print "Try again with new output filename."
+            return None
+        stream_rows(wht_fname, rms_fname, lambda block, start, stop: rms_from_wht(block, zero_handle), block_rows, store_dir=store_dir, ext=ext)
+        return None
+
     hdu_list = fits.open(wht_fname, ignore_missing_end=True)
+    if ext:
+        # Just the one extension, as an image of its own
+        ext_header = mef.primary_header(hdu_list[ext].header)
+        ext_data = np.array(hdu_list[ext].data if store_dir is None else store.image_data(wht_fname, store_dir, ext))
+        hdu_list.close()
+        hdu_list = fits.HDUList([fits.PrimaryHDU(ext_data, header=ext_header)])
+    elif store_dir is not None:
+        hdu_list[0].data = np.array(store.image_data(wht_fname, store_dir))
     weight_data = hdu_list[0].data
 
     # Changes the header of the new fits file to match the filename
     hdu_list[0].header['filename'] = rms_fname
 
-    if zero_handle == 'inf':
-        for x in np.nditer(weight_data, op_flags = ['readwrite']):
-            x[...] = 1/np.sqrt(np.absolute(x))
-    else:
-        try:
-            big_num = float(zero_handle)
-            for x in np.nditer(weight_data, op_flags = ['readwrite']):
-                if not x == 0:
-                    x[...] = 1/np.sqrt(np.absolute(x))
-                else:
-                    x[...] = big_num
-        except ValueError:
-            for x in np.nditer(weight_data, op_flags = ['readwrite']):
-                x[...] = 1/np.sqrt(np.absolute(x))
+    rms_from_wht(weight_data, zero_handle)
 
     try:
         hdu_list.writeto(rms_fname)
@@ -48,41 +228,62 @@ def wht_to_rms(wht_fname, rms_fname, zero_handle='inf'):
 
     return None
 
-def wht_to_rms_mask(wht_fname, rms_fname, mask):
+def wht_to_rms_mask(wht_fname, rms_fname, mask, block_rows=None, store_dir=None, ext=0):
     """Reads in data from a .fits weight map and makes an RMS map where each pixel is 1/sqrt(x) of the value x in the weight map.
 
     Parameters
     ----------
     wht_fname, rms_fname : str
         Filenames of the input weight map file and the output RMS file. The RMS file must NOT already be a file
-    mask : numpy array
-        Array the shape of the wht map with positive values corresponding to bad pixels
-    zero_handle : str 'inf' or '100'
-        What to put in the RMS map for a value of 0 in the wht map
+    mask : numpy array or str
+        Array the shape of the wht map with non-zero values corresponding to bad pixels, such as the bitmask from bad_pixel_bitmask, or the filename of a .fits image of one
+    block_rows : int or None
+        If given, stream the map through memory in strips of this many rows rather than loading it whole. A mask given by filename is then read through the same strips
+    store_dir : str or None
+        If given, read the input through the field's store (see store.py) instead of from the FITS file
+    ext : int
+        Index of the image HDU of the input to read, for multi-extension files. The output is always a single image file
 
     Returns
     -------
     RMS map .fits file
 
     """
+    if block_rows:
+        if exists(rms_fname):
+            print "Error: Unable to write to file. %s already exists." % rms_fname
+            print "Try again with new output filename."
+            return None
+        mask_list = None
+        if isinstance(mask, basestring):
+            mask_list = fits.open(mask, memmap=True, ignore_missing_end=True)
+            mask = mask_list[ext].section if store_dir is None else store.image_data(mask, store_dir, ext)
+        try:
+            stream_rows(wht_fname, rms_fname, lambda block, start, stop: mask_rms(rms_from_wht(block), np.array(mask[start:stop])), block_rows, store_dir=store_dir, ext=ext)
+        finally:
+            if mask_list is not None:
+                mask_list.close()
+        return None
+
+    if isinstance(mask, basestring):
+        mask = store.image_data(mask, store_dir, ext)
+
     hdu_list = fits.open(wht_fname, ignore_missing_end=True)
+    if ext:
+        # Just the one extension, as an image of its own
+        ext_header = mef.primary_header(hdu_list[ext].header)
+        ext_data = np.array(hdu_list[ext].data if store_dir is None else store.image_data(wht_fname, store_dir, ext))
+        hdu_list.close()
+        hdu_list = fits.HDUList([fits.PrimaryHDU(ext_data, header=ext_header)])
+    elif store_dir is not None:
+        hdu_list[0].data = np.array(store.image_data(wht_fname, store_dir))
     weight_data = hdu_list[0].data
 
     # Changes the header of the new fits file to match the filename
     hdu_list[0].header['filename'] = rms_fname
 
-    # for x in np.nditer(weight_data, flags = ['multi_index'], op_flags = ['readwrite']):
-        # print x
-        # if not x == 0:
-            # x[...] = 1/np.sqrt(np.absolute(x))
-    for x in range(weight_data.shape[0]):
-        for y in range(weight_data.shape[1]):
-            wht_val = weight_data[x,y]
-            if mask[x,y] == 1:
-                weight_data[x,y] = 100
-            else:
-                rms_val = 1/np.sqrt(np.absolute(wht_val))
-                weight_data[x,y] = rms_val
+    rms_from_wht(weight_data)
+    mask_rms(weight_data, mask)
 
     try:
         hdu_list.writeto(rms_fname)
@@ -94,7 +295,98 @@ def wht_to_rms_mask(wht_fname, rms_fname, mask):
 
     return None
 
-def bad_pixel_mask(wht_images, mask_output_fname, bad_val=1):
+def _bitmask_dtype(n_bands):
+    """Picks the smallest integer type that holds one non-sign bit per band.
+
+    """
+    for dtype, n_bits in ((np.uint8, 8), (np.int16, 15), (np.int32, 31), (np.int64, 63)):
+        if n_bands <= n_bits:
+            return dtype
+    raise ValueError("Can't pack a bad pixel mask for %d bands into one integer image" % n_bands)
+
+def bad_pixel_bits(wht_images, block_rows=None, store_dir=None, ext=0):
+    """Builds an integer bitmask in which bit n of a pixel is set where the nth weight image is zero.
+
+    The weight images are reduced one at a time through a memory map, so only the mask and one strip of one weight image are held in memory.
+
+    Parameters
+    ----------
+    wht_images : list
+        A list of strings corresponding to the filenames of the weight images in each band
+    block_rows : int or None
+        Number of rows of each weight image to read at once. None reads each image in one go
+    store_dir : str or None
+        If given, read the weight images through the field's store (see store.py), which leaves them there for the later stages
+    ext : int
+        Index of the image HDU to read, for multi-extension weight images
+
+    Returns
+    -------
+    out_mask : np.array
+        The bitmask
+
+    """
+    out_mask = None
+    for bit, wht in enumerate(wht_images):
+        hdu_list = fits.open(wht, memmap=True, ignore_missing_end=True)
+        wht_hdu = hdu_list[ext]
+        wht_rows = wht_hdu.section if store_dir is None else store.image_data(wht, store_dir, ext)
+        n_rows = wht_hdu.header['NAXIS2']
+        if out_mask is None:
+            out_mask = np.zeros((n_rows, wht_hdu.header['NAXIS1']), dtype=_bitmask_dtype(len(wht_images)))
+        band_bit = out_mask.dtype.type(1 << bit)
+        for start, stop in row_blocks(n_rows, block_rows or n_rows):
+            strip = out_mask[start:stop]
+            strip[wht_rows[start:stop] == 0] |= band_bit
+        hdu_list.close()
+
+    return out_mask
+
+def bad_pixel_bitmask(wht_images, mask_output_fname, bands=None, block_rows=None, store_dir=None, extensions=None):
+    """Makes a bad pixel mask for a field that records which bands each bad pixel is bad in.
+
+    Bit n of a pixel is set where the weight image of the nth band is zero, so any non-zero pixel is bad in at least one band. The band each bit belongs to is written to the MASKBn header keywords. For multi-extension weight images the mask is a multi-extension file with the same extension numbers.
+
+    Parameters
+    ----------
+    wht_images : list
+        A list of strings corresponding to the filenames of the weight images in each band
+    mask_output_fname : str
+        Name of the output .fits file
+    bands : list or None
+        Names of the bands in the same order as wht_images, used to label the bits. Defaults to the weight image filenames
+    block_rows : int or None
+        Number of rows of each weight image to read at once. None reads each image in one go
+    store_dir : str or None
+        If given, read the weight images through the field's store (see store.py), which leaves them there for the later stages
+    extensions : list or None
+        Image HDUs of the weight images to make masks for, as from mef.image_extensions. None for single image files
+
+    Returns
+    -------
+    out_mask : np.array or dict
+        The bitmask, or the bitmask of each extension by HDU index
+
+    """
+    if bands is None:
+        bands = [basename(wht) for wht in wht_images]
+    mask_cards = [('MASKB%d' % bit, band, 'band flagged by bit %d' % bit) for bit, band in enumerate(bands)]
+
+    if extensions is not None and mef.is_mef(extensions):
+        out_masks = dict((ext, bad_pixel_bits(wht_images, block_rows=block_rows, store_dir=store_dir, ext=ext)) for ext in extensions)
+        mef.write_mask_mef(out_masks, wht_images[0], mask_output_fname, mask_cards)
+        return out_masks
+
+    out_mask = bad_pixel_bits(wht_images, block_rows=block_rows, store_dir=store_dir)
+
+    mask_hdu = fits.PrimaryHDU(out_mask)
+    for key, value, comment in mask_cards:
+        mask_hdu.header[key] = (value, comment)
+    mask_hdu.writeto(mask_output_fname)
+
+    return out_mask
+
+def bad_pixel_mask(wht_images, mask_output_fname, bad_val=1, block_rows=None, store_dir=None, extensions=None):
     """Iterates through the the arrays corresponding to the weight images for the different filters of the field. Will output numpy array of zeros with a one corresponding to any pixel that's bad in any of the images.
 
     Parameters
@@ -105,52 +397,119 @@ def bad_pixel_mask(wht_images, mask_output_fname, bad_val=1):
         Name of the output .fits file
     bad_val : float or int
         Value to give to bad pixels
+    block_rows : int or None
+        Number of rows of each weight image to read at once. None reads each image in one go
+    store_dir : str or None
+        If given, read the weight images through the field's store (see store.py), which leaves them there for the later stages
+    extensions : list or None
+        Image HDUs of the weight images to make masks for, as from mef.image_extensions. The mask is then a multi-extension file with the same extension numbers. None for single image files
 
     Returns
     -------
-    out_mask : np.array
-        Array as described
+    out_mask : np.array or dict
+        Array as described, or the array of each extension by HDU index
 
     """
-    wht_data = {}
-    count = 0
-    for wht in wht_images:
-        hdu_list = fits.open(wht, ignore_missing_end=True)
-        wht_data[wht] = hdu_list[0].data
-        count += 1
-        hdu_list.close()
-
-    out_mask = np.zeros(wht_data[wht_images[0]].shape)
+    if extensions is not None and mef.is_mef(extensions):
+        out_masks = dict((ext, np.where(bad_pixel_bits(wht_images, block_rows=block_rows, store_dir=store_dir, ext=ext) != 0, bad_val, 0.)) for ext in extensions)
+        mef.write_mask_mef(out_masks, wht_images[0], mask_output_fname)
+        return out_masks
 
-    xmax, ymax = out_mask.shape
-
-    for x in range(xmax):
-        for y in range(ymax):
-            test_val = 1
-            for wht in wht_images:
-                multi = wht_data[wht][x,y]
-                test_val = test_val * multi
-            if test_val == 0:
-                out_mask[x,y] = bad_val
+    out_mask = np.where(bad_pixel_bits(wht_images, block_rows=block_rows, store_dir=store_dir) != 0, bad_val, 0.)
 
     fits.writeto(mask_output_fname, out_mask)
 
     return out_mask
 
-def crude_SExtract(field_band_dict):
+def run_sextractor(sex_args, log_fname=None):
+    """Runs SExtractor, optionally capturing everything it prints to a log file.
+
+    Parameters
+    ----------
+    sex_args : list
+        Command line arguments for SExtractor, not including the executable
+    log_fname : str or None
+        File to append SExtractor's stdout and stderr to. If None they go to the console
+
+    Raises
+    ------
+    CalledProcessError
+        If SExtractor fails. Its output is the end of the log, if there is one
+
+    """
+    if log_fname is None:
+        check_call(['sextractor'] + sex_args)
+        return None
+
+    log_file = open(log_fname, 'a')
+    log_file.write('$ sextractor %s\n' % ' '.join(sex_args))
+    log_file.flush()
+    try:
+        check_call(['sextractor'] + sex_args, stdout=log_file, stderr=STDOUT)
+    except CalledProcessError as err:
+        log_file.close()
+        err.output = ''.join(open(log_fname).readlines()[-10:])
+        raise
+    log_file.close()
+
+def pipe_sextractor(sex_args, log_fname=None):
+    """Runs SExtractor with an ASCII_HEAD catalog written to its stdout, yielding the catalog a line at a time as SExtractor writes it.
+
+    Parameters
+    ----------
+    sex_args : list
+        Command line arguments for SExtractor, not including the executable or CATALOG_NAME
+    log_fname : str or None
+        File to append SExtractor's messages (its stderr) to. If None they go to the console
+
+    Yields
+    ------
+    cat_line : str
+        Each line of the catalog
+
+    Raises
+    ------
+    CalledProcessError
+        Once the catalog has been read, if SExtractor fails. Its output is the end of the log, if there is one
+
+    """
+    sex_args = sex_args + ['-CATALOG_NAME', 'STDOUT', '-CATALOG_TYPE', 'ASCII_HEAD']
+    log_file = None
+    if log_fname is not None:
+        log_file = open(log_fname, 'a')
+        log_file.write('$ sextractor %s\n' % ' '.join(sex_args))
+        log_file.flush()
+    sex_proc = Popen(['sextractor'] + sex_args, stdout=PIPE, stderr=log_file)
+    try:
+        for cat_line in iter(sex_proc.stdout.readline, ''):
+            yield cat_line
+    finally:
+        sex_proc.stdout.close()
+        returncode = sex_proc.wait()
+        if log_file is not None:
+            log_file.close()
+    if returncode != 0:
+        err = CalledProcessError(returncode, 'sextractor')
+        if log_fname is not None:
+            err.output = ''.join(open(log_fname).readlines()[-10:])
+        raise err
+
+def crude_SExtract(field_band_dict, profile='lean'):
     """Runs SExtractor in dual mode on one science image with one RMS map to produce a segmentaion map and a catalog
 
     Parameters
     ----------
     field_band_dict : dict
         Dict of the various filenames etc relevant to the field and band being SExtracted
+    profile : str 'lean' or 'full'
+        SExtractor profile of the run, see sex_profiles.py. The lean profile makes no catalog
 
     Returns
     -------
     SExtractor outputs
 
     """
-    sci_image = field_band_dict['sci']
+    sci_image = field_band_dict.get('sci_ext', field_band_dict['sci'])
     rms_map = field_band_dict['rms_crude']
     cat_fname = field_band_dict['cat_crude']
     segm_chk_fname = field_band_dict['segmap']
@@ -162,29 +521,78 @@ def crude_SExtract(field_band_dict):
     dual_rms = rms_map + ',' + rms_map
 
     # Run SExtractor
-    check_call(['sextractor', dual_sci, '-c', 'crude.sex', '-WEIGHT_IMAGE', dual_rms, '-CHECKIMAGE_NAME', segm_chk_fname, '-CATALOG_NAME', cat_fname, '-GAIN', gain, '-MAG_ZEROPOINT', magzeropoint])
+    run_sextractor([dual_sci, '-c', 'crude.sex', '-WEIGHT_IMAGE', dual_rms, '-CHECKIMAGE_NAME', segm_chk_fname, '-CATALOG_NAME', cat_fname, '-GAIN', gain, '-MAG_ZEROPOINT', magzeropoint] + sex_profiles.profile_args('crude', profile, field_band_dict.get('scratch', '')), log_fname=field_band_dict.get('sex_log'))
+
+def crude_segment(field_band_dict, block_rows=None, store_dir=None, mask_fname=None):
+    """Makes the segmentation map of one science image with its RMS map in-process, in place of crude_SExtract (see segmentation.py). No crude catalog is made.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band being segmented
+    block_rows : int or None
+        If given, work through the image in strips of this many rows
+    store_dir : str or None
+        If given, read the images through the field's store (see store.py) instead of from the FITS files
+    mask_fname : str or None
+        Filename of the field's bad pixel mask, if it has one, to leave out of the background along with the zero weight pixels
+
+    Returns
+    -------
+    n_objects : int
+        Number of sources in the segmentation map
 
-def norm_rms_map(crude_rms_map, norm_rms_fname, norm_const):
+    """
+    segm_fname = field_band_dict['segmap']
+    if exists(segm_fname):
+        remove(segm_fname)
+    return segmentation.segmentation_map(field_band_dict['sci'], field_band_dict['rms_crude'], segm_fname, block_rows=block_rows, store_dir=store_dir, ext=field_band_dict.get('ext', 0),
+                                         wht_fname=field_band_dict['wht'], mask_fname=mask_fname)
+
+def norm_rms_map(crude_rms_map, norm_rms_fname, norm_const, block_rows=None, store_dir=None, tile_size=None, keywords=None):
     """Normalises a 'crude' RMS map according to a normalisation constant.
 
     Parameters
     ----------
     crude_rms_map, norm_rms_fname : str
         Filenames of the input RMS map to be normalised, and the ouput normalised RMS map respectively
-    norm_const : float
-        The normalisation constant to be applied
+    norm_const : float or numpy array
+        The normalisation constant to be applied, or a grid of them over the image from noise.tiled_norm_constants
+    tile_size : int or None
+        Size in pixels of the tiles of a grid of normalisation constants
+    block_rows : int or None
+        If given, stream the map through memory in strips of this many rows rather than loading it whole
+    store_dir : str or None
+        If given, read the input through the field's store (see store.py) instead of from the FITS file
+    keywords : list or None
+        (key, value, comment) cards to add to the output header, e.g. from noise.noise_curve_keywords
 
     Returns
     -------
     Normalised RMS map
 
     """
+    if block_rows:
+        if np.ndim(norm_const) == 2:
+            stream_rows(crude_rms_map, norm_rms_fname, lambda block, start, stop: scale_rms_tiled(block, norm_const, tile_size, start), block_rows, store_dir=store_dir, keywords=keywords)
+        else:
+            stream_rows(crude_rms_map, norm_rms_fname, lambda block, start, stop: scale_rms(block, norm_const), block_rows, store_dir=store_dir, keywords=keywords)
+        return None
+
     hdu_list = fits.open(crude_rms_map)
+    if store_dir is not None:
+        hdu_list[0].data = np.array(store.image_data(crude_rms_map, store_dir))
     rms_data = hdu_list[0].data
     hdu_list[0].header['filename'] = norm_rms_fname
+    for key, value, comment in (keywords or []):
+        hdu_list[0].header[key] = (value, comment)
 
-    for x in np.nditer(rms_data, op_flags = ['readwrite']):
-        x[...] = x * norm_const
+    if np.ndim(norm_const) == 2:
+        # A strip at a time, so the surface is never held for the whole image
+        for start, stop in row_blocks(rms_data.shape[0], 1024):
+            scale_rms_tiled(rms_data[start:stop], norm_const, tile_size, start)
+    else:
+        scale_rms(rms_data, norm_const)
 
     # Writes the output to file
     hdu_list.writeto(norm_rms_fname)
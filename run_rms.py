@@ -1,79 +1,66 @@
-import rms_tools as rms
 import rms_config as config
-import noise
-from os.path import isfile
-from os import remove
-
-# sci_data_dir = config.config_dict['sci_dir']   #z8
-master_bands = config.config_dict['master_bands']
-fields = config.read_list(config.config_dict['fields'])
-
-flagged_imgs = []
-
-# field_data = config.field_band_list(fields, sci_data_dir, master_bands=master_bands)  # z8
-field_data = {}             # z9
-for field in fields:        # z9
-    this_field = {}
-    this_field['bands'] = master_bands  # z9
-    field_data[field] = this_field      # z9
-
-# field_data = config.full_filename_list_z8(field_data)  # z8
-field_data = config.full_filename_list_z9(field_data)  # z9
-
-for field in field_data:
-    for band in field_data[field]['bands']:
-        flags = ''
-        try:
-            print "\n\n****************\n****************\nField %s, band %s : \n" % (field, band)
-            if not isfile(field_data[field][band]['rms_crude']):
-                print "Making initial RMS map..."
-                rms.wht_to_rms(field_data[field][band]['wht'], field_data[field][band]['rms_crude'], zero_handle=config.config_dict['wht_zero'])
-            else:
-                print "First pass RMS map for field %s band %s already exists!" % (field, band)
-
-            print "SExtracting...\n"
-            rms.crude_SExtract(field_data[field][band])
-
-            if not isfile(field_data[field][band]['false_img']):
-                print "Generating false sources..."
-                noise.false_sources(field_data[field][band], no_sources=field_data[field][band]['no_false_srcs'])
-            else:
-                print "False sources image for field %s band %s already exists!" % (field, band)
-
-            print "SExtracting false sources...\n"
-            noise.false_SExtract(field_data[field][band])
-
-            norm_constant, fal_src_count = noise.rms_norm_constant(field_data[field][band]['cat_false'])
-            print "%d false sources SExtracted.\n" % fal_src_count
-            print "Calculating normalisation constant..."
-
-            if not fal_src_count == field_data[field][band]['no_false_srcs']:
-                flags = flags + ' falsecount '
-
-            print "Creating normalised RMS map..."
-            if isfile(field_data[field][band]['rms_norm']):
-                remove(field_data[field][band]['rms_norm'])
-            rms.norm_rms_map(field_data[field][band]['rms_crude'], field_data[field][band]['rms_norm'], norm_constant)
-
-            noise.test_SExtract(field_data[field][band])
-            test_norm, test_count = noise.rms_norm_constant('test.cat')
-
-            print "noise_measured / noise_estimated = ", test_norm
-
-            if not 0.99 < test_norm < 1.001:
-                flags = flags + ' normacc:' + str(test_norm) + ' '
-
-            if not flags == '':
-                flagged_imgs.append(field+'_'+band+flags)
-        except IOError:
-            print 'IOError!!'
-            flags = flags + ' ERROR:IOError '
-            flagged_imgs.append(field+'_'+band+flags)
-
-# Clean up
-if not len(flagged_imgs) == 0:
-    config.write_flags(flagged_imgs)
-try:
-    remove('test.cat')
-except OSError:
-    pass
+import argparse
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Makes normalised RMS maps for every field and band in the config file.')
+    parser.add_argument('--strict-verify', action='store_true', help='check each normalised map by measuring the false sources again, rather than predicting the result from the first measurement')
+    parser.add_argument('-c', '--config', default='detection.config', help='config file (default: detection.config)')
+    parser.add_argument('-j', '--jobs', type=int, help='number of fields/bands to process at once (default 1, or one per CPU with memory_budget set in the config file)')
+    queue = parser.add_mutually_exclusive_group()
+    queue.add_argument('--plan', metavar='QUEUE_DIR', help='write each field/band to a shared queue directory for --work to run, instead of running them here')
+    queue.add_argument('--work', metavar='QUEUE_DIR', help='run fields/bands from a queue until it is empty, -j at a time (run from the directory with crude.sex)')
+    queue.add_argument('--collect', metavar='QUEUE_DIR', help='write the flag log and run report of a finished queue')
+    args = parser.parse_args()
+
+    # Imported once the arguments are parsed, so --help doesn't have to load astropy
+    import pipeline
+    import instrument
+    import store
+    import taskqueue
+    if args.work is not None:
+        # Everything a worker needs is in the queue
+        n_run = taskqueue.work_pool(args.work, jobs=args.jobs or 1)
+        print "Ran %d units of %s" % (n_run, args.work)
+        raise SystemExit
+    config_dict = config.load_config(args.config)
+    config.make_dirs(config_dict)
+
+    if args.collect is not None:
+        # The units of the queue carry everything about the run bar the config's output paths
+        tasks, reports, flagged_imgs = taskqueue.collect(args.collect)
+    else:
+        # sci_data_dir = config_dict['sci_dir']   #z8
+        master_bands = config_dict['master_bands']
+        fields = config.read_list(config_dict['fields'])
+
+        # field_data = config.field_band_list(fields, sci_data_dir, master_bands=master_bands)  # z8
+        field_data = {}             # z9
+        for field in fields:        # z9
+            this_field = {}
+            this_field['bands'] = master_bands  # z9
+            field_data[field] = this_field      # z9
+
+        # field_data = config.full_filename_list_z8(field_data)  # z8
+        field_data = config.full_filename_list_z9(field_data, config_dict)  # z9
+
+        # Queued tasks are given their stores by the workers that run them
+        store_root = config_dict.get('store_dir') if args.plan is None else None
+        tasks = pipeline.band_tasks(field_data, scratch_root=config_dict.get('scratch_dir', config_dict['fake_dir']),
+                                    store_root=store_root,
+                                    wht_zero=config_dict['wht_zero'],
+                                    **pipeline.task_options(config_dict, strict_verify=args.strict_verify))
+        if args.plan is not None:
+            taskqueue.plan(args.plan, taskqueue.band_units(tasks, store_root=config_dict.get('store_dir')))
+            raise SystemExit
+        flagged_imgs, reports = pipeline.run_tasks(tasks, jobs=args.jobs, memory_budget=config_dict.get('memory_budget'))
+        if store_root is not None:
+            for field in field_data:
+                store.clear_store(store_root + field + '/')
+
+    flagged_imgs += pipeline.merge_extensions(tasks, reports, cache_mode=config_dict.get('cache', 'stat'))
+
+    # Clean up
+    if not len(flagged_imgs) == 0:
+        config.write_flags(flagged_imgs, config_dict['flag_log'])
+    json_fname, csv_fname = config.report_fnames(config_dict)
+    instrument.write_report(reports, json_fname, csv_fname)
@@ -0,0 +1,118 @@
+"""A module for running tasks in parallel within a memory budget, so a run on big images doesn't need -j guessed to keep from running out of memory.
+
+The peak memory of each task is estimated from the headers of its images before anything is run (task_memory). Tasks are then started largest first, each as soon as there is a free worker and the estimates of the tasks running alongside it leave room for it under the budget. Starting the largest first means the run isn't left waiting on one big task at the end, and the small ones fill in the room around them.
+
+"""
+
+import multiprocessing
+import Queue
+from astropy.io import fits
+from os.path import exists
+import numpy as np
+
+# Memory of a worker before it loads any images (Python, numpy and astropy)
+BASE_MEMORY = 64 * 1024**2
+
+# Full-width float64 arrays the RMS map stages work with at once, per row of the strip (or image) they're working on
+STRIP_ARRAYS = 3
+
+# Seconds between checks on the running tasks
+POLL_S = 1
+
+def _pixel_bytes(fname, ext=0):
+    """Gets the shape and bytes per pixel of a FITS image from its header.
+
+    """
+    header = fits.getheader(fname, ext=ext, ignore_missing_end=True)
+    return (header['NAXIS2'], header['NAXIS1']), abs(header['BITPIX']) // 8
+
+def task_memory(task):
+    """Estimates the peak memory of a task of pipeline.process_band from its image headers, without reading any data.
+
+    The heaviest stage is placing the false sources, which reads the whole weight and segmentation maps to find the empty pixels, while the science image is read whole by native photometry and masking. They're all counted at once, along with the false source image unless it's streamed out in strips (block_rows), the field mask for make_detection_rms.py, and the working arrays of the RMS map stages. Images read through the store are counted too, though the workers of a field share those pages, so the estimate errs high.
+
+    Parameters
+    ----------
+    task : tuple
+        (field, band, field_band_dict, options) as from pipeline.band_tasks
+
+    Returns
+    -------
+    n_bytes : int
+        Estimated peak resident memory of the worker running the task
+
+    """
+    field, band, field_band_dict, options = task
+    ext = field_band_dict.get('ext', 0)
+    (n_rows, n_cols), sci_bytes = _pixel_bytes(field_band_dict['sci'], ext)
+    wht_bytes = _pixel_bytes(field_band_dict['wht'], ext)[1]
+
+    # Weight and science images, segmentation map (int32) and the map of allowed false source centres (bool)
+    pixel_bytes = wht_bytes + sci_bytes + 4 + 1
+    if not options.get('block_rows'):
+        pixel_bytes += np.dtype(options.get('false_dtype', 'float64')).itemsize
+    if options.get('mask') is not None:
+        # The mask is made before the tasks are, but guess an int32 bitmask if it isn't there yet
+        pixel_bytes += _pixel_bytes(options['mask'], ext)[1] if exists(options['mask']) else 4
+
+    strip_rows = min(options.get('block_rows') or n_rows, n_rows)
+    return BASE_MEMORY + n_rows * n_cols * pixel_bytes + STRIP_ARRAYS * 8 * strip_rows * n_cols
+
+def run_within_budget(func, tasks, budget, jobs=None):
+    """Runs func on each task in a pool of worker processes, keeping the total estimated memory of the running tasks within a budget.
+
+    Tasks are started largest first. When the next largest doesn't fit, smaller ones that do are started in its place. A task bigger than the whole budget is run on its own.
+
+    Parameters
+    ----------
+    func : function
+        Function to run on each task, e.g. pipeline.process_band. It must be picklable, i.e. defined at the top level of a module
+    tasks : list
+        Tasks as from pipeline.band_tasks
+    budget : int
+        Memory in bytes the running tasks' estimates must add up to no more than
+    jobs : int or None
+        Most tasks to run at once. Defaults to the number of CPUs
+
+    Returns
+    -------
+    results : list
+        The result of func for each task, in the order of tasks
+    estimates : list
+        The estimated memory of each task in bytes, from task_memory
+
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    estimates = [task_memory(task) for task in tasks]
+    pending = sorted(range(len(tasks)), key=lambda n: estimates[n], reverse=True)
+    for n in pending:
+        if estimates[n] > budget:
+            print "Task %s %s needs ~%d MB, more than the memory budget of %d MB, so it will be run on its own" % (tasks[n][0], tasks[n][1], estimates[n] // 1024**2, budget // 1024**2)
+
+    results = [None] * len(tasks)
+    running = {}
+    finished = Queue.Queue()
+    pool = multiprocessing.Pool(min(jobs, max(len(tasks), 1)))
+    try:
+        while pending or running:
+            in_use = sum(estimates[n] for n in running)
+            for n in list(pending):
+                if len(running) >= jobs:
+                    break
+                if running and in_use + estimates[n] > budget:
+                    continue
+                running[n] = pool.apply_async(func, (tasks[n],), callback=lambda result: finished.put(True))
+                in_use += estimates[n]
+                pending.remove(n)
+
+            # Woken by the next task to finish, or now and then to pick up a task that raised
+            try:
+                finished.get(timeout=POLL_S)
+            except Queue.Empty:
+                pass
+            for n in [n for n in running if running[n].ready()]:
+                results[n] = running.pop(n).get()
+    finally:
+        pool.close()
+        pool.join()
+    return results, estimates
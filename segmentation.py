@@ -0,0 +1,207 @@
+"""A module for masking the sources in an image in-process, in place of the crude SExtractor run, following the detection settings of crude.sex.
+
+The only product of the crude run the normalisation uses is the segmentation map, which tells false_sources where the real objects are. This makes one the way SExtractor detects: subtract a mesh background, filter with the detection kernel, threshold against the RMS map and keep the connected regions of at least DETECT_MINAREA pixels. The regions are then grown by a few pixels to cover the faint wings SExtractor's isophotes miss. The image is worked through a strip of rows at a time. It needs scipy.
+
+"""
+
+import re
+import numpy as np
+from astropy.io import fits
+from astropy.io.fits.hdu.base import DTYPE2BITPIX
+from numpy.lib.format import open_memmap
+from os import getpid, remove
+from os.path import exists
+import mef
+import photometry
+import store
+
+def gaussian_kernel(fwhm, size):
+    """Makes a normalised size x size Gaussian convolution kernel, like SExtractor's gauss_<fwhm>_<size>x<size>.conv filters.
+
+    """
+    sigma = fwhm / (2. * np.sqrt(2. * np.log(2.)))
+    y, x = np.mgrid[0:size, 0:size] - (size - 1) / 2.
+    kernel = np.exp(-(x**2 + y**2) / (2 * sigma**2))
+    return kernel / kernel.sum()
+
+def detection_kernel(sex_config):
+    """Gets the detection filter of a SExtractor config, normalised to a sum of 1.
+
+    The FILTER_NAME file is read if it exists. Otherwise a name like gauss_2.0_5x5.conv is made with gaussian_kernel.
+
+    Parameters
+    ----------
+    sex_config : dict
+        SExtractor config, from photometry.read_sex_config
+
+    Returns
+    -------
+    kernel : numpy array or None
+        The kernel, or None if FILTER is N
+
+    """
+    if sex_config.get('FILTER', ['Y'])[0].upper() == 'N':
+        return None
+    filter_name = sex_config.get('FILTER_NAME', ['gauss_2.0_5x5.conv'])[0]
+    if exists(filter_name):
+        rows = []
+        for line in open(filter_name):
+            line = line.split('#')[0].strip()
+            if len(line) == 0 or line.startswith('CONV'):
+                continue
+            rows.append([float(val) for val in line.split()])
+        kernel = np.array(rows)
+        return kernel / kernel.sum()
+
+    match = re.match(r'gauss_([0-9.]+)_([0-9]+)x([0-9]+)\.conv$', filter_name.split('/')[-1])
+    if match is None:
+        raise IOError("Can't find the filter %s" % filter_name)
+    return gaussian_kernel(float(match.group(1)), int(match.group(2)))
+
+def _disk(r):
+    """Boolean footprint of a disk of radius r.
+
+    """
+    y, x = np.mgrid[-r:r+1, -r:r+1]
+    return x**2 + y**2 <= r**2
+
+def _boundary_pairs(upper, lower):
+    """Finds the pairs of labels touching across the boundary between two strips, with 8-connectivity.
+
+    Parameters
+    ----------
+    upper, lower : numpy array
+        The last row of labels of one strip and the first row of the next
+
+    """
+    pairs = []
+    for dx in (-1, 0, 1):
+        a = upper[max(dx, 0):len(upper)+min(dx, 0)]
+        b = lower[max(-dx, 0):len(lower)+min(-dx, 0)]
+        touching = (a != 0) & (b != 0)
+        pairs.append(np.column_stack((a[touching], b[touching])))
+    return np.vstack(pairs)
+
+def segmentation_map(sci_fname, rms_fname, seg_fname, sex_fname='crude.sex', block_rows=1024, dilate=2, store_dir=None, ext=0, wht_fname=None, mask_fname=None):
+    """Makes a segmentation map of the sources in a science image in-process, in place of SExtractor's SEGMENTATION check image.
+
+    The first pass thresholds and labels each strip of rows and links up the labels of regions crossing from one strip into the next. The second drops the regions smaller than DETECT_MINAREA, numbers the rest from 1 and grows them by dilate pixels, writing the map a strip at a time.
+
+    Parameters
+    ----------
+    sci_fname, rms_fname : str
+        Filenames of the science image and its RMS map. Pixels with a non-finite RMS are never part of a source
+    seg_fname : str
+        Filename of the output segmentation map. The map must NOT already be a file
+    sex_fname : str
+        SExtractor config file to take BACK_SIZE, BACK_FILTERSIZE, FILTER_NAME, DETECT_THRESH and DETECT_MINAREA from
+    block_rows : int or None
+        Number of image rows per strip
+    dilate : int
+        Radius in pixels to grow each region by. Pixels of another region are left to it
+    store_dir : str or None
+        If given, read the images through the field's store (see store.py) instead of from the FITS files
+    ext : int
+        Index of the image HDU of the science image, for multi-extension files. The RMS map is a single image
+    wht_fname, mask_fname : str or None
+        Filenames of the weight image and the field's bad pixel mask, if given, whose zero weight and masked pixels are left out of the background as they are in false_photometry. Read at the same extension as the science image
+
+    Returns
+    -------
+    n_objects : int
+        Number of sources in the map
+
+    """
+    from scipy import ndimage
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    if exists(seg_fname):
+        raise IOError("%s already exists." % seg_fname)
+
+    sex_config = photometry.read_sex_config(sex_fname)
+    back_size = int(sex_config['BACK_SIZE'][0])
+    thresh = float(sex_config['DETECT_THRESH'][0])
+    min_area = int(sex_config['DETECT_MINAREA'][0])
+    kernel = detection_kernel(sex_config)
+    halo = 0 if kernel is None else kernel.shape[0] // 2
+
+    sci_data = store.image_data(sci_fname, store_dir, ext)
+    rms_data = store.image_data(rms_fname, store_dir)
+    n_rows, n_cols = sci_data.shape
+    block_rows = block_rows or n_rows
+    wht_data = store.image_data(wht_fname, store_dir, ext) if wht_fname is not None else None
+    mask_data = store.image_data(mask_fname, store_dir, ext) if mask_fname is not None else None
+    back_grid = photometry.mesh_background(sci_data, back_size=back_size, filter_size=int(sex_config['BACK_FILTERSIZE'][0]), rms_data=rms_data, wht_data=wht_data, mask_data=mask_data)
+    cols = np.arange(n_cols)
+
+    # Labels of each strip, numbered on from the strip before, while the regions crossing strips are linked up
+    label_fname = '%s.%d.labels.npy' % (seg_fname, getpid())
+    labels = open_memmap(label_fname, mode='w+', dtype=np.int32, shape=(n_rows, n_cols))
+    try:
+        areas = [np.zeros(1, dtype=np.int64)]
+        pairs = []
+        n_labels = 0
+        for start in range(0, n_rows, block_rows):
+            stop = min(start + block_rows, n_rows)
+            lo, hi = max(start - halo, 0), min(stop + halo, n_rows)
+            rms_block = np.array(rms_data[lo:hi], dtype=np.float64)
+            good = np.isfinite(rms_block) & (rms_block > 0)
+            rows = np.arange(lo, hi)[:, None]
+            det_block = np.where(good, sci_data[lo:hi] - photometry.background_at(back_grid, cols[None, :], rows, back_size), 0.)
+            if kernel is not None:
+                det_block = ndimage.convolve(det_block, kernel, mode='nearest')
+            with np.errstate(invalid='ignore'):
+                above = (det_block > thresh * rms_block) & good
+            above = above[start-lo:stop-lo]
+
+            block_labels, n_block = ndimage.label(above, structure=np.ones((3, 3)))
+            block_labels[block_labels != 0] += n_labels
+            labels[start:stop] = block_labels
+            areas.append(np.bincount(block_labels.ravel(), minlength=n_labels + n_block + 1)[n_labels+1:])
+            if start > 0:
+                pairs.append(_boundary_pairs(labels[start-1], block_labels[0]))
+            n_labels += n_block
+
+        # Regions are joined through their links, and kept if their total area is big enough
+        pairs = np.vstack(pairs) if pairs else np.zeros((0, 2), dtype=np.int32)
+        links = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n_labels + 1, n_labels + 1))
+        n_regions, region = connected_components(links, directed=False)
+        region_area = np.bincount(region, weights=np.concatenate(areas), minlength=n_regions)
+        keep = region_area >= min_area
+        keep[region[0]] = False
+        number = np.zeros(n_regions, dtype=np.int32)
+        number[keep] = np.arange(1, keep.sum() + 1)
+        final = number[region]
+
+        out_hdu = None
+        footprint = _disk(dilate) if dilate > 0 else None
+        try:
+            for start in range(0, n_rows, block_rows):
+                stop = min(start + block_rows, n_rows)
+                lo, hi = max(start - dilate, 0), min(stop + dilate, n_rows)
+                seg_block = final[labels[lo:hi]]
+                if footprint is not None:
+                    grown = ndimage.grey_dilation(seg_block, footprint=footprint)
+                    seg_block = np.where(seg_block == 0, grown, seg_block)
+                if out_hdu is None:
+                    header = mef.primary_header(fits.getheader(sci_fname, ext=ext, ignore_missing_end=True))
+                    header['filename'] = seg_fname
+                    header['BITPIX'] = DTYPE2BITPIX['int32']
+                    header.remove('BSCALE', ignore_missing=True)
+                    header.remove('BZERO', ignore_missing=True)
+                    out_hdu = fits.StreamingHDU(seg_fname, header)
+                out_hdu.write(seg_block[start-lo:stop-lo])
+        except Exception:
+            # Don't leave a truncated map behind to be mistaken for a finished one
+            if out_hdu is not None:
+                out_hdu.close()
+                remove(seg_fname)
+            raise
+        if out_hdu is not None:
+            out_hdu.close()
+    finally:
+        del labels
+        remove(label_fname)
+
+    return int(keep.sum())
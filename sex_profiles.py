@@ -0,0 +1,91 @@
+"""A module for the lean SExtractor profiles of each stage, which ask SExtractor for only what the normalisation reads.
+
+crude.sex and crude.param are written for a general purpose catalog, with ~30 columns and a segmentation check image on every run. The normalisation only needs the segmentation map of the crude run, and NUMBER, X_IMAGE, Y_IMAGE and the aperture fluxes of the false and test runs. Each profile is a set of command line overrides on top of crude.sex, with a parameter file the package writes itself, so the rest of crude.sex (detection, background, apertures) still applies. The 'full' profile uses crude.sex as it is, for reference runs.
+
+"""
+
+from os import getpid, rename
+from os.path import exists
+import photometry
+
+PROFILES = ('lean', 'full')
+
+def stage_params(stage, sex_fname='crude.sex'):
+    """Lists the catalog parameters a stage reads.
+
+    Parameters
+    ----------
+    stage : str 'crude', 'false' or 'test'
+        The SExtractor run
+    sex_fname : str
+        SExtractor config file, for the number of PHOT_APERTURES
+
+    Returns
+    -------
+    params : list
+        Parameter names as they go in a parameter file
+
+    """
+    if stage == 'crude':
+        return ['NUMBER']
+    n_apertures = len(photometry.read_sex_config(sex_fname)['PHOT_APERTURES'])
+    return ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'FLUX_APER(%d)' % n_apertures, 'FLUXERR_APER(%d)' % n_apertures]
+
+def write_param_file(param_fname, params):
+    """Writes a SExtractor parameter file, unless it already has these parameters.
+
+    It's written under a temporary name and moved into place, so a SExtractor run reading it never sees half of it.
+
+    """
+    contents = '\n'.join(params) + '\n'
+    if exists(param_fname) and open(param_fname).read() == contents:
+        return
+    tmp_fname = '%s.%d.tmp' % (param_fname, getpid())
+    param_file = open(tmp_fname, 'w')
+    param_file.write(contents)
+    param_file.close()
+    rename(tmp_fname, param_fname)
+
+def param_fname(stage, profile='lean', profile_dir='', sex_fname='crude.sex'):
+    """Gets the parameter file a stage's SExtractor run uses under a profile, i.e. the one written by profile_args or, for the full profile, the one named in sex_fname.
+
+    """
+    if profile == 'full':
+        return photometry.read_sex_config(sex_fname)['PARAMETERS_NAME'][0]
+    return profile_dir + stage + '.param'
+
+def profile_args(stage, profile='lean', profile_dir='', sex_fname='crude.sex'):
+    """Gets the SExtractor command line overrides of a stage's profile.
+
+    The crude run writes its segmentation map and no catalog. The false and test runs write their catalog and no check images.
+
+    Parameters
+    ----------
+    stage : str 'crude', 'false' or 'test'
+        The SExtractor run
+    profile : str 'lean' or 'full'
+        'full' uses crude.sex and its parameter file unchanged
+    profile_dir : str
+        Directory to write the stage's parameter file to, e.g. the task's scratch directory
+    sex_fname : str
+        SExtractor config file the profile is applied on top of
+
+    Returns
+    -------
+    sex_args : list
+        Arguments to add to the SExtractor command line, after '-c sex_fname'
+
+    """
+    if profile not in PROFILES:
+        raise ValueError("Unknown SExtractor profile %s, should be one of %s" % (profile, ', '.join(PROFILES)))
+    if profile == 'full':
+        return []
+
+    stage_param_fname = param_fname(stage, profile, profile_dir, sex_fname)
+    write_param_file(stage_param_fname, stage_params(stage, sex_fname))
+    sex_args = ['-PARAMETERS_NAME', stage_param_fname]
+    if stage == 'crude':
+        sex_args += ['-CATALOG_TYPE', 'NONE']
+    else:
+        sex_args += ['-CHECKIMAGE_TYPE', 'NONE']
+    return sex_args
@@ -0,0 +1,114 @@
+"""A module for sharing the images of a field between the stages of the normalisation and the worker processes running them.
+
+Each image is decoded from its FITS file once, into a native byte order .npy file in the field's store directory. Every later read of it, in any process, memory maps that file, so the stages all get read-only views of the same pages instead of opening and decoding the FITS file again. Decoding an image is done under a lock on it, so workers that want it at the same time wait for the one decoding it rather than clearing or replacing its file under each other.
+
+"""
+
+import fcntl
+import hashlib
+import shutil
+import numpy as np
+from astropy.io import fits
+from numpy.lib.format import open_memmap
+from os import getpid, makedirs, rename
+from os.path import abspath, basename, exists
+import cache
+
+# Views already mapped by this process, by stored filename, with the identity of the image they were made from
+_views = {}
+
+def array_fname(fname, store_dir, ext=0):
+    """Filename of the stored copy of an image, or of one extension of a multi-extension file.
+
+    The name includes a hash of the image's full path, so images with the same filename in different directories don't collide.
+
+    """
+    path_hash = hashlib.sha1(abspath(fname).encode('utf-8')).hexdigest()[:8]
+    if ext:
+        return store_dir + basename(fname) + '.ext%d.' % ext + path_hash + '.npy'
+    return store_dir + basename(fname) + '.' + path_hash + '.npy'
+
+def make_store(store_dir):
+    """Creates a store directory if it doesn't exist yet, allowing for other workers of the field doing the same at the same time.
+
+    """
+    try:
+        makedirs(store_dir)
+    except OSError:
+        if not exists(store_dir):
+            raise
+
+def _decode(fname, npy_fname, block_rows=1024, ext=0):
+    """Copies an image HDU of a FITS file into a native byte order .npy file, a strip of rows at a time.
+
+    The copy is made under a temporary name and moved into place when it's complete, so other processes never map a half written file.
+
+    """
+    hdu_list = fits.open(fname, memmap=True, ignore_missing_end=True)
+    in_hdu = hdu_list[ext]
+    n_rows = in_hdu.header['NAXIS2']
+    tmp_fname = '%s.%d.tmp.npy' % (npy_fname[:-4], getpid())
+    try:
+        first = in_hdu.section[0:1]
+        stored = open_memmap(tmp_fname, mode='w+', dtype=first.dtype.newbyteorder('='), shape=(n_rows, in_hdu.header['NAXIS1']))
+        for start in range(0, n_rows, block_rows):
+            stop = min(start + block_rows, n_rows)
+            stored[start:stop] = in_hdu.section[start:stop]
+        stored.flush()
+        del stored
+    finally:
+        hdu_list.close()
+    rename(tmp_fname, npy_fname)
+
+def image_data(fname, store_dir=None, ext=0):
+    """Gets the data of an image HDU of a FITS file as a read-only array, through the store if there is one.
+
+    Parameters
+    ----------
+    fname : str
+        Filename of the FITS image
+    store_dir : str or None
+        The field's store directory. None memory maps the FITS file itself
+    ext : int
+        Index of the HDU, for multi-extension files
+
+    Returns
+    -------
+    data : numpy array
+        Read-only view of the image data. Copy it before changing it
+
+    """
+    if store_dir is None:
+        return fits.getdata(fname, ext=ext, memmap=True, ignore_missing_end=True)
+
+    npy_fname = array_fname(fname, store_dir, ext)
+    identity = cache.file_identity(fname)
+    if npy_fname in _views and _views[npy_fname][0] == identity:
+        return _views[npy_fname][1]
+
+    # The stored copy is stamped like a stage output, so it's remade whenever the image changes
+    # It's checked and made under an flock of the image, which is let go however its holder ends, opened afresh so threads exclude each other too
+    lock_file = open(npy_fname + '.lock', 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        up_to_date, key = cache.check_stage([npy_fname], [fname])
+        if not up_to_date:
+            _decode(fname, npy_fname, ext=ext)
+            cache.mark_stage([npy_fname], key)
+    finally:
+        lock_file.close()
+
+    data = np.load(npy_fname, mmap_mode='r')
+    _views[npy_fname] = (identity, data)
+    return data
+
+def clear_store(store_dir):
+    """Removes a field's store directory and forgets the views this process has of it.
+
+    Views already handed out stay valid until they're dropped.
+
+    """
+    for npy_fname in list(_views):
+        if npy_fname.startswith(store_dir):
+            del _views[npy_fname]
+    shutil.rmtree(store_dir, ignore_errors=True)
@@ -0,0 +1,312 @@
+"""A module for sharing the tasks of a run between any number of workers on any number of machines, through a queue directory on a filesystem they all see.
+
+The planner (run_rms.py or make_detection_rms.py with --plan) writes each unit of work to the queue: a field and band for run_rms.py, or a whole field, bad pixel mask and all, for make_detection_rms.py. Workers (--work) claim units one at a time by creating a lock file, which only one of them can do, and keep the lock's modification time fresh while they run the unit. A lock that hasn't been touched for stale_after seconds belongs to a worker that died, and is taken over. Each finished unit leaves its run reports in the queue, and --collect gathers them up for the flag log and run report.
+
+Layout of the queue directory:
+
+    units/<name>.json    the unit, from plan
+    locks/<name>.lock    the worker running it, while it runs
+    done/<name>.json     its run reports, once it's finished
+
+"""
+
+import json
+import multiprocessing
+import socket
+import threading
+import time
+from os import O_CREAT, O_EXCL, O_WRONLY, close, getpid, link, listdir, makedirs, remove, rename, rmdir, utime, write
+from os import open as open_fd
+from os.path import exists, getmtime, join
+import pipeline
+import store
+
+# Seconds between touches of a running unit's lock, and since the last one before the lock is taken over
+HEARTBEAT_S = 30
+STALE_S = 600
+
+# Seconds between looks at the queue while every unit left is being run by someone else
+POLL_S = 10
+
+def _write_json(obj, fname):
+    """Writes JSON to a file in one step, so no reader ever sees half of it.
+
+    """
+    tmp_fname = '%s.%s.%d.tmp' % (fname, socket.gethostname(), getpid())
+    out_file = open(tmp_fname, 'w')
+    json.dump(obj, out_file, indent=1, sort_keys=True)
+    out_file.close()
+    rename(tmp_fname, fname)
+
+def _read_json(fname):
+    in_file = open(fname)
+    obj = json.load(in_file)
+    in_file.close()
+    return obj
+
+def _make_dir(dir_name):
+    try:
+        makedirs(dir_name)
+    except OSError:
+        if not exists(dir_name):
+            raise
+
+def unit_names(queue_dir):
+    """Lists the units in a queue, in the order they were planned.
+
+    """
+    return sorted(fname[:-5] for fname in listdir(queue_dir + 'units/') if fname.endswith('.json'))
+
+def plan(queue_dir, units):
+    """Writes the units of a run to a queue directory.
+
+    Units already in the queue are replaced, and their reports and locks are cleared, so planning again starts the run over. Units of an earlier plan that aren't in this one are removed, so they're neither run nor collected. The stages of each unit still skip whatever is up to date (see cache.py).
+
+    Parameters
+    ----------
+    queue_dir : str
+        The queue directory, on a filesystem every worker can see
+    units : list
+        Units from band_units or field_units
+
+    """
+    queue_dir = join(queue_dir, '')
+    for sub_dir in ('units/', 'locks/', 'done/'):
+        _make_dir(queue_dir + sub_dir)
+    planned = set(unit['name'] for unit in units)
+    for name in unit_names(queue_dir):
+        if name not in planned:
+            for fname in (queue_dir + 'units/' + name + '.json', queue_dir + 'done/' + name + '.json', queue_dir + 'locks/' + name + '.lock'):
+                if exists(fname):
+                    remove(fname)
+    for unit in units:
+        for fname in (queue_dir + 'done/' + unit['name'] + '.json', queue_dir + 'locks/' + unit['name'] + '.lock'):
+            if exists(fname):
+                remove(fname)
+        _write_json(unit, queue_dir + 'units/' + unit['name'] + '.json')
+    print "Planned %d units in %s" % (len(units), queue_dir)
+
+def band_units(tasks, store_root=None):
+    """Makes one unit for each task from pipeline.band_tasks, for run_rms.py.
+
+    The tasks should be made without a store_root. Each worker keeps its own store under the unit's store_root, as a store directory may be on a disk only its machine sees.
+
+    """
+    units = []
+    for field, band, field_band_dict, options in tasks:
+        name = field + '_' + band + ('_ext%d' % field_band_dict['ext'] if 'ext' in field_band_dict else '')
+        units.append({'name': name, 'field': field, 'mask': None, 'tasks': [[field, band, field_band_dict, options]], 'store_root': store_root})
+    return units
+
+def field_units(field_masks, tasks, store_root=None):
+    """Makes one unit for each field, for make_detection_rms.py, as its band tasks all need the field's bad pixel mask.
+
+    Parameters
+    ----------
+    field_masks : dict
+        Keyword arguments of pipeline.field_mask for each field, without store_dir
+    tasks : list
+        Tasks from pipeline.band_tasks, made without a store_root
+    store_root : str or None
+        Directory for each worker to keep its stores in
+
+    """
+    units = []
+    for field in sorted(field_masks):
+        field_tasks = [list(task) for task in tasks if task[0] == field]
+        units.append({'name': field, 'field': field, 'mask': field_masks[field], 'tasks': field_tasks, 'store_root': store_root})
+    return units
+
+def run_unit(unit, worker_name):
+    """Runs the mask stage (if any) and band tasks of a unit, returning their run reports.
+
+    """
+    store_dir = None
+    if unit['store_root'] is not None:
+        store_dir = unit['store_root'] + worker_name + '/' + unit['field'] + '/'
+
+    reports = []
+    try:
+        if unit['mask'] is not None:
+            reports.append(pipeline.field_mask(store_dir=store_dir, **unit['mask']))
+        for field, band, field_band_dict, options in unit['tasks']:
+            if store_dir is not None:
+                field_band_dict['store'] = store_dir
+            reports.append(pipeline.process_band((field, band, field_band_dict, options)))
+    finally:
+        if store_dir is not None:
+            store.clear_store(store_dir)
+            try:
+                rmdir(unit['store_root'] + worker_name + '/')
+            except OSError:
+                # Another unit of this worker's is still using it
+                pass
+    return reports
+
+def _claim(lock_fname, token, stale_after):
+    """Tries to take the lock of a unit, taking it over if it's gone stale.
+
+    Creating the lock file with O_EXCL succeeds for exactly one worker. A stale lock is first renamed out of the way, which likewise succeeds for only one of the workers that spot it. Another worker may have taken the lock over, or its owner touched it, between the look at it and the rename, so what was renamed is checked again, and put back if it isn't the stale lock that was seen.
+
+    Returns
+    -------
+    claimed : bool
+
+    """
+    try:
+        if time.time() - getmtime(lock_fname) > stale_after:
+            owner = open(lock_fname).read()
+            stale_fname = '%s.%s.stale' % (lock_fname, token)
+            rename(lock_fname, stale_fname)
+            if open(stale_fname).read() != owner or time.time() - getmtime(stale_fname) <= stale_after:
+                # A live lock: put it back, unless yet another has been made meanwhile
+                try:
+                    link(stale_fname, lock_fname)
+                finally:
+                    remove(stale_fname)
+                return False
+            print "Taking over stale unit %s from %s" % (lock_fname, owner)
+            remove(stale_fname)
+    except (IOError, OSError):
+        # No lock, or another worker took it over first
+        pass
+    try:
+        lock_fd = open_fd(lock_fname, O_CREAT | O_EXCL | O_WRONLY, 0644)
+    except OSError:
+        return False
+    write(lock_fd, token)
+    close(lock_fd)
+    return True
+
+def _heartbeat(lock_fname, token, stop, interval):
+    """Touches a lock every interval seconds until stop is set, or until the lock is no longer this worker's.
+
+    """
+    while not stop.wait(interval):
+        try:
+            if open(lock_fname).read() != token:
+                print "Lock %s has been taken over by another worker" % lock_fname
+                return
+            utime(lock_fname, None)
+        except (IOError, OSError):
+            pass
+
+def _release(lock_fname, token):
+    """Removes a lock, unless another worker has taken it over in the meantime.
+
+    """
+    try:
+        if open(lock_fname).read() == token:
+            remove(lock_fname)
+    except (IOError, OSError):
+        pass
+
+def work(queue_dir, heartbeat=HEARTBEAT_S, stale_after=STALE_S, poll=POLL_S):
+    """Claims and runs units from a queue until every unit in it is done.
+
+    Parameters
+    ----------
+    queue_dir : str
+        The queue directory
+    heartbeat : float
+        Seconds between touches of the lock of the running unit
+    stale_after : float
+        Seconds after the last touch before a lock is taken over. Should be several heartbeats
+    poll : float
+        Seconds to wait between looks at the queue while the only units left are being run by other workers
+
+    Returns
+    -------
+    n_run : int
+        Number of units this worker ran
+
+    """
+    queue_dir = join(queue_dir, '')
+    worker_name = '%s_%d' % (socket.gethostname(), getpid())
+    n_run = 0
+    while True:
+        waiting = False
+        for name in unit_names(queue_dir):
+            done_fname = queue_dir + 'done/' + name + '.json'
+            lock_fname = queue_dir + 'locks/' + name + '.lock'
+            if exists(done_fname):
+                continue
+            if not _claim(lock_fname, worker_name, stale_after):
+                waiting = True
+                continue
+            # The unit may have been finished between the check and the claim
+            if exists(done_fname):
+                _release(lock_fname, worker_name)
+                continue
+
+            stop = threading.Event()
+            beat = threading.Thread(target=_heartbeat, args=(lock_fname, worker_name, stop, heartbeat))
+            beat.daemon = True
+            beat.start()
+            try:
+                print "Worker %s running unit %s" % (worker_name, name)
+                reports = run_unit(_read_json(queue_dir + 'units/' + name + '.json'), worker_name)
+                _write_json({'worker': worker_name, 'reports': reports}, done_fname)
+                n_run += 1
+            finally:
+                stop.set()
+                beat.join()
+                _release(lock_fname, worker_name)
+        if not waiting:
+            return n_run
+        time.sleep(poll)
+
+def _work_process(args):
+    return work(*args)
+
+def work_pool(queue_dir, jobs=1, **kwargs):
+    """Runs jobs workers on this machine, each claiming units from the queue until they're all done.
+
+    """
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            n_runs = pool.map(_work_process, [(queue_dir, kwargs.get('heartbeat', HEARTBEAT_S), kwargs.get('stale_after', STALE_S), kwargs.get('poll', POLL_S))] * jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return sum(n_runs)
+    return work(queue_dir, **kwargs)
+
+def collect(queue_dir):
+    """Gathers the run reports of a queue's finished units.
+
+    Parameters
+    ----------
+    queue_dir : str
+        The queue directory
+
+    Returns
+    -------
+    tasks : list
+        The band tasks of every unit, as from pipeline.band_tasks
+    reports : list
+        Run reports of the finished units, sorted by field and band
+    flagged_imgs : list
+        Flag log entries of the finished units' reports, and an ERROR:unfinished entry for each unit that hasn't finished
+
+    """
+    queue_dir = join(queue_dir, '')
+    tasks = []
+    reports = []
+    unfinished = []
+    for name in unit_names(queue_dir):
+        unit = _read_json(queue_dir + 'units/' + name + '.json')
+        tasks += [tuple(task) for task in unit['tasks']]
+        done_fname = queue_dir + 'done/' + name + '.json'
+        if exists(done_fname):
+            reports += _read_json(done_fname)['reports']
+        else:
+            unfinished.append(name)
+
+    reports.sort(key=lambda report: (report['field'], report['band'], report.get('ext')))
+    flagged_imgs = pipeline.flag_entries(reports)
+    for name in unfinished:
+        print "Unit %s hasn't finished" % name
+        flagged_imgs.append(name + ' ERROR:unfinished ')
+    return tasks, reports, flagged_imgs
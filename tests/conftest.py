@@ -0,0 +1,8 @@
+"""Puts the package's modules, which live at the top of the repository, on the path of the tests.
+
+"""
+
+import sys
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
@@ -0,0 +1,62 @@
+"""Tests of when cache.check_stage finds a stage's outputs out of date.
+
+"""
+
+import os
+import time
+import cache
+
+def _stage(tmpdir):
+    in_fname = str(tmpdir.join('in.fits'))
+    out_fname = str(tmpdir.join('out.fits'))
+    open(in_fname, 'w').write('input')
+    return in_fname, out_fname
+
+def _run(in_fname, out_fname, params=None):
+    up_to_date, key = cache.check_stage([out_fname], [in_fname], params)
+    if not up_to_date:
+        open(out_fname, 'w').write('output')
+        cache.mark_stage([out_fname], key)
+    return up_to_date
+
+def _age(fname, seconds):
+    then = time.time() - seconds
+    os.utime(fname, (then, then))
+
+def test_stage_up_to_date_once_marked(tmpdir):
+    in_fname, out_fname = _stage(tmpdir)
+    assert not _run(in_fname, out_fname)
+    assert _run(in_fname, out_fname)
+
+def test_changed_input_makes_stage_stale(tmpdir):
+    in_fname, out_fname = _stage(tmpdir)
+    _run(in_fname, out_fname)
+    _age(in_fname, 100)
+    assert not _run(in_fname, out_fname)
+
+def test_changed_params_make_stage_stale(tmpdir):
+    in_fname, out_fname = _stage(tmpdir)
+    _run(in_fname, out_fname, {'wht_zero': 'inf'})
+    assert not _run(in_fname, out_fname, {'wht_zero': '100'})
+    assert _run(in_fname, out_fname, {'wht_zero': '100'})
+
+def test_touched_output_makes_stage_stale(tmpdir):
+    in_fname, out_fname = _stage(tmpdir)
+    _run(in_fname, out_fname)
+    _age(out_fname, 100)
+    assert not _run(in_fname, out_fname)
+
+def test_stale_stamped_output_is_cleared(tmpdir):
+    in_fname, out_fname = _stage(tmpdir)
+    _run(in_fname, out_fname)
+    up_to_date, key = cache.check_stage([out_fname], [in_fname], {'changed': True})
+    assert not up_to_date
+    assert not os.path.exists(out_fname) and not os.path.exists(cache.stamp_fname([out_fname]))
+
+def test_unstamped_output_is_kept_aside(tmpdir):
+    in_fname, out_fname = _stage(tmpdir)
+    open(out_fname, 'w').write('made before caching')
+    up_to_date, key = cache.check_stage([out_fname], [in_fname])
+    assert not up_to_date
+    assert not os.path.exists(out_fname)
+    assert open(out_fname + '.unstamped').read() == 'made before caching'
@@ -0,0 +1,72 @@
+"""Tests of writing multi-extension outputs with mef.py and putting the extensions of a band back together.
+
+"""
+
+import numpy as np
+from astropy.io import fits
+import instrument
+import mef
+import pipeline
+
+def _template(tmpdir):
+    # A primary header with no data, two chips and a table the output should keep
+    table = fits.BinTableHDU.from_columns([fits.Column(name='A', format='J', array=np.arange(3))])
+    hdus = [fits.PrimaryHDU(), fits.ImageHDU(np.ones((20, 30), dtype=np.float32)), fits.ImageHDU(np.ones((20, 30), dtype=np.float32)), table]
+    hdus[1].header['CHIP'] = 1
+    hdus[2].header['CHIP'] = 2
+    fname = str(tmpdir.join('wht.fits'))
+    fits.HDUList(hdus).writeto(fname)
+    return fname
+
+def _ext_images(tmpdir, exts=(1, 2)):
+    ext_fnames = {}
+    for ext in exts:
+        ext_fnames[ext] = mef.ext_fname(str(tmpdir.join('rms.fits')), ext)
+        fits.writeto(ext_fnames[ext], np.full((20, 30), float(ext), dtype=np.float32))
+    return ext_fnames
+
+def test_image_extensions(tmpdir):
+    assert mef.image_extensions(_template(tmpdir)) == [1, 2]
+    assert mef.is_mef([1, 2]) and not mef.is_mef([0])
+
+def test_write_mef_keeps_layout_and_adds_keywords(tmpdir):
+    template_fname = _template(tmpdir)
+    out_fname = str(tmpdir.join('out.fits'))
+    mef.write_mef(_ext_images(tmpdir), template_fname, out_fname, {2: [('NORMCONS', 1.5, 'norm constant')]})
+    out = fits.open(out_fname)
+    assert len(out) == 4 and out[0].data is None
+    assert np.all(out[1].data == 1.) and np.all(out[2].data == 2.)
+    assert out[1].header['CHIP'] == 1 and out[2].header['CHIP'] == 2
+    assert 'NORMCONS' not in out[1].header and out[2].header['NORMCONS'] == 1.5
+    assert np.array_equal(out[3].data['A'], np.arange(3))
+    out.close()
+
+def _tasks(tmpdir, template_fname, ext_fnames):
+    tasks = []
+    for ext in (1, 2):
+        band_dict = {'ext': ext, 'rms_norm': ext_fnames.get(ext, mef.ext_fname(str(tmpdir.join('rms.fits')), ext)), 'rms_mef': str(tmpdir.join('rms.fits')), 'wht': template_fname}
+        tasks.append(('f1', 'F160', band_dict, {}))
+    return tasks
+
+def _report(ext, norm_constant):
+    report = instrument.new_report('f1', 'F160', ext)
+    report['norm_constant'] = norm_constant
+    if norm_constant is not None:
+        report['norm_constant_ci'] = [norm_constant - 0.1, norm_constant + 0.1]
+    return report
+
+def test_merge_extensions_writes_each_constant(tmpdir):
+    template_fname = _template(tmpdir)
+    tasks = _tasks(tmpdir, template_fname, _ext_images(tmpdir))
+    assert pipeline.merge_extensions(tasks, [_report(1, 1.2), _report(2, 0.9)]) == []
+    out = fits.open(str(tmpdir.join('rms.fits')))
+    assert out[1].header['NORMCONS'] == 1.2 and out[2].header['NORMCONS'] == 0.9
+    assert np.isclose(out[2].header['NORMCILO'], 0.8)
+    out.close()
+
+def test_merge_extensions_flags_failed_extension(tmpdir):
+    template_fname = _template(tmpdir)
+    tasks = _tasks(tmpdir, template_fname, _ext_images(tmpdir, exts=(1,)))
+    flagged = pipeline.merge_extensions(tasks, [_report(1, 1.2), _report(2, None)])
+    assert flagged == ['f1_F160 ERROR:MEF:2 ']
+    assert not tmpdir.join('rms.fits').exists()
@@ -0,0 +1,157 @@
+"""Tests of the false source placement and catalog parsing of noise.py.
+
+"""
+
+import numpy as np
+import noise
+
+def test_allowed_centres_clears_border():
+    wht = np.ones((20, 30))
+    seg = np.zeros((20, 30), dtype=np.int32)
+    allowed = noise.allowed_centres(wht, seg, r=3)
+    assert not allowed[:3].any() and not allowed[-3:].any()
+    assert not allowed[:, :3].any() and not allowed[:, -3:].any()
+    assert allowed[3:-3, 3:-3].all()
+
+def test_allowed_centres_zero_radius_keeps_whole_map():
+    wht = np.ones((10, 12))
+    seg = np.zeros((10, 12), dtype=np.int32)
+    seg[4, 5] = 1
+    allowed = noise.allowed_centres(wht, seg, r=0)
+    assert allowed.sum() == allowed.size - 1
+    assert not allowed[4, 5]
+
+def test_allowed_centres_excludes_disk_around_bad_pixels():
+    wht = np.ones((41, 41))
+    seg = np.zeros((41, 41), dtype=np.int32)
+    wht[20, 20] = 0
+    allowed = noise.allowed_centres(wht, seg, r=4)
+    rows, cols = np.indices(allowed.shape)
+    near = (rows - 20)**2 + (cols - 20)**2 <= 16
+    assert not allowed[near].any()
+    inside = (rows >= 4) & (rows < 37) & (cols >= 4) & (cols < 37)
+    assert allowed[inside & ~near].all()
+
+def test_allowed_centres_strips_match_whole_image():
+    np.random.seed(0)
+    wht = (np.random.rand(57, 43) > 0.02).astype(float)
+    seg = (np.random.rand(57, 43) > 0.99).astype(np.int32)
+    whole = noise.allowed_centres(wht, seg, r=5, block_rows=1000)
+    for block_rows in (1, 4, 10):
+        assert np.array_equal(noise.allowed_centres(wht, seg, r=5, block_rows=block_rows), whole)
+
+HEADER = ['#   1 NUMBER                 Running object number\n',
+          '#   2 X_IMAGE                Object position along x    [pixel]\n',
+          '#   3 FLAGS                  Extraction flags\n',
+          '#   4 FLUX_APER              Flux vector within fixed circular aperture(s)    [count]\n']
+
+def test_parse_ascii_catalog_splits_vectors_and_types_by_name():
+    rows = ['         1 2.0 3 1.0 2.0 3.0\n', '         2 5.5 0 4.0 5.0 6.0\n']
+    cat = noise.parse_ascii_catalog(HEADER + rows)
+    assert cat.dtype.names == ('NUMBER', 'X_IMAGE', 'FLAGS', 'FLUX_APER_1', 'FLUX_APER_2', 'FLUX_APER_3')
+    assert cat.dtype['NUMBER'].kind == 'i' and cat.dtype['FLAGS'].kind == 'i'
+    # Written as a whole number, but a float parameter all the same
+    assert cat.dtype['X_IMAGE'].kind == 'f'
+    assert np.array_equal(cat['FLUX_APER_3'], [3., 6.])
+
+def test_parse_ascii_catalog_chunks():
+    rows = ['%d 1.5 0 1 2 3\n' % n for n in range(1, 26)]
+    cat = noise.parse_ascii_catalog(HEADER + rows, chunk_lines=7)
+    assert np.array_equal(cat['NUMBER'], np.arange(1, 26))
+
+def test_parse_ascii_catalog_empty_takes_widths_from_param_file(tmpdir):
+    param_fname = str(tmpdir.join('test.param'))
+    open(param_fname, 'w').write('NUMBER\nX_IMAGE\nFLAGS\nFLUX_APER(3)\n')
+    full = noise.parse_ascii_catalog(HEADER + ['1 2.0 3 1.0 2.0 3.0\n'])
+    empty = noise.parse_ascii_catalog(HEADER, param_fname=param_fname)
+    assert len(empty) == 0
+    assert empty.dtype == full.dtype
+
+def _false_catalog(n_src, realisations=1, seed=0):
+    rng = np.random.RandomState(seed)
+    cat = np.empty(n_src * realisations, dtype=noise.catalog_dtype(['REALISATION', 'FLUX_APER', 'FLUXERR_APER'], [1, 2, 2]))
+    cat['REALISATION'] = np.arange(len(cat)) // n_src
+    for a in (1, 2):
+        cat['FLUX_APER_%d' % a] = rng.normal(0, 2. * a, len(cat))
+        cat['FLUXERR_APER_%d' % a] = rng.uniform(0.5, 1.5, len(cat)) * a
+    return cat
+
+def test_realisation_norm_constants_match_each_subset():
+    cat = _false_catalog(50, realisations=3)
+    consts, counts = noise.realisation_norm_constants(cat, cat['REALISATION'], aperture=2)
+    assert np.array_equal(counts, [50, 50, 50])
+    for k in range(3):
+        assert np.isclose(consts[k], noise.rms_norm_constant(cat[cat['REALISATION'] == k], aperture=2)[0])
+
+def test_weighted_norm_constants_match_repeated_sources():
+    cat = _false_catalog(21)
+    weights = np.array([np.ones(21), np.arange(21) % 3])
+    consts = noise._weighted_norm_constants(cat['FLUX_APER_1'], cat['FLUXERR_APER_1'], weights)
+    repeated = np.repeat(np.arange(21), (np.arange(21) % 3).astype(int))
+    assert np.isclose(consts[0], noise.rms_norm_constant(cat, aperture=1)[0])
+    assert np.isclose(consts[1], noise.rms_norm_constant(cat[repeated], aperture=1)[0])
+
+def test_bootstrap_resamples_whole_realisations():
+    cat = _false_catalog(40, realisations=5)
+    by_source = noise.bootstrap_norm_constant(cat, n_boot=400, seed=1, aperture=1)
+    by_realisation = noise.bootstrap_norm_constant(cat, n_boot=400, seed=1, aperture=1, realisations=cat['REALISATION'])
+    assert by_source != by_realisation
+    const = noise.rms_norm_constant(cat, aperture=1)[0]
+    assert by_realisation[0] < const < by_realisation[1]
+    # A single realisation falls back on resampling the sources
+    assert noise.bootstrap_norm_constant(cat, n_boot=400, seed=1, aperture=1, realisations=np.zeros(len(cat))) == by_source
+
+def test_place_separated_sources_keeps_sources_apart_and_allowed():
+    np.random.seed(2)
+    allowed = np.zeros((200, 200), dtype=bool)
+    allowed[20:180, 40:160] = True
+    x, y = noise.place_separated_sources(allowed, 30, 15.)
+    assert len(x) == 30
+    assert allowed[y - 1, x - 1].all()
+    dist2 = (x[:, None] - x[None, :])**2 + (y[:, None] - y[None, :])**2
+    assert dist2[~np.eye(30, dtype=bool)].min() >= 15**2
+
+def test_place_separated_sources_raises_without_room():
+    np.random.seed(3)
+    allowed = np.zeros((50, 50), dtype=bool)
+    allowed[10:40, 10:40] = True
+    try:
+        noise.place_separated_sources(allowed, 20, 25., max_rounds=5)
+    except ValueError:
+        pass
+    else:
+        assert False, "placed 20 sources 25 pixels apart in a 30 pixel box"
+
+def test_bootstrap_interval_covers_constant_and_narrows_with_more_sources():
+    few = _false_catalog(100, seed=4)
+    many = _false_catalog(2000, seed=4)
+    low, high = noise.bootstrap_norm_constant(few, n_boot=500, seed=0, aperture=1)
+    assert low < noise.rms_norm_constant(few, aperture=1)[0] < high
+    many_low, many_high = noise.bootstrap_norm_constant(many, n_boot=500, seed=0, aperture=1)
+    assert many_high - many_low < 0.5 * (high - low)
+    # Seeded, so the same every time
+    assert noise.bootstrap_norm_constant(few, n_boot=500, seed=0, aperture=1) == (low, high)
+
+def test_fit_noise_curve_recovers_relation():
+    diameters = np.array([2., 4., 8., 16.])
+    consts = noise.noise_curve_constant(1.3, 0.8, diameters)
+    alpha, beta = noise.fit_noise_curve(diameters, consts)
+    assert np.isclose(alpha, 1.3) and np.isclose(beta, 0.8)
+    # Uncorrelated noise has the same constant in every aperture
+    assert np.isclose(noise.fit_noise_curve(diameters, np.full(4, 1.1))[1], 0.5)
+
+def test_tiled_norm_constants_follow_noise_across_image():
+    rng = np.random.RandomState(5)
+    n_src = 4000
+    x = rng.uniform(1, 400, n_src)
+    y = rng.uniform(1, 200, n_src)
+    cat = np.zeros(n_src, dtype=noise.catalog_dtype(['X_IMAGE', 'Y_IMAGE', 'FLUX_APER', 'FLUXERR_APER'], [1, 1, 2, 2]))
+    cat['X_IMAGE'] = x
+    cat['Y_IMAGE'] = y
+    # The errors underestimate the noise by half as much again on the right of the image
+    cat['FLUX_APER_1'] = rng.normal(0, np.where(x > 200, 1.5, 1.), n_src)
+    cat['FLUXERR_APER_1'] = 1.
+    norm_grid, counts = noise.tiled_norm_constants(cat, (200, 400), tile_size=100, filter_size=1, aperture=1)
+    assert norm_grid.shape == (2, 4) and counts.sum() == n_src
+    assert norm_grid[:, :2].max() < norm_grid[:, 2:].min()
+    assert abs(norm_grid[:, 2:].mean() / norm_grid[:, :2].mean() - 1.5) < 0.15
@@ -0,0 +1,56 @@
+"""Tests of the mesh background and aperture photometry of photometry.py.
+
+"""
+
+import numpy as np
+import photometry
+
+def test_aperture_photometry_flat_image():
+    sci = np.full((60, 60), 2.)
+    rms = np.full((60, 60), 0.5)
+    flux, fluxerr = photometry.aperture_photometry(sci, rms, [30.], [30.], [4., 10.])
+    area = np.pi * np.array([2., 5.])**2
+    assert np.allclose(flux[0], 2. * area, rtol=0.01)
+    assert np.allclose(fluxerr[0], 0.5 * np.sqrt(area), rtol=0.01)
+
+def test_aperture_photometry_subtracts_background_and_adds_poisson_term():
+    sci = np.full((64, 64), 3.)
+    rms = np.ones((64, 64))
+    back_grid = np.full((2, 2), 3.)
+    flux, fluxerr = photometry.aperture_photometry(sci, rms, [20.], [40.], [6.], back_grid=back_grid, back_size=32)
+    assert np.allclose(flux, 0.)
+    sci[37:44, 17:24] += 10.
+    flux, fluxerr = photometry.aperture_photometry(sci, rms, [20.], [40.], [6.], gain=2., back_grid=back_grid, back_size=32)
+    no_gain = photometry.aperture_photometry(sci, rms, [20.], [40.], [6.], back_grid=back_grid, back_size=32)[1]
+    assert flux[0, 0] > 0
+    assert np.isclose(fluxerr[0, 0]**2, no_gain[0, 0]**2 + flux[0, 0] / 2.)
+
+def test_aperture_photometry_flags_infinite_rms():
+    sci = np.ones((60, 60))
+    rms = np.ones((60, 60))
+    rms[30, 32] = np.inf
+    flux, fluxerr = photometry.aperture_photometry(sci, rms, [31., 11.], [31., 11.], [2., 10.])
+    # Only the big aperture around the first position reaches the bad pixel
+    assert np.isnan(flux[0, 1]) and np.isnan(fluxerr[0, 1])
+    assert np.isfinite(fluxerr[0, 0]) and np.isfinite(fluxerr[1]).all()
+
+def test_mesh_background_of_noise_with_sources():
+    rng = np.random.RandomState(0)
+    sci = 5. + rng.normal(0, 1., (128, 128))
+    sci[20:26, 20:26] += 500.
+    back_grid, rms_grid = photometry.mesh_background(sci, back_size=32, filter_size=1, with_rms=True)
+    assert back_grid.shape == (4, 4)
+    assert np.allclose(back_grid, 5., atol=0.2)
+    assert np.allclose(rms_grid, 1., atol=0.15)
+
+def test_mesh_background_leaves_out_bad_pixels():
+    sci = np.ones((64, 64))
+    sci[:32, :32] = 1000.
+    wht = np.ones((64, 64))
+    wht[:32, :16] = 0
+    mask = np.zeros((64, 64), dtype=np.int32)
+    mask[:32, 16:32] = 1
+    back_grid = photometry.mesh_background(sci, back_size=32, filter_size=1, wht_data=wht, mask_data=mask)
+    # The mesh of nothing but bad pixels is empty, and takes its neighbours' value through the filter
+    assert np.allclose(back_grid[1], 1.) and np.allclose(back_grid[0, 1], 1.)
+    assert np.isclose(photometry.mesh_background(sci, back_size=32, filter_size=3, wht_data=wht, mask_data=mask)[0, 0], 1.)
@@ -0,0 +1,61 @@
+"""Tests of the RMS map conversions and normalisation surface of rms_tools.py.
+
+"""
+
+import numpy as np
+import photometry
+import rms_tools as rms
+
+def _original_rms_from_wht(weight_data, zero_handle='inf'):
+    # The element by element loops rms_from_wht replaced
+    weight_data = weight_data.copy()
+    for x in np.nditer(weight_data, op_flags=['readwrite']):
+        if zero_handle == 'inf' or not x == 0:
+            x[...] = 1/np.sqrt(np.absolute(x))
+        else:
+            x[...] = float(zero_handle)
+    return weight_data
+
+def _original_scale_rms(rms_data, norm_const):
+    rms_data = rms_data.copy()
+    for x in np.nditer(rms_data, op_flags=['readwrite']):
+        x[...] = x * norm_const
+    return rms_data
+
+def _weights(dtype):
+    rng = np.random.RandomState(0)
+    weights = rng.lognormal(0, 2, (40, 50)).astype(dtype)
+    weights[::7, ::3] = 0
+    weights[5, :10] *= -1
+    return weights
+
+def test_rms_from_wht_bit_identical_to_original():
+    with np.errstate(divide='ignore'):
+        for dtype in (np.float32, np.float64, '>f4'):
+            for zero_handle in ('inf', '100'):
+                expected = _original_rms_from_wht(_weights(dtype), zero_handle)
+                assert np.array_equal(rms.rms_from_wht(_weights(dtype), zero_handle), expected)
+
+def test_scale_rms_bit_identical_to_original():
+    with np.errstate(divide='ignore'):
+        for dtype in (np.float32, np.float64, '>f4'):
+            rms_data = rms.rms_from_wht(_weights(dtype), '100')
+            for norm_const in (0.8734567891234, 1.1, 2.):
+                scaled = rms.scale_rms(rms_data.copy(), norm_const)
+                assert scaled.dtype == rms_data.dtype
+                assert np.array_equal(scaled, _original_scale_rms(rms_data, norm_const))
+
+def test_norm_surface_constant_grid():
+    surface = rms.norm_surface(np.full((3, 4), 1.25), 50, 10, 90, 180)
+    assert surface.shape == (80, 180)
+    assert np.allclose(surface, 1.25)
+
+def test_norm_surface_matches_background_at_and_strips():
+    rng = np.random.RandomState(1)
+    norm_grid = rng.uniform(0.8, 1.2, (4, 5))
+    n_rows, n_cols = 190, 230
+    whole = rms.norm_surface(norm_grid, 50, 0, n_rows, n_cols)
+    rows, cols = np.mgrid[0:n_rows, 0:n_cols]
+    assert np.allclose(whole, photometry.background_at(norm_grid, cols, rows, 50))
+    strips = np.vstack([rms.norm_surface(norm_grid, 50, start, stop, n_cols) for start, stop in rms.row_blocks(n_rows, 37)])
+    assert np.array_equal(strips, whole)
@@ -0,0 +1,40 @@
+"""Tests of the memory estimates of scheduler.py.
+
+"""
+
+import numpy as np
+from astropy.io import fits
+import scheduler
+
+def _task(tmpdir, shape=(200, 300), options=None):
+    sci_fname = str(tmpdir.join('sci.fits'))
+    wht_fname = str(tmpdir.join('wht.fits'))
+    fits.writeto(sci_fname, np.zeros(shape, dtype=np.float32))
+    fits.writeto(wht_fname, np.zeros(shape, dtype=np.float64))
+    return ('f1', 'F160', {'sci': sci_fname, 'wht': wht_fname}, options or {})
+
+def test_task_memory_whole_images(tmpdir):
+    n_pixels = 200 * 300
+    # Weight (8), science (4), segmentation (4), allowed centres (1) and the float64 false image (8)
+    expected = scheduler.BASE_MEMORY + n_pixels * (8 + 4 + 4 + 1 + 8) + scheduler.STRIP_ARRAYS * 8 * n_pixels
+    assert scheduler.task_memory(_task(tmpdir)) == expected
+
+def test_task_memory_smaller_with_block_rows(tmpdir):
+    whole = scheduler.task_memory(_task(tmpdir.mkdir('whole')))
+    streamed = scheduler.task_memory(_task(tmpdir.mkdir('streamed'), options={'block_rows': 20}))
+    assert streamed < whole
+    assert streamed == scheduler.BASE_MEMORY + 200 * 300 * (8 + 4 + 4 + 1) + scheduler.STRIP_ARRAYS * 8 * 20 * 300
+
+def test_task_memory_counts_mask(tmpdir):
+    task = _task(tmpdir)
+    mask_fname = str(tmpdir.join('mask.fits'))
+    fits.writeto(mask_fname, np.zeros((200, 300), dtype=np.int16))
+    masked = scheduler.task_memory(task[:3] + ({'mask': mask_fname},))
+    missing = scheduler.task_memory(task[:3] + ({'mask': str(tmpdir.join('not_made_yet.fits'))},))
+    assert masked - scheduler.task_memory(task) == 2 * 200 * 300
+    assert missing - scheduler.task_memory(task) == 4 * 200 * 300
+
+def test_task_memory_scales_with_image_size(tmpdir):
+    small = scheduler.task_memory(_task(tmpdir.mkdir('small'), shape=(100, 100))) - scheduler.BASE_MEMORY
+    large = scheduler.task_memory(_task(tmpdir.mkdir('large'), shape=(200, 200))) - scheduler.BASE_MEMORY
+    assert large == 4 * small
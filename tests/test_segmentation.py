@@ -0,0 +1,50 @@
+"""Tests of the in-process segmentation map of segmentation.py.
+
+"""
+
+import numpy as np
+from astropy.io import fits
+import segmentation
+
+SEX_CONFIG = 'BACK_SIZE 32\nBACK_FILTERSIZE 3\nFILTER Y\nFILTER_NAME gauss_2.0_5x5.conv\nDETECT_THRESH 3.0\nDETECT_MINAREA 5\n'
+
+def _images(tmpdir):
+    rng = np.random.RandomState(0)
+    sci = 10. + rng.normal(0, 1., (96, 128)).astype(np.float32)
+    rows, cols = np.mgrid[0:96, 0:128]
+    for y0, x0 in ((11, 30), (60, 90)):
+        sci += 40. * np.exp(-((rows - y0)**2 + (cols - x0)**2) / 8.)
+    # A single hot pixel, smoothed away by the detection filter
+    sci[80, 20] += 8.
+    rms = np.ones((96, 128), dtype=np.float32)
+    sex_fname = str(tmpdir.join('seg.sex'))
+    open(sex_fname, 'w').write(SEX_CONFIG)
+    fits.writeto(str(tmpdir.join('sci.fits')), sci)
+    fits.writeto(str(tmpdir.join('rms.fits')), rms)
+    return str(tmpdir.join('sci.fits')), str(tmpdir.join('rms.fits')), sex_fname
+
+def test_segmentation_map_finds_sources(tmpdir):
+    sci_fname, rms_fname, sex_fname = _images(tmpdir)
+    seg_fname = str(tmpdir.join('seg.fits'))
+    n_objects = segmentation.segmentation_map(sci_fname, rms_fname, seg_fname, sex_fname=sex_fname, block_rows=None)
+    seg = fits.getdata(seg_fname)
+    assert n_objects == 2
+    assert seg[11, 30] != 0 and seg[60, 90] != 0 and seg[11, 30] != seg[60, 90]
+    assert seg[80, 20] == 0
+    assert set(np.unique(seg)) == set([0, 1, 2])
+
+def test_segmentation_map_strips_match_whole_image(tmpdir):
+    sci_fname, rms_fname, sex_fname = _images(tmpdir)
+    segmentation.segmentation_map(sci_fname, rms_fname, str(tmpdir.join('whole.fits')), sex_fname=sex_fname, block_rows=None)
+    # Strips of 10 rows split the first source across a boundary
+    segmentation.segmentation_map(sci_fname, rms_fname, str(tmpdir.join('strips.fits')), sex_fname=sex_fname, block_rows=10)
+    assert np.array_equal(fits.getdata(str(tmpdir.join('strips.fits'))), fits.getdata(str(tmpdir.join('whole.fits'))))
+
+def test_segmentation_map_skips_infinite_rms(tmpdir):
+    sci_fname, rms_fname, sex_fname = _images(tmpdir)
+    rms = fits.getdata(rms_fname).copy()
+    rms[50:70, 80:100] = np.inf
+    fits.writeto(rms_fname, rms, overwrite=True)
+    n_objects = segmentation.segmentation_map(sci_fname, rms_fname, str(tmpdir.join('seg.fits')), sex_fname=sex_fname)
+    assert n_objects == 1
+    assert fits.getdata(str(tmpdir.join('seg.fits')))[60, 90] == 0
@@ -0,0 +1,62 @@
+"""Tests of the lock claiming and heartbeats of taskqueue.py.
+
+"""
+
+import threading
+import time
+from os import utime
+from os.path import exists, getmtime
+import taskqueue
+
+def _age(fname, seconds):
+    old = time.time() - seconds
+    utime(fname, (old, old))
+
+def test_claim_only_once(tmpdir):
+    lock_fname = str(tmpdir.join('unit.lock'))
+    assert taskqueue._claim(lock_fname, 'worker1', stale_after=60)
+    assert not taskqueue._claim(lock_fname, 'worker2', stale_after=60)
+    assert open(lock_fname).read() == 'worker1'
+
+def test_claim_takes_over_stale_lock(tmpdir):
+    lock_fname = str(tmpdir.join('unit.lock'))
+    taskqueue._claim(lock_fname, 'worker1', stale_after=60)
+    _age(lock_fname, 120)
+    assert taskqueue._claim(lock_fname, 'worker2', stale_after=60)
+    assert open(lock_fname).read() == 'worker2'
+    assert tmpdir.listdir() == [tmpdir.join('unit.lock')]
+
+def test_release_leaves_lock_taken_over(tmpdir):
+    lock_fname = str(tmpdir.join('unit.lock'))
+    taskqueue._claim(lock_fname, 'worker1', stale_after=60)
+    _age(lock_fname, 120)
+    taskqueue._claim(lock_fname, 'worker2', stale_after=60)
+    taskqueue._release(lock_fname, 'worker1')
+    assert exists(lock_fname)
+    taskqueue._release(lock_fname, 'worker2')
+    assert not exists(lock_fname)
+
+def test_heartbeat_keeps_lock_fresh(tmpdir):
+    lock_fname = str(tmpdir.join('unit.lock'))
+    taskqueue._claim(lock_fname, 'worker1', stale_after=60)
+    _age(lock_fname, 120)
+    stop = threading.Event()
+    beat = threading.Thread(target=taskqueue._heartbeat, args=(lock_fname, 'worker1', stop, 0.05))
+    beat.start()
+    time.sleep(0.3)
+    stop.set()
+    beat.join()
+    assert time.time() - getmtime(lock_fname) < 60
+    assert not taskqueue._claim(lock_fname, 'worker2', stale_after=60)
+
+def test_heartbeat_stops_once_lock_taken_over(tmpdir):
+    lock_fname = str(tmpdir.join('unit.lock'))
+    taskqueue._claim(lock_fname, 'worker1', stale_after=60)
+    stop = threading.Event()
+    beat = threading.Thread(target=taskqueue._heartbeat, args=(lock_fname, 'worker1', stop, 0.05))
+    beat.start()
+    open(lock_fname, 'w').write('worker2')
+    beat.join(5)
+    assert not beat.is_alive()
+    stop.set()
+    assert open(lock_fname).read() == 'worker2'
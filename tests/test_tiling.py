@@ -0,0 +1,46 @@
+"""Tests of the tile layout and catalog merging of tiling.py.
+
+"""
+
+import numpy as np
+import noise
+import tiling
+
+def test_tile_regions_cores_cover_image_once():
+    shape = (250, 190)
+    regions = tiling.tile_regions(shape, 64, 16)
+    cover = np.zeros(shape, dtype=int)
+    for (y0, y1, x0, x1), pad in regions:
+        cover[y0:y1, x0:x1] += 1
+    assert (cover == 1).all()
+
+def test_tile_regions_pads_grow_cores_within_image():
+    regions = tiling.tile_regions((250, 190), 64, 16)
+    for core, pad in regions:
+        assert pad[0] == max(core[0] - 16, 0) and pad[1] == min(core[1] + 16, 250)
+        assert pad[2] == max(core[2] - 16, 0) and pad[3] == min(core[3] + 16, 190)
+
+def _tile_catalog(x, y):
+    cat = np.zeros(len(x), dtype=noise.catalog_dtype(['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'FLUX_APER'], [1, 1, 1, 2]))
+    cat['NUMBER'] = np.arange(1, len(x) + 1)
+    cat['X_IMAGE'] = x
+    cat['Y_IMAGE'] = y
+    return cat
+
+def test_merge_catalogs_keeps_each_object_once_from_its_core():
+    regions = tiling.tile_regions((100, 200), 100, 20)
+    # An object at image x = 95.3 is in the overlap, so both tiles see it, but only the first tile's core holds it
+    left = _tile_catalog([10., 95.3], [50., 50.])
+    right = _tile_catalog([95.3 - 80, 150. - 80], [50., 50.])
+    cat = tiling.merge_catalogs([left, right], regions)
+    assert len(cat) == 3
+    assert np.allclose(sorted(cat['X_IMAGE']), [10., 95.3, 150.])
+
+def test_merge_catalogs_owner_at_core_edge():
+    regions = tiling.tile_regions((100, 200), 100, 20)
+    # Pixel centres are at whole numbers counting from 1, so x = 100.6 is in pixel 100, the first of the second core
+    left = _tile_catalog([100.6], [50.])
+    right = _tile_catalog([100.6 - 80], [50.])
+    cat = tiling.merge_catalogs([left, right], regions)
+    assert len(cat) == 1
+    assert np.allclose(cat['X_IMAGE'], [100.6])
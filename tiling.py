@@ -0,0 +1,375 @@
+"""A module for running the SExtractor stages on overlapping tiles of a big image, several at once, in place of one run on the whole frame.
+
+SExtractor's memory and run time grow faster than the image on the largest mosaics. In tiled mode each image of a run (science, RMS and false source images) is cut into tile_size x tile_size tiles with overlap pixels of the neighbouring tiles around them, read through a memory map a section at a time, and SExtractor is run on the tiles in parallel. Every tile owns the objects whose centre is in its core, the part of it no other tile covers, so an object seen by two tiles is only kept once: the segmentation maps are stitched into a full size map written a tile at a time through a memory map, and the catalogs are merged into one with the positions moved onto the full image and the objects numbered to match the map. The overlap should be wider than the biggest object, so the tile that owns an object sees all of it.
+
+"""
+
+import multiprocessing
+import re
+import numpy as np
+from astropy.io import fits
+from astropy.io.fits.hdu.base import DTYPE2BITPIX
+from multiprocessing.pool import ThreadPool
+from os import makedirs, remove
+from os.path import exists
+import shutil
+import mef
+import noise
+import sex_profiles
+import store
+from rms_tools import run_sextractor
+
+# Catalog columns of x and y pixel positions, moved from tile to image coordinates when the catalogs are merged
+X_COLUMN = re.compile(r'^X(WIN|PEAK|MIN|MAX|PSF|MODEL)?_IMAGE$')
+Y_COLUMN = re.compile(r'^Y(WIN|PEAK|MIN|MAX|PSF|MODEL)?_IMAGE$')
+
+def tile_regions(shape, tile_size, overlap):
+    """Splits an image into tiles.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image (rows, columns)
+    tile_size : int
+        Size of the core of each tile in pixels
+    overlap : int
+        Pixels of the neighbouring tiles to include around each core
+
+    Returns
+    -------
+    regions : list
+        (core, pad) of each tile, each a (y0, y1, x0, x1) slice of the image. The cores cover the image without overlapping, and each pad is its core grown by overlap pixels within the image
+
+    """
+    n_rows, n_cols = shape
+    regions = []
+    for y0 in range(0, n_rows, tile_size):
+        for x0 in range(0, n_cols, tile_size):
+            core = (y0, min(y0 + tile_size, n_rows), x0, min(x0 + tile_size, n_cols))
+            pad = (max(y0 - overlap, 0), min(core[1] + overlap, n_rows), max(x0 - overlap, 0), min(core[3] + overlap, n_cols))
+            regions.append((core, pad))
+    return regions
+
+def cut_tile(fname, tile_fname, pad, ext=0, store_dir=None):
+    """Writes a section of an image to a file of its own, reading only that section through a memory map.
+
+    The WCS reference pixel is moved with the section, so positions on the tile still map onto the sky.
+
+    Parameters
+    ----------
+    fname, tile_fname : str
+        Filenames of the image and of the tile to write
+    pad : tuple
+        (y0, y1, x0, x1) section of the image
+    ext : int
+        Index of the image HDU, for multi-extension files
+    store_dir : str or None
+        If given, read the image through the field's store (see store.py) instead of from the FITS file
+
+    """
+    y0, y1, x0, x1 = pad
+    hdu_list = fits.open(fname, memmap=True, ignore_missing_end=True)
+    try:
+        in_hdu = hdu_list[ext]
+        in_rows = in_hdu.section if store_dir is None else store.image_data(fname, store_dir, ext)
+        data = np.array(in_rows[y0:y1, x0:x1])
+        header = mef.primary_header(in_hdu.header)
+        header.remove('BSCALE', ignore_missing=True)
+        header.remove('BZERO', ignore_missing=True)
+        for key, offset in (('CRPIX1', x0), ('CRPIX2', y0)):
+            if key in header:
+                header[key] -= offset
+    finally:
+        hdu_list.close()
+    fits.writeto(tile_fname, data, header, overwrite=True)
+
+def blank_image(fname, shape, dtype, template_header):
+    """Makes a FITS image of zeros without holding it in memory, by writing its header and extending the file to size.
+
+    """
+    header = mef.primary_header(template_header)
+    header.remove('BSCALE', ignore_missing=True)
+    header.remove('BZERO', ignore_missing=True)
+    header['BITPIX'] = DTYPE2BITPIX[np.dtype(dtype).name]
+    header['NAXIS1'] = shape[1]
+    header['NAXIS2'] = shape[0]
+    header.tofile(fname, overwrite=True)
+    n_bytes = len(header.tostring()) + shape[0] * shape[1] * np.dtype(dtype).itemsize
+    out_file = open(fname, 'rb+')
+    out_file.seek(-(-n_bytes // 2880) * 2880 - 1)
+    out_file.write(b'\0')
+    out_file.close()
+
+def owned_labels(tile_seg, core, pad):
+    """Works out which objects of a tile's segmentation map are the tile's own, those whose centre is in its core.
+
+    Returns
+    -------
+    owned : numpy array
+        Whether each label of the map, from 0 (no object) to its highest, belongs to the tile
+
+    """
+    n_labels = tile_seg.max() + 1
+    rows, cols = np.indices(tile_seg.shape)
+    labels = tile_seg.ravel()
+    counts = np.bincount(labels, minlength=n_labels)
+    with np.errstate(invalid='ignore'):
+        centre_y = np.floor(np.bincount(labels, weights=rows.ravel(), minlength=n_labels) / counts + 0.5) + pad[0]
+        centre_x = np.floor(np.bincount(labels, weights=cols.ravel(), minlength=n_labels) / counts + 0.5) + pad[2]
+        owned = (counts > 0) & (centre_y >= core[0]) & (centre_y < core[1]) & (centre_x >= core[2]) & (centre_x < core[3])
+    owned[0] = False
+    return owned
+
+def stitch_segmentation(tile_segs, regions, shape, seg_fname, template_header):
+    """Puts the segmentation maps of the tiles together into one map of the whole image, keeping each object from the tile that owns it.
+
+    The map is made on disk and each tile's objects are written into their section of it through a memory map, so the whole map is never held in memory. An object's pixels are written wherever no other object has been.
+
+    Parameters
+    ----------
+    tile_segs : list
+        Filename of the segmentation map of each tile
+    regions : list
+        (core, pad) of each tile, from tile_regions
+    shape : tuple
+        Shape of the image
+    seg_fname : str
+        Filename of the stitched map
+    template_header : astropy Header
+        Header of the image, for the stitched map's
+
+    Returns
+    -------
+    label_maps : list
+        For each tile, the number in the stitched map of each of its labels, 0 for the objects it doesn't own
+
+    """
+    blank_image(seg_fname, shape, np.int32, template_header)
+    out_list = fits.open(seg_fname, mode='update', memmap=True)
+    label_maps = []
+    n_objects = 0
+    try:
+        out_data = out_list[0].data
+        for tile_seg_fname, (core, pad) in zip(tile_segs, regions):
+            tile_seg = fits.getdata(tile_seg_fname).astype(np.int64)
+            owned = owned_labels(tile_seg, core, pad)
+            label_map = np.zeros(len(owned), dtype=np.int64)
+            label_map[owned] = np.arange(n_objects + 1, n_objects + owned.sum() + 1)
+            n_objects += owned.sum()
+            label_maps.append(label_map)
+
+            section = out_data[pad[0]:pad[1], pad[2]:pad[3]]
+            new_labels = label_map[tile_seg]
+            paint = (new_labels != 0) & (section == 0)
+            section[paint] = new_labels[paint]
+    finally:
+        out_list.close()
+    return label_maps
+
+def merge_catalogs(tile_cats, regions, label_maps=None):
+    """Merges the catalogs of the tiles into one catalog of the whole image, with every object once.
+
+    Positions are moved onto the image. With label_maps, from stitch_segmentation, each tile keeps the objects it owns in the stitched map, numbered as they are there. Otherwise each tile keeps the objects whose position is in its core, numbered in tile order.
+
+    Parameters
+    ----------
+    tile_cats : list
+        Catalog of each tile, as from noise.read_catalog
+    regions : list
+        (core, pad) of each tile, from tile_regions
+
+    Returns
+    -------
+    cat : numpy array
+        The merged catalog
+
+    """
+    kept = []
+    for tile_no, (cat, (core, pad)) in enumerate(zip(tile_cats, regions)):
+        cat = cat.copy()
+        for name in cat.dtype.names:
+            if X_COLUMN.match(name):
+                cat[name] += pad[2]
+            elif Y_COLUMN.match(name):
+                cat[name] += pad[0]
+        if label_maps is not None:
+            numbers = label_maps[tile_no][np.clip(cat['NUMBER'], 0, len(label_maps[tile_no]) - 1)]
+            cat = cat[numbers != 0]
+            cat['NUMBER'] = numbers[numbers != 0]
+        else:
+            # SExtractor's pixel centres are at whole numbers counting from 1
+            row = np.floor(cat['Y_IMAGE'] - 0.5)
+            col = np.floor(cat['X_IMAGE'] - 0.5)
+            cat = cat[(row >= core[0]) & (row < core[1]) & (col >= core[2]) & (col < core[3])]
+        kept.append(cat)
+
+    # A tile with no objects only knows the widths of its vector columns from the parameter file, so it's left out unless every tile is empty
+    kept = [cat for cat in kept if len(cat)] or kept[:1]
+    dtype = np.dtype([(name, np.float64 if any(cat.dtype[name].kind == 'f' for cat in kept) else np.int64) for name in kept[0].dtype.names])
+    cat = np.concatenate([cat.astype(dtype) for cat in kept])
+    if label_maps is not None:
+        cat = cat[np.argsort(cat['NUMBER'], kind='mergesort')]
+    else:
+        cat['NUMBER'] = np.arange(1, len(cat) + 1)
+    return cat
+
+def sextract_tiles(field_band_dict, stage, det_fname, rms_fname, profile='lean', tile_size=4096, overlap=128, jobs=None, store_dir=None, pipe=False, segmentation=False):
+    """Runs one SExtractor stage in dual mode on overlapping tiles of its images, several tiles at once.
+
+    Each tile's images are cut out just before its run and deleted after it.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    stage : str 'crude', 'false' or 'test'
+        The SExtractor run, for its profile (see sex_profiles.py)
+    det_fname : str
+        The detection image: the science image for the crude run, the false source image for the others. Photometry is always on the science image
+    rms_fname : str
+        The RMS map
+    profile : str 'lean' or 'full'
+        SExtractor profile of the run
+    tile_size, overlap : int
+        Tiling of the image, see tile_regions
+    jobs : int or None
+        Number of tiles to run at once. Defaults to the number of CPUs
+    store_dir : str or None
+        If given, read the images through the field's store (see store.py) instead of from the FITS files
+    pipe : bool
+        Set True to read each tile's catalog straight from SExtractor's output
+    segmentation : bool
+        Set True to ask for each tile's segmentation map
+
+    Returns
+    -------
+    regions : list
+        (core, pad) of each tile, from tile_regions
+    tile_cats : list
+        Catalog of each tile, or None for runs that make no catalog
+    tile_segs : list
+        Filename of the segmentation map of each tile, or None without segmentation
+    tile_dir : str
+        Scratch directory the tiles' outputs are in, to be removed once they're merged
+
+    """
+    ext = field_band_dict.get('ext', 0)
+    sci_header = fits.getheader(field_band_dict['sci'], ext=ext, ignore_missing_end=True)
+    regions = tile_regions((sci_header['NAXIS2'], sci_header['NAXIS1']), tile_size, overlap)
+    scratch_dir = field_band_dict.get('scratch', '')
+    tile_dir = scratch_dir + stage + '_tiles/'
+    if not exists(tile_dir):
+        makedirs(tile_dir)
+
+    if store_dir is not None:
+        # Stored before the tiles start, so no tile reads an image while another is still storing it
+        store.image_data(field_band_dict['sci'], store_dir, ext)
+        store.image_data(rms_fname, store_dir)
+
+    # Written once here, as the tiles' runs share it
+    profile_args = sex_profiles.profile_args(stage, profile, scratch_dir)
+    param_fname = sex_profiles.param_fname(stage, profile, scratch_dir)
+    has_catalog = not (stage == 'crude' and profile == 'lean')
+
+    def run_tile(tile_no):
+        core, pad = regions[tile_no]
+        prefix = tile_dir + 'tile%d_' % tile_no
+        sci_tile = prefix + 'sci.fits'
+        rms_tile = prefix + 'rms.fits'
+        cut_tile(field_band_dict['sci'], sci_tile, pad, ext, store_dir)
+        cut_tile(rms_fname, rms_tile, pad, 0, store_dir)
+        det_tile = sci_tile
+        if det_fname != field_band_dict['sci']:
+            det_tile = prefix + 'det.fits'
+            cut_tile(det_fname, det_tile, pad)
+
+        sex_args = [det_tile + ',' + sci_tile, '-c', 'crude.sex', '-WEIGHT_IMAGE', rms_tile + ',' + rms_tile, '-GAIN', str(field_band_dict['gain']), '-MAG_ZEROPOINT', str(field_band_dict['magz'])]
+        seg_tile = None
+        if segmentation:
+            seg_tile = prefix + 'seg.fits'
+            sex_args += ['-CHECKIMAGE_TYPE', 'SEGMENTATION', '-CHECKIMAGE_NAME', seg_tile]
+        else:
+            sex_args += ['-CHECKIMAGE_TYPE', 'NONE']
+        log_fname = prefix + 'sextractor.log' if field_band_dict.get('sex_log') else None
+        try:
+            tile_cat = None
+            if pipe and has_catalog:
+                tile_cat = noise.piped_catalog(sex_args + profile_args, log_fname=log_fname, param_fname=param_fname)
+            else:
+                run_sextractor(sex_args + profile_args + ['-CATALOG_NAME', prefix + 'cat'], log_fname=log_fname)
+                if has_catalog:
+                    tile_cat = noise.read_catalog(prefix + 'cat', param_fname)
+        finally:
+            for tile_fname in (sci_tile, rms_tile, det_tile):
+                if exists(tile_fname):
+                    remove(tile_fname)
+        return tile_cat, seg_tile
+
+    print "Running SExtractor on %d tiles, %d at a time..." % (len(regions), jobs or multiprocessing.cpu_count())
+    pool = ThreadPool(jobs or multiprocessing.cpu_count())
+    try:
+        results = pool.map(run_tile, range(len(regions)), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return regions, [tile_cat for tile_cat, seg_tile in results], [seg_tile for tile_cat, seg_tile in results], tile_dir
+
+def crude_SExtract_tiled(field_band_dict, profile='lean', tile_size=4096, overlap=128, jobs=None, store_dir=None):
+    """Runs the crude SExtractor run of rms_tools.crude_SExtract on overlapping tiles, stitching their segmentation maps into segmap and, with the full profile, merging their catalogs into cat_crude as ASCII_HEAD.
+
+    Returns
+    -------
+    n_objects : int
+        Number of objects in the stitched segmentation map
+
+    """
+    ext = field_band_dict.get('ext', 0)
+    regions, tile_cats, tile_segs, tile_dir = sextract_tiles(field_band_dict, 'crude', field_band_dict['sci'], field_band_dict['rms_crude'], profile=profile,
+                                                             tile_size=tile_size, overlap=overlap, jobs=jobs, store_dir=store_dir, segmentation=True)
+    try:
+        sci_header = fits.getheader(field_band_dict['sci'], ext=ext, ignore_missing_end=True)
+        label_maps = stitch_segmentation(tile_segs, regions, (sci_header['NAXIS2'], sci_header['NAXIS1']), field_band_dict['segmap'], sci_header)
+        if tile_cats[0] is not None:
+            noise.write_ascii_catalog(merge_catalogs(tile_cats, regions, label_maps), field_band_dict['cat_crude'])
+    finally:
+        shutil.rmtree(tile_dir, ignore_errors=True)
+    return int(sum(label_map.astype(bool).sum() for label_map in label_maps))
+
+def catalog_SExtract_tiled(field_band_dict, stage='false', profile='lean', tile_size=4096, overlap=128, jobs=None, store_dir=None, pipe=False, cat_fname=None):
+    """Runs the false source or test SExtractor run of noise.false_SExtract or noise.test_SExtract on overlapping tiles, merging their catalogs by position.
+
+    With the full profile, the false source run's segmentation maps are stitched into seg_false too.
+
+    Parameters
+    ----------
+    field_band_dict : dict
+        Dict of the various filenames etc relevant to the field and band
+    stage : str 'false' or 'test'
+        The run, with the crude or the normalised RMS map
+    profile : str 'lean' or 'full'
+        SExtractor profile of the run
+    tile_size, overlap, jobs, store_dir, pipe
+        See sextract_tiles
+    cat_fname : str or None
+        File to write the merged catalog to as ASCII_HEAD, if any
+
+    Returns
+    -------
+    cat : numpy array
+        The merged catalog, as from noise.read_catalog
+
+    """
+    rms_fname = field_band_dict['rms_crude'] if stage == 'false' else field_band_dict['rms_norm']
+    segmentation = stage == 'false' and profile == 'full'
+    regions, tile_cats, tile_segs, tile_dir = sextract_tiles(field_band_dict, stage, field_band_dict['false_img'], rms_fname, profile=profile,
+                                                             tile_size=tile_size, overlap=overlap, jobs=jobs, store_dir=store_dir, pipe=pipe, segmentation=segmentation)
+    try:
+        cat = merge_catalogs(tile_cats, regions)
+        if segmentation:
+            sci_header = fits.getheader(field_band_dict['sci'], ext=field_band_dict.get('ext', 0), ignore_missing_end=True)
+            stitch_segmentation(tile_segs, regions, (sci_header['NAXIS2'], sci_header['NAXIS1']), field_band_dict['seg_false'], sci_header)
+        if cat_fname is not None:
+            noise.write_ascii_catalog(cat, cat_fname)
+    finally:
+        shutil.rmtree(tile_dir, ignore_errors=True)
+    return cat